@@ -1,69 +1,216 @@
 #!/usr/bin/env python3
-
+"""
+Copy the files listed in every MANIFEST under IN_DIR to a temp tree and upload it.
+
+Only files that changed since the last successful upload are copied and uploaded. A file
+is unchanged when its size and mtime match the state file, or with --hash when its size
+and SHA-256 do. Files are copied on a thread pool, as hardlinks or reflinks when the temp
+tree is on the same filesystem.
+"""
+
+import argparse
+import concurrent.futures
+import fcntl
+import hashlib
+import json
 import os
-import sys
 import re
+import shlex
+import shutil
+import sys
 import tempfile
 from subprocess import run
-from shutil import copyfile
-
-args = sys.argv[1:]
-in_dir = args[0] if len(args) == 1 else os.getcwd()
-
-if not os.path.isabs(in_dir):
-    in_dir = os.path.abspath(in_dir)
-
-if not os.path.isdir(in_dir):
-    print('"{}" is not a directory'.format(in_dir))
-    sys.exit(1)
-
-work_dir = os.environ['WORK']
-app_dir = re.sub(work_dir, '', in_dir)
-if app_dir.startswith('/'):
-    app_dir = app_dir[1:]
-
-app_base = os.path.split(app_dir)[0]
-
-print('Looking in "{}"'.format(in_dir))
-
-manifests = []
-for root, _, filenames in os.walk(in_dir):
-    for filename in filenames:
-        if filename == 'MANIFEST':
-            manifests.append(os.path.join(root, filename))
-
-num = len(manifests)
-print('Found {} MANIFEST file{} in "{}"'.format(num, '' if num == 1 else 's', in_dir))
-
-if num == 0:
-    sys.exit(1)
-
-file_num = 0
-tmp_dir = os.path.join(tempfile.mkdtemp(), app_dir)
-if not os.path.isdir(tmp_dir):
-    os.makedirs(tmp_dir)
-
-for manifest in manifests:
-    man_dir = os.path.dirname(manifest)
-    print('Processing {}'.format(manifest))
-    for file in open(manifest):
-        file = file.rstrip()
-        path = re.sub('^\.', man_dir, file)
-        file_num += 1
-        print('{:3}: {}'.format(file_num, path))
-
-        if os.path.isfile(path):
-            filedir = os.path.dirname(re.sub(in_dir, '', path))
-            if filedir.startswith('/'):
-                filedir = filedir[1:]
-
-            partial = os.path.join(tmp_dir, filedir)
-            if not os.path.isdir(partial):
-                os.makedirs(partial)
-
-            copyfile(path, os.path.join(partial, os.path.basename(file))) 
 
-dest = 'kyclark/applications/' + app_base
-upload = '/home1/03137/kyclark/cyverse-cli/bin/files-upload'
-run([upload, '-F', tmp_dir, dest])
-print('Done, check "{}"'.format(dest))
+FICLONE = 0x40049409  # linux/fs.h, reflink a whole file on btrfs/xfs
+
+# --------------------------------------------------
+def main():
+    """main"""
+    args = get_args()
+    in_dir = args.in_dir
+
+    if not os.path.isabs(in_dir):
+        in_dir = os.path.abspath(in_dir)
+
+    if not os.path.isdir(in_dir):
+        print('"{}" is not a directory'.format(in_dir))
+        sys.exit(1)
+
+    work_dir = os.environ['WORK']
+    app_dir = re.sub(work_dir, '', in_dir)
+    if app_dir.startswith('/'):
+        app_dir = app_dir[1:]
+
+    app_base = os.path.split(app_dir)[0]
+    state_file = args.state_file or os.path.join(in_dir, '.copy_from_manifest.json')
+
+    print('Looking in "{}"'.format(in_dir))
+
+    manifests = find_manifests(in_dir)
+    num = len(manifests)
+    print('Found {} MANIFEST file{} in "{}"'.format(num, '' if num == 1 else 's', in_dir))
+
+    if num == 0:
+        sys.exit(1)
+
+    files = list_manifest_files(manifests, in_dir)
+    state = load_state(state_file)
+    changed, new_state = find_changed_files(files, state, use_hash=args.hash)
+    removed = sorted(set(state) - set(new_state))
+    print('{} of {} files changed, {} no longer listed'.format(len(changed), len(files), len(removed)))
+
+    if len(changed) == 0:
+        save_state(state_file, new_state)
+        print('Nothing to upload')
+        return
+
+    tmp_root = tempfile.mkdtemp()
+    tmp_dir = os.path.join(tmp_root, app_dir)
+    if not os.path.isdir(tmp_dir):
+        os.makedirs(tmp_dir)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        jobs = [
+            pool.submit(stage_file, path, os.path.join(tmp_dir, rel_path))
+            for rel_path, path in changed
+        ]
+        for file_num, job in enumerate(jobs, start=1):
+            print('{:3}: {} ({})'.format(file_num, changed[file_num - 1][1], job.result()))
+
+    dest = args.dest or 'kyclark/applications/' + app_base
+    upload = [arg.format(src=tmp_dir, dest=dest) for arg in shlex.split(args.upload_cmd)]
+    returncode = run(upload).returncode
+    shutil.rmtree(tmp_root, ignore_errors=True)
+    if returncode != 0:
+        print('Upload failed, state not saved so the next run tries again')
+        sys.exit(1)
+
+    save_state(state_file, new_state)
+    print('Done, check "{}"'.format(dest))
+
+
+# --------------------------------------------------
+def get_args():
+    """command line arguments"""
+    parser = argparse.ArgumentParser(description='Upload changed MANIFEST files')
+    parser.add_argument('in_dir', nargs='?', default=os.getcwd())
+    parser.add_argument('--state-file', default='',
+                        help='where sizes, mtimes and hashes of uploaded files are kept '
+                             '(default: IN_DIR/.copy_from_manifest.json)')
+    parser.add_argument('--hash', action='store_true', default=False,
+                        help='compare SHA-256 when the mtime changed but the size did not')
+    parser.add_argument('--workers', default=8, type=int,
+                        help='number of files copied at a time')
+    parser.add_argument('--upload-cmd',
+                        default='/home1/03137/kyclark/cyverse-cli/bin/files-upload -F {src} {dest}',
+                        help='upload command, {src} is the temp tree and {dest} the destination')
+    parser.add_argument('--dest', default='',
+                        help='upload destination (default: kyclark/applications/APP_BASE)')
+    return parser.parse_args()
+
+
+# --------------------------------------------------
+def find_manifests(in_dir):
+    """all MANIFEST files under in_dir"""
+    manifests = []
+    for root, _, filenames in os.walk(in_dir):
+        for filename in filenames:
+            if filename == 'MANIFEST':
+                manifests.append(os.path.join(root, filename))
+    return manifests
+
+
+# --------------------------------------------------
+def list_manifest_files(manifests, in_dir):
+    """(path relative to in_dir, path) of every existing file listed in the manifests"""
+    files = {}
+    for manifest in manifests:
+        man_dir = os.path.dirname(manifest)
+        print('Processing {}'.format(manifest))
+        for file in open(manifest):
+            file = file.rstrip()
+            if file == '':
+                continue
+            path = re.sub(r'^\.', man_dir, file)
+            if os.path.isfile(path):
+                rel_path = os.path.relpath(path, in_dir)
+                files[rel_path] = path
+            else:
+                print('Missing "{}"'.format(path))
+    return sorted(files.items())
+
+
+# --------------------------------------------------
+def get_sha256(path):
+    """hex SHA-256 of a file"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(2**20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+# --------------------------------------------------
+def find_changed_files(files, state, use_hash=False):
+    """files that differ from the state, and the state after they are uploaded"""
+    changed = []
+    new_state = {}
+    for rel_path, path in files:
+        stat = os.stat(path)
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        old = state.get(rel_path)
+        if old is not None and old['size'] == entry['size'] and old['mtime_ns'] == entry['mtime_ns']:
+            new_state[rel_path] = old
+            continue
+        if use_hash:
+            entry['sha256'] = get_sha256(path)
+            # touched but not modified
+            if old is not None and old['size'] == entry['size'] and old.get('sha256') == entry['sha256']:
+                new_state[rel_path] = entry
+                continue
+        changed.append((rel_path, path))
+        new_state[rel_path] = entry
+    return changed, new_state
+
+
+# --------------------------------------------------
+def stage_file(path, staged_path):
+    """hardlink, reflink or copy path to staged_path, return which one it was"""
+    os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+    if os.stat(path).st_dev == os.stat(os.path.dirname(staged_path)).st_dev:
+        try:
+            os.link(path, staged_path)
+            return 'hardlink'
+        except OSError:
+            pass
+        try:
+            with open(path, 'rb') as src, open(staged_path, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return 'reflink'
+        except OSError:
+            pass
+    shutil.copyfile(path, staged_path)
+    return 'copy'
+
+
+# --------------------------------------------------
+def load_state(state_file):
+    """{relative path: {size, mtime_ns, sha256}} from the last successful upload"""
+    if not os.path.isfile(state_file):
+        return {}
+    with open(state_file) as fh:
+        return json.load(fh)
+
+
+# --------------------------------------------------
+def save_state(state_file, state):
+    """write the state file atomically"""
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as fh:
+        json.dump(state, fh, indent=2, sort_keys=True)
+    os.replace(tmp_file, state_file)
+
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
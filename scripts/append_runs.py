@@ -0,0 +1,222 @@
+"""
+Per-sample files for a whole project, grown one run at a time. With pipeline.py --append
+each input is identified by the SHA-256 of its read, paired and index files; inputs already
+appended are skipped without being processed again, and the final per-sample reads of a new
+input are appended to WORK_DIR/samples/SAMPLE.fastq (SAMPLE_R1.fastq and SAMPLE_R2.fastq
+for paired ends), with their .idx record indexes extended in place.
+
+WORK_DIR/samples/runs.json lists the appended runs with their per-sample read counts, the
+project's reads per sample and the committed size of every sample file. An append that did
+not finish is rolled back to those sizes by the next one.
+
+    python append_runs.py WORK_DIR
+"""
+import argparse
+import array
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+
+from pipeline_util import *
+from record_index import RecordIndexBuilder, build_index, get_index_fp, index_header, index_magic
+
+
+samples_dir_name = 'samples'
+runs_file_name = 'runs.json'
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('work_dir')
+    args = arg_parser.parse_args()
+
+    appender = SampleAppender(args.work_dir)
+    state = appender.load_state()
+    for input_hash, run in sorted(state['runs'].items(), key=lambda r: r[1]['appended_at']):
+        print('{}  {}  {} reads'.format(input_hash[:12], run['input_name'], sum(run['samples'].values())))
+    for sample_name, count in sorted(state['samples'].items()):
+        print('{}\t{}'.format(sample_name, count))
+    return 0
+
+
+def get_sha256(fp_list, state_hashes):
+    """SHA-256 of the files one after the other, reusing hashes of files whose size and mtime are unchanged."""
+    stamps = []
+    for fp in fp_list:
+        stat = os.stat(fp)
+        stamps.append('{}:{}:{}'.format(os.path.abspath(fp), stat.st_size, stat.st_mtime_ns))
+    key = '|'.join(stamps)
+    if key not in state_hashes:
+        sha = hashlib.sha256()
+        for fp in fp_list:
+            with open(fp, 'rb') as input_file:
+                for block in iter(lambda: input_file.read(4 * 2**20), b''):
+                    sha.update(block)
+        state_hashes[key] = sha.hexdigest()
+    return state_hashes[key]
+
+
+def append_fastq(input_fp, output_fp, index_every=0):
+    """Append the records of input_fp to output_fp and extend its index, returns the records appended."""
+    output_index_fp = get_index_fp(output_fp)
+    # sample files started without an index stay without one
+    if os.path.exists(output_fp):
+        has_index = os.path.exists(output_index_fp)
+    else:
+        has_index = index_every > 0
+    if not has_index:
+        with open(input_fp, 'rb') as input_file, open(output_fp, 'ab') as output_file:
+            copy_file_bytes(input_file, output_file)
+        with open(input_fp, 'rb') as input_file:
+            return sum(1 for _ in input_file) // 4
+
+    if os.path.exists(output_index_fp):
+        with open(output_index_fp, 'rb') as index_file:
+            _, every, record_count, byte_count = index_header.unpack(index_file.read(index_header.size))
+    else:
+        every, record_count, byte_count = index_every, 0, 0
+    input_index = None
+    if os.path.exists(get_index_fp(input_fp)):
+        with open(get_index_fp(input_fp), 'rb') as index_file:
+            header = index_header.unpack(index_file.read(index_header.size))
+            if header[0] == index_magic and header[1] == every and header[3] == os.path.getsize(input_fp):
+                input_index = header, array.array('Q', index_file.read())
+
+    if input_index is not None and record_count % every == 0:
+        # the input's indexed records are exactly the ones to index, shifted by the bytes already there
+        (_, _, input_records, input_bytes), input_offsets = input_index
+        with open(input_fp, 'rb') as input_file, open(output_fp, 'ab') as output_file:
+            copy_file_bytes(input_file, output_file)
+        new_offsets = array.array('Q', (byte_count + offset for offset in input_offsets))
+    else:
+        builder = RecordIndexBuilder(every=every)
+        builder.record_count = record_count
+        builder.byte_count = byte_count
+        with open(input_fp, 'rb') as input_file, open(output_fp, 'ab') as output_file:
+            while True:
+                record = b''.join(input_file.readline() for _ in range(4))
+                if record == b'':
+                    break
+                builder.add(len(record))
+                output_file.write(record)
+        input_records = builder.record_count - record_count
+        input_bytes = builder.byte_count - byte_count
+        new_offsets = builder.offsets
+
+    # rewrite the header and add the new offsets at the end, the old offsets stay where they are
+    with open(output_index_fp, 'r+b' if os.path.exists(output_index_fp) else 'wb') as index_file:
+        index_file.write(index_header.pack(index_magic, every, record_count + input_records, byte_count + input_bytes))
+        index_file.seek(0, os.SEEK_END)
+        new_offsets.tofile(index_file)
+    return input_records
+
+
+class SampleAppender:
+    def __init__(self, work_dir):
+        self.samples_dir = os.path.join(work_dir, samples_dir_name)
+        self.runs_fp = os.path.join(self.samples_dir, runs_file_name)
+
+    def load_state(self):
+        if not os.path.exists(self.runs_fp):
+            return {'runs': {}, 'samples': {}, 'sizes': {}, 'hashes': {}}
+        with open(self.runs_fp, 'rt') as runs_file:
+            return json.load(runs_file)
+
+    def save_state(self, state):
+        tmp_fp = self.runs_fp + '.tmp'
+        with open(tmp_fp, 'wt') as runs_file:
+            json.dump(state, runs_file, indent=2, sort_keys=True)
+        os.replace(tmp_fp, self.runs_fp)
+
+    def lock(self):
+        os.makedirs(self.samples_dir, exist_ok=True)
+        lock_file = open(os.path.join(self.samples_dir, '.lock'), 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def find_run(self, input_fp_list, input_name):
+        """The hash of the input files and the run already appended for it, or None."""
+        with self.lock():
+            state = self.load_state()
+            input_hash = get_sha256(input_fp_list, state['hashes'])
+            self.save_state(state)
+        run = state['runs'].get(input_hash)
+        if run is None:
+            for other_hash, other_run in state['runs'].items():
+                if other_run['input_name'] == input_name:
+                    # the step directories of that run would be taken for this one's
+                    raise PipelineException(
+                        'a different "{}" was already appended (SHA-256 {}), rename the new input'.format(
+                            input_name, other_hash[:12]))
+        return input_hash, run
+
+    def roll_back(self, state):
+        # an append that did not finish left bytes past the committed sizes
+        log = logging.getLogger(name=__name__)
+        for file_name in sorted(os.listdir(self.samples_dir)):
+            if not file_name.endswith('.fastq'):
+                continue
+            fastq_fp = os.path.join(self.samples_dir, file_name)
+            committed = state['sizes'].get(file_name, 0)
+            index_header_values = None
+            if os.path.exists(get_index_fp(fastq_fp)):
+                with open(get_index_fp(fastq_fp), 'rb') as index_file:
+                    index_header_values = index_header.unpack(index_file.read(index_header.size))
+            index_bytes = committed if index_header_values is None else index_header_values[3]
+            if os.path.getsize(fastq_fp) == committed and index_bytes == committed:
+                continue
+            log.warning('rolling "%s" back to %d bytes', fastq_fp, committed)
+            if committed == 0:
+                os.remove(fastq_fp)
+                if index_header_values is not None:
+                    os.remove(get_index_fp(fastq_fp))
+                continue
+            with open(fastq_fp, 'r+b') as fastq_file:
+                fastq_file.truncate(committed)
+            if index_header_values is None:
+                continue
+            _, every, record_count, _ = index_header_values
+            if index_bytes == committed:
+                # the header was not rewritten yet, drop any offsets added after it
+                with open(get_index_fp(fastq_fp), 'r+b') as index_file:
+                    index_file.truncate(index_header.size + 8 * ((record_count + every - 1) // every))
+            else:
+                build_index(fastq_fp, every=every)
+
+    def append_run(self, input_hash, input_name, final_dir, file_name, index_every=0):
+        """Append the per-sample FASTQ files in final_dir, named FILE_NAME_SAMPLE*.fastq, to the project."""
+        log = logging.getLogger(name=__name__)
+        prefix = file_name + '_'
+        sample_fps = [
+            os.path.join(final_dir, name)
+            for name
+            in sorted(os.listdir(final_dir))
+            if name.startswith(prefix) and name.endswith('.fastq')
+        ]
+        with self.lock():
+            state = self.load_state()
+            if input_hash in state['runs']:
+                return state['runs'][input_hash]
+            self.roll_back(state)
+            run = {'input_name': input_name, 'appended_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'samples': {}}
+            for sample_fp in sample_fps:
+                sample_file_name = os.path.basename(sample_fp)[len(prefix):]
+                output_fp = os.path.join(self.samples_dir, sample_file_name)
+                records = append_fastq(sample_fp, output_fp, index_every=index_every)
+                sample_name = sample_file_name[:-len('.fastq')]
+                run['samples'][sample_name] = records
+                state['samples'][sample_name] = state['samples'].get(sample_name, 0) + records
+                state['sizes'][sample_file_name] = os.path.getsize(output_fp)
+            state['runs'][input_hash] = run
+            self.save_state(state)
+        log.info('appended %d reads of "%s" to %d sample files in "%s"',
+                 sum(run['samples'].values()), input_name, len(sample_fps), self.samples_dir)
+        return run
+
+
+if __name__ == '__main__':
+    sys.exit(main())
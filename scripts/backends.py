@@ -0,0 +1,172 @@
+"""
+Demultiplexing backends used by Pipeline steps 01 to 03. Every backend writes the same
+file names into the step output directory (reads1.fastq, barcodes.fastq, seqs.fastq,
+SAMPLE_ID.fastq, ...) so the steps can rename and find them the same way whichever
+backend produced them.
+"""
+import os
+
+from pipeline_util import *
+import demux
+
+
+class QiimeBackend:
+    name = 'qiime'
+
+    def __init__(self, mapping_file, barcode_length, max_barcode_errors, sample_interval=1.0, **kwargs):
+        self.mapping_file = mapping_file
+        self.barcode_length = barcode_length
+        self.max_barcode_errors = max_barcode_errors
+        # seconds between /proc samples of the QIIME scripts
+        self.sample_interval = sample_interval
+
+    def extract_barcodes(self, forward_fp, reverse_fp, output_dir, barcode_offset=0):
+        if barcode_offset != 0:
+            raise PipelineException('extract_barcodes.py cannot skip {} bases before the barcode, '
+                                    'use the native backend'.format(barcode_offset))
+        require_executable('extract_barcodes.py')
+        if reverse_fp is None:
+            cmd_line_list = [
+                #'python', '/miniconda/bin/extract_barcodes.py',
+                'extract_barcodes.py',
+                '-f', forward_fp,
+                '-c', 'barcode_single_end',
+                '-m', str(self.mapping_file),
+                '-l', str(self.barcode_length),
+                '-o', str(output_dir)
+            ]
+        else:
+            cmd_line_list = [
+                #'python', '/miniconda/bin/extract_barcodes.py',
+                'extract_barcodes.py',
+                '-f', forward_fp,
+                '-r', reverse_fp,
+                '-c', 'barcode_paired_end',
+                '-m', str(self.mapping_file),
+                '-l', str(self.barcode_length),
+                '-L', str(self.barcode_length),
+                '-o', str(output_dir)
+            ]
+        check_cmd(cmd_line_list, log_file=os.path.join(output_dir, 'log'), sample_interval=self.sample_interval)
+
+    def split_libraries(self, read_fp_list, barcodes_fp_list, output_dir, barcode_offset=0, rev_comp_barcode=True,
+                        index2_fp_list=None, index_caches=None):
+        if index2_fp_list is not None:
+            raise PipelineException('dual index demultiplexing needs the native backend')
+        if barcode_offset != 0:
+            raise PipelineException('split_libraries_fastq.py cannot skip {} bases before the barcode, '
+                                    'use the native backend'.format(barcode_offset))
+        require_executable('split_libraries_fastq.py')
+        #TODO Make argument for -q and --max_barcode_errors (1-step vs 2-step PCR?)?
+        check_cmd([
+                #'python', '/miniconda/bin/split_libraries_fastq.py',
+                'split_libraries_fastq.py',
+                '-o', str(output_dir),
+                '-b', ','.join(str(fp) for fp in barcodes_fp_list),
+                '-i', ','.join(str(fp) for fp in read_fp_list),
+                '-m', str(self.mapping_file),
+                '--barcode_type', str(self.barcode_length),
+                '-q', '0',
+                '--max_barcode_errors', str(self.max_barcode_errors),
+                '--phred_offset=33',
+                '--store_demultiplexed_fastq'
+            ] + (['--rev_comp_barcode'] if rev_comp_barcode else []),
+            log_file=os.path.join(output_dir, 'log'),
+            sample_interval=self.sample_interval
+        )
+
+    def demultiplex_to_samples(self, read_fp_list, output_dir, file_name, **kwargs):
+        raise PipelineException('demultiplexing straight to per-sample files needs the native backend')
+
+    def split_sequence_file_on_sample_ids(self, seqs_fp, output_dir, dereplicate_minuniquesize=0):
+        if dereplicate_minuniquesize > 0:
+            raise PipelineException('dereplicating samples as they are written needs the native backend')
+        require_executable('split_sequence_file_on_sample_ids.py')
+        check_cmd([
+                #'python', '/miniconda/bin/split_sequence_file_on_sample_ids.py',
+                'split_sequence_file_on_sample_ids.py',
+                '-i', seqs_fp,
+                '-o', str(output_dir),
+                '--file_type', 'fastq'
+            ],
+            log_file=os.path.join(output_dir, 'log'),
+            sample_interval=self.sample_interval
+        )
+
+    def get_sample_file_names(self, sample_ids, dereplicate_minuniquesize=0):
+        # QIIME does not report its samples, the step lists its output directory instead
+        return None
+
+
+class NativeBackend:
+    name = 'native'
+
+    def __init__(self, mapping_file, barcode_length, max_barcode_errors, write_buffer_size=512 * 2**20,
+                 index_every=0, index2_length=None, rev_comp_index2=False, **kwargs):
+        self.mapping_file = mapping_file
+        self.barcode_length = barcode_length
+        self.max_barcode_errors = max_barcode_errors
+        self.write_buffer_size = write_buffer_size
+        self.index_every = index_every
+        self.index2_length = index2_length
+        self.rev_comp_index2 = rev_comp_index2
+
+    def extract_barcodes(self, forward_fp, reverse_fp, output_dir, barcode_offset=0):
+        return demux.extract_barcodes(
+            forward_fp, reverse_fp, output_dir, self.barcode_length,
+            barcode_offset=barcode_offset,
+            write_buffer_size=self.write_buffer_size)
+
+    def split_libraries(self, read_fp_list, barcodes_fp_list, output_dir, barcode_offset=0, rev_comp_barcode=True,
+                        index2_fp_list=None, index_caches=None):
+        demux.split_libraries(
+            read_fp_list, barcodes_fp_list, output_dir,
+            mapping_file=self.mapping_file,
+            barcode_length=self.barcode_length,
+            max_barcode_errors=self.max_barcode_errors,
+            barcode_offset=barcode_offset,
+            rev_comp_barcode=rev_comp_barcode,
+            write_buffer_size=self.write_buffer_size,
+            index2_fp_list=index2_fp_list,
+            index2_length=self.index2_length,
+            rev_comp_index2=self.rev_comp_index2,
+            index_caches=index_caches)
+
+    def demultiplex_to_samples(self, read_fp_list, output_dir, file_name, index_fp=None, index2_fp=None,
+                               barcode_offset=0, rev_comp_barcode=True):
+        return demux.demultiplex_to_samples(
+            read_fp_list, output_dir, file_name,
+            mapping_file=self.mapping_file,
+            barcode_length=self.barcode_length,
+            index_fp=index_fp,
+            index2_fp=index2_fp,
+            max_barcode_errors=self.max_barcode_errors,
+            barcode_offset=barcode_offset,
+            rev_comp_barcode=rev_comp_barcode,
+            write_buffer_size=self.write_buffer_size,
+            index_every=self.index_every,
+            index2_length=self.index2_length,
+            rev_comp_index2=self.rev_comp_index2)
+
+    def split_sequence_file_on_sample_ids(self, seqs_fp, output_dir, dereplicate_minuniquesize=0):
+        return demux.split_sequence_file_on_sample_ids(
+            seqs_fp, output_dir,
+            dereplicate_minuniquesize=dereplicate_minuniquesize,
+            write_buffer_size=self.write_buffer_size,
+            index_every=self.index_every)
+
+    def get_sample_file_names(self, sample_ids, dereplicate_minuniquesize=0):
+        return demux.get_sample_file_names(
+            sample_ids, index_every=self.index_every, dereplicate_minuniquesize=dereplicate_minuniquesize)
+
+
+backends = {
+    QiimeBackend.name: QiimeBackend,
+    NativeBackend.name: NativeBackend,
+}
+
+
+def get_backend(name, **kwargs):
+    if name not in backends:
+        raise PipelineException('unknown backend "{}", choose one of {}'.format(name, ', '.join(sorted(backends))))
+    return backends[name](**kwargs)
@@ -0,0 +1,95 @@
+"""
+Per-sample output buffering. Records are collected in one buffer per output file and written
+with a single large write when the file is flushed. When the total buffered bytes reach the
+memory budget the largest buffers are flushed first, so each flush is as large as possible.
+With index_every, each write is one FASTQ record and every file gets a record offset index.
+"""
+import logging
+
+from record_index import RecordIndexBuilder, get_index_fp
+
+
+class BufferedSampleWriter:
+    def __init__(self, memory_budget=512 * 2**20, index_every=0):
+        self.memory_budget = memory_budget
+        self.index_every = index_every
+        self.index_builders = {}
+        self.buffers = {}
+        self.buffer_sizes = {}
+        self.buffered_bytes = 0
+        self.created = set()
+        self.flush_count = 0
+        self.flushed_bytes = 0
+        self.largest_flush = 0
+        self.budget_flush_count = 0
+
+    def write(self, output_fp, data):
+        if output_fp not in self.buffers:
+            self.buffers[output_fp] = []
+            self.buffer_sizes[output_fp] = 0
+            if self.index_every > 0:
+                self.index_builders[output_fp] = RecordIndexBuilder(every=self.index_every)
+        if self.index_every > 0 and len(data) > 0:
+            self.index_builders[output_fp].add(len(data))
+        self.buffers[output_fp].append(data)
+        self.buffer_sizes[output_fp] += len(data)
+        self.buffered_bytes += len(data)
+        if self.buffered_bytes >= self.memory_budget:
+            self.flush_largest()
+
+    def flush(self, output_fp):
+        data = ''.join(self.buffers[output_fp]).encode('ascii')
+        # the first flush creates the file, later flushes append to it
+        with open(output_fp, 'ab' if output_fp in self.created else 'wb') as output_file:
+            output_file.write(data)
+        self.created.add(output_fp)
+        self.buffered_bytes -= self.buffer_sizes[output_fp]
+        self.buffers[output_fp] = []
+        self.buffer_sizes[output_fp] = 0
+        self.flush_count += 1
+        self.flushed_bytes += len(data)
+        self.largest_flush = max(self.largest_flush, len(data))
+
+    def flush_largest(self):
+        # flush the largest buffers until half of the budget is free again
+        self.budget_flush_count += 1
+        for output_fp in sorted(self.buffer_sizes, key=self.buffer_sizes.get, reverse=True):
+            if self.buffered_bytes <= self.memory_budget // 2:
+                break
+            self.flush(output_fp)
+
+    def close(self):
+        for output_fp in list(self.buffers):
+            if self.buffer_sizes[output_fp] > 0 or output_fp not in self.created:
+                self.flush(output_fp)
+        for output_fp, index_builder in self.index_builders.items():
+            index_builder.write(get_index_fp(output_fp))
+        self.index_builders = {}
+        return self.get_counters()
+
+    def get_counters(self):
+        return {
+            'files': len(self.buffers),
+            'flushes': self.flush_count,
+            'flushed_bytes': self.flushed_bytes,
+            'mean_flush_bytes': self.flushed_bytes // self.flush_count if self.flush_count else 0,
+            'largest_flush_bytes': self.largest_flush,
+            'budget_flushes': self.budget_flush_count,
+        }
+
+    def log_counters(self, log=None):
+        log = log or logging.getLogger(name=__name__)
+        counters = self.get_counters()
+        log.info(
+            'wrote %d files with %d flushes (%.1f MB, mean flush %.1f KB, largest %.1f KB), '
+            '%d flushes forced by the %.0f MB budget',
+            counters['files'], counters['flushes'], counters['flushed_bytes'] / 2**20,
+            counters['mean_flush_bytes'] / 2**10, counters['largest_flush_bytes'] / 2**10,
+            counters['budget_flushes'], self.memory_budget / 2**20)
+        return counters
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,24 @@
+"""
+Combine per-run files (e.g. Mock_Run3_V4.fastq.gz and Mock_Run4_V4.fastq.gz) into one file
+named by get_combined_file_name (Mock_Run3_Run4_V4.fastq.gz) without recompressing them.
+"""
+import argparse
+import logging
+
+from pipeline_util import *
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-o', '--output-dir', required=True)
+    arg_parser.add_argument('input_files', nargs='+')
+    args = arg_parser.parse_args()
+
+    log = logging.getLogger(name=__name__)
+    output_fp = combine_runs(args.input_files, args.output_dir)
+    log.info('combined %d files into "%s"', len(args.input_files), output_fp)
+
+
+if __name__ == '__main__':
+    main()
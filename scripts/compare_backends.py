@@ -0,0 +1,200 @@
+"""
+Differential equivalence harness for the demultiplexing backends.
+
+Runs the pipeline once per backend on the same dataset (a real one, or one generated with
+--generate) and compares the per-sample read ID sets and counts of the final per-sample
+files. Prints the differences and the speedup and writes them to WORK_DIR/comparison.json.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+from pipeline_util import *
+from pipeline import Pipeline
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-i', '--input-file', default='',
+                            help='path to the input file (not needed with --generate)')
+    arg_parser.add_argument('-w', '--work-dir', required=True,
+                            help='each backend writes to WORK_DIR/BACKEND')
+    arg_parser.add_argument('-b', '--barcode-length', default=12, type=int)
+    arg_parser.add_argument('-m', '--mapping-file', default='')
+    arg_parser.add_argument('-p', '--paired-ends', default='')
+    arg_parser.add_argument('-d', '--index-file', default='')
+    arg_parser.add_argument('-e', '--max-barcode-errors', default=0)
+    arg_parser.add_argument('--backends', default='qiime,native',
+                            help='comma separated backends, the first is the reference')
+    arg_parser.add_argument('--generate', default=0, type=int,
+                            help='generate a paired-end dataset with this many reads in WORK_DIR/data')
+    arg_parser.add_argument('--generate-samples', default=24, type=int)
+    arg_parser.add_argument('--generate-index', action='store_true', default=False,
+                            help='put the generated barcodes in an index file (-d mode)')
+    args = arg_parser.parse_args()
+
+    if args.generate > 0:
+        dataset = generate_dataset(
+            os.path.join(args.work_dir, 'data'),
+            read_count=args.generate,
+            sample_count=args.generate_samples,
+            barcode_length=args.barcode_length,
+            index=args.generate_index)
+        args.__dict__.update(dataset)
+    elif args.input_file == '' or args.mapping_file == '':
+        arg_parser.error('-i and -m are required without --generate')
+
+    report = compare_backends(backend_names=args.backends.split(','), **args.__dict__)
+    print_report(report)
+    return 0 if report['equivalent'] else 1
+
+
+def random_seq(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+def generate_dataset(output_dir, read_count, sample_count=24, barcode_length=12, read_length=150,
+                     index=False, unassigned_fraction=0.05, n_fraction=0.01, seed=1):
+    """
+    Write a QIIME mapping file and paired-end reads whose barcodes are the reverse complement
+    of a mapping file barcode (as --rev_comp_barcode expects), with a fraction of reads carrying
+    an unknown barcode or an N. Returns the pipeline arguments for the dataset.
+    """
+    rng = random.Random(seed)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    barcodes = {}
+    while len(barcodes) < sample_count:
+        barcodes[random_seq(rng, barcode_length)] = 'Sample{}'.format(len(barcodes) + 1)
+
+    mapping_fp = os.path.join(output_dir, 'mapping.txt')
+    with open(mapping_fp, 'wt') as mapping_file:
+        mapping_file.write('#SampleID\tBarcodeSequence\tLinkerPrimerSequence\tDescription\n')
+        for barcode, sample_id in barcodes.items():
+            mapping_file.write('{}\t{}\tGTGCCAGCMGCCGCGGTAA\t{}\n'.format(sample_id, barcode, sample_id))
+
+    forward_fp = os.path.join(output_dir, 'generated_R1.fastq')
+    reverse_fp = os.path.join(output_dir, 'generated_R2.fastq')
+    index_fp = os.path.join(output_dir, 'generated_I1.fastq')
+    barcode_list = list(barcodes)
+    with open(forward_fp, 'wt') as forward_file, open(reverse_fp, 'wt') as reverse_file, \
+            open(index_fp if index else os.devnull, 'wt') as index_file:
+        for n in range(read_count):
+            if rng.random() < unassigned_fraction:
+                barcode = random_seq(rng, barcode_length)
+            else:
+                barcode = reverse_complement(rng.choice(barcode_list))
+            forward_seq = random_seq(rng, read_length)
+            reverse_seq = random_seq(rng, read_length)
+            if rng.random() < n_fraction:
+                n_position = barcode_length + 10
+                forward_seq = forward_seq[:n_position] + 'N' + forward_seq[n_position + 1:]
+            read_id = 'GEN:1:FC:1:1101:{}:{}'.format(n // 1000, n % 1000)
+            if index:
+                index_file.write('@{} 1:N:0:1\n{}\n+\n{}\n'.format(read_id, barcode, 'I' * barcode_length))
+            else:
+                forward_seq = barcode + forward_seq[barcode_length:]
+                reverse_seq = barcode + reverse_seq[barcode_length:]
+            forward_file.write('@{} 1:N:0:1\n{}\n+\n{}\n'.format(read_id, forward_seq, 'I' * read_length))
+            reverse_file.write('@{} 2:N:0:1\n{}\n+\n{}\n'.format(read_id, reverse_seq, 'I' * read_length))
+
+    return {
+        'input_file': forward_fp,
+        'paired_ends': reverse_fp,
+        'index_file': index_fp if index else '',
+        'mapping_file': mapping_fp,
+    }
+
+
+def get_per_sample_read_ids(output_dir):
+    # the original read ID is the second field of both the step_03 and step_04 headers
+    read_ids = {}
+    for entry in get_sorted_file_list(output_dir):
+        if not entry.name.endswith('.fastq'):
+            continue
+        with open(entry.path, 'rt') as sample_file:
+            read_ids[entry.name] = {
+                get_read_id(header.split(None, 2)[1])
+                for header, _, _, _
+                in iter_fastq_records(sample_file)
+            }
+    return read_ids
+
+
+def compare_read_ids(reference, other):
+    differences = {}
+    for name in sorted(set(reference) | set(other)):
+        reference_ids = reference.get(name, set())
+        other_ids = other.get(name, set())
+        if reference_ids != other_ids:
+            differences[name] = {
+                'reference_count': len(reference_ids),
+                'count': len(other_ids),
+                'only_in_reference': len(reference_ids - other_ids),
+                'only_in_other': len(other_ids - reference_ids),
+                'examples': sorted(reference_ids ^ other_ids)[:5],
+            }
+    return differences
+
+
+def compare_backends(backend_names, input_file, work_dir, **kwargs):
+    log = logging.getLogger(name=__name__)
+    results = {}
+    for backend_name in backend_names:
+        backend_work_dir = os.path.join(work_dir, backend_name)
+        if not os.path.isdir(backend_work_dir):
+            os.makedirs(backend_work_dir)
+        log.info('running backend "%s" in "%s"', backend_name, backend_work_dir)
+        start = time.perf_counter()
+        output_dir_list = Pipeline(
+            input_file=input_file, work_dir=backend_work_dir, backend=backend_name, **kwargs).run(input_file=input_file)
+        seconds = time.perf_counter() - start
+        results[backend_name] = {
+            'seconds': seconds,
+            'output_dir': output_dir_list[-1],
+            'read_ids': get_per_sample_read_ids(output_dir_list[-1]),
+        }
+
+    reference_name = backend_names[0]
+    reference = results[reference_name]
+    report = {
+        'reference': reference_name,
+        'reference_seconds': reference['seconds'],
+        'samples': {name: len(ids) for name, ids in reference['read_ids'].items()},
+        'backends': {},
+        'equivalent': True,
+    }
+    for backend_name in backend_names[1:]:
+        differences = compare_read_ids(reference['read_ids'], results[backend_name]['read_ids'])
+        report['backends'][backend_name] = {
+            'seconds': results[backend_name]['seconds'],
+            'speedup': reference['seconds'] / results[backend_name]['seconds'],
+            'differences': differences,
+        }
+        report['equivalent'] = report['equivalent'] and len(differences) == 0
+
+    with open(os.path.join(work_dir, 'comparison.json'), 'wt') as report_file:
+        json.dump(report, report_file, indent=2)
+    return report
+
+
+def print_report(report):
+    print('reference backend "{}": {} files, {} reads in {:.1f}s'.format(
+        report['reference'], len(report['samples']), sum(report['samples'].values()), report['reference_seconds']))
+    for backend_name, backend_report in sorted(report['backends'].items()):
+        print('backend "{}": {:.1f}s, {:.2f}x speedup, {} files differ'.format(
+            backend_name, backend_report['seconds'], backend_report['speedup'], len(backend_report['differences'])))
+        for name, difference in sorted(backend_report['differences'].items()):
+            print('  {}: {} reads vs {} ({} only in reference, {} only in "{}")'.format(
+                name, difference['reference_count'], difference['count'],
+                difference['only_in_reference'], difference['only_in_other'], backend_name))
+    print('EQUIVALENT' if report['equivalent'] else 'DIFFERENT')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,414 @@
+"""
+Native demultiplexing: the barcode extraction, library splitting and per-sample splitting that
+extract_barcodes.py, split_libraries_fastq.py and split_sequence_file_on_sample_ids.py do,
+written so that the outputs have the same names and the same record format as QIIME's.
+"""
+import itertools
+import logging
+import os
+import statistics
+
+from pipeline_util import *
+from buffered_writer import BufferedSampleWriter
+from readahead import SynchronizedReader
+from dereplicate import SampleDereplicators
+from progress import report_reads
+from record_index import get_index_fp
+
+
+# reads are matched to cached barcodes by record number, a sample of read IDs is enough to
+# catch an index file that does not belong to the reads
+index_cache_check_every = 64
+
+
+def get_hamming_neighbors(barcode, distance):
+    # all sequences exactly `distance` substitutions away from barcode
+    for positions in itertools.combinations(range(len(barcode)), distance):
+        for replacements in itertools.product('ACGT', repeat=distance):
+            if any(barcode[p] == r for p, r in zip(positions, replacements)):
+                continue
+            neighbor = list(barcode)
+            for p, r in zip(positions, replacements):
+                neighbor[p] = r
+            yield ''.join(neighbor)
+
+
+def build_barcode_table(barcodes, max_barcode_errors=0):
+    """
+    Map every sequence within max_barcode_errors substitutions of a mapping file barcode to
+    (sample_id, corrected barcode, bc_diffs). Sequences that are equally close to two
+    barcodes are left out, exact matches always win.
+    """
+    table = {barcode: (sample_id, barcode, 0) for barcode, sample_id in barcodes.items()}
+    for distance in range(1, int(float(max_barcode_errors)) + 1):
+        ambiguous = set()
+        found = {}
+        for barcode, sample_id in barcodes.items():
+            for neighbor in get_hamming_neighbors(barcode, distance):
+                if neighbor in table:
+                    continue
+                elif neighbor in found and found[neighbor][1] != barcode:
+                    ambiguous.add(neighbor)
+                else:
+                    found[neighbor] = (sample_id, barcode, distance)
+        for neighbor in ambiguous:
+            del found[neighbor]
+        table.update(found)
+    return table
+
+
+# compiled lookup tables by mapping file, so a process that runs many jobs (service.py)
+# builds them once per mapping file
+_mapping_tables = {}
+max_cached_mapping_tables = 32
+
+
+def get_mapping_tables(mapping_file, max_barcode_errors=0, dual_index=False):
+    """
+    build_barcode_table for the mapping file barcodes, or build_dual_index_tables with
+    dual_index, reused while the mapping file is unchanged.
+    """
+    stat = os.stat(mapping_file)
+    key = (os.path.abspath(mapping_file), stat.st_size, stat.st_mtime_ns, int(float(max_barcode_errors)), dual_index)
+    if key not in _mapping_tables:
+        if len(_mapping_tables) >= max_cached_mapping_tables:
+            del _mapping_tables[next(iter(_mapping_tables))]
+        if dual_index:
+            _mapping_tables[key] = build_dual_index_tables(get_mapping_index_pairs(mapping_file), max_barcode_errors)
+        else:
+            _mapping_tables[key] = build_barcode_table(get_mapping_barcodes(mapping_file), max_barcode_errors)
+    return _mapping_tables[key]
+
+
+def build_dual_index_tables(index_pairs, max_barcode_errors=0):
+    """
+    Factored lookup for combinatorial dual indexes: one error tolerant table for i7 and one for
+    i5, each mapping a sequence to (_, corrected index, diffs), and a table mapping the pair of
+    corrected indexes to the sample. Memory grows with the number of i7 plus i5 indexes rather
+    than with the number of pairs times their error neighborhoods.
+    """
+    i7_table = build_barcode_table({i7: i7 for i7, _ in index_pairs}, max_barcode_errors)
+    i5_table = build_barcode_table({i5: i5 for _, i5 in index_pairs}, max_barcode_errors)
+    return i7_table, i5_table, dict(index_pairs)
+
+
+class BarcodeMatcher:
+    """
+    Sample lookup for a barcode, or for the i7 and i5 of a dual indexed run. match() returns
+    (sample_id, orig_bc, new_bc, bc_diffs) or None. Reads with a known i7 and a known i5 that
+    are not a pair in the mapping file are counted per pair in hopped_counts.
+    """
+    def __init__(self, mapping_file, max_barcode_errors=0, rev_comp_barcode=True, dual_index=False,
+                 rev_comp_index2=False):
+        self.rev_comp_barcode = rev_comp_barcode
+        self.rev_comp_index2 = rev_comp_index2
+        self.dual_index = dual_index
+        if dual_index:
+            self.barcode_table, self.index2_table, self.pair_table = get_mapping_tables(
+                mapping_file, max_barcode_errors, dual_index=True)
+        else:
+            self.barcode_table = get_mapping_tables(mapping_file, max_barcode_errors)
+            self.pair_table = None
+        self.hopped_counts = {}
+
+    def match(self, barcode, index2=None):
+        if self.rev_comp_barcode:
+            barcode = reverse_complement(barcode)
+        match = self.barcode_table.get(barcode)
+        if match is None:
+            return None
+        elif not self.dual_index:
+            return match[0], barcode, match[1], match[2]
+        if self.rev_comp_index2:
+            index2 = reverse_complement(index2)
+        index2_match = self.index2_table.get(index2)
+        if index2_match is None:
+            return None
+        index_pair = (match[1], index2_match[1])
+        sample_id = self.pair_table.get(index_pair)
+        if sample_id is None:
+            self.hopped_counts[index_pair] = self.hopped_counts.get(index_pair, 0) + 1
+            return None
+        return sample_id, barcode + index2, match[1] + index2_match[1], match[2] + index2_match[2]
+
+    def get_index_hopped_count(self):
+        return sum(self.hopped_counts.values())
+
+
+def write_index_hopping_report(report_fp, index_pairs, hopped_counts, assigned_count):
+    hopped_count = sum(hopped_counts.values())
+    with open(report_fp, 'wt') as report_file:
+        report_file.write('Index pairs in mapping file: {}\n'.format(len(index_pairs)))
+        report_file.write('Reads with an expected index pair: {}\n'.format(assigned_count))
+        report_file.write('Reads with an unexpected index pair: {}\n'.format(hopped_count))
+        report_file.write('Index hopping rate: {:.4%}\n'.format(
+            hopped_count / (assigned_count + hopped_count) if assigned_count + hopped_count else 0))
+        report_file.write('\ni7\ti5\treads\n')
+        for (i7, i5), count in sorted(hopped_counts.items(), key=lambda c: -c[1]):
+            report_file.write('{}\t{}\t{}\n'.format(i7, i5, count))
+
+
+def extract_barcodes(forward_fp, reverse_fp, output_dir, barcode_length, barcode_offset=0,
+                     write_buffer_size=512 * 2**20):
+    """
+    extract_barcodes.py -c barcode_single_end (reverse_fp is None) or -c barcode_paired_end:
+    the first barcode_length bases of each read are moved to barcodes.fastq. With
+    barcode_offset the barcode starts that many bases into the read and the bases before
+    it are dropped.
+    """
+    log = logging.getLogger(name=__name__)
+    if reverse_fp is None:
+        read_fp_list = [forward_fp]
+        output_fp_list = [os.path.join(output_dir, 'reads.fastq')]
+    else:
+        read_fp_list = [forward_fp, reverse_fp]
+        output_fp_list = [os.path.join(output_dir, 'reads1.fastq'), os.path.join(output_dir, 'reads2.fastq')]
+    barcodes_fp = os.path.join(output_dir, 'barcodes.fastq')
+    barcode_end = barcode_offset + barcode_length
+    count = 0
+    with BufferedSampleWriter(memory_budget=write_buffer_size) as writer:
+        for records in SynchronizedReader(read_fp_list):
+            barcode = ''.join(seq[barcode_offset:barcode_end] for _, seq, _, _ in records)
+            barcode_qual = ''.join(qual[barcode_offset:barcode_end] for _, _, _, qual in records)
+            writer.write(barcodes_fp, '{}\n{}\n+\n{}\n'.format(records[0][0], barcode, barcode_qual))
+            for (header, seq, plus, qual), output_fp in zip(records, output_fp_list):
+                writer.write(output_fp, '{}\n{}\n+\n{}\n'.format(header, seq[barcode_end:], qual[barcode_end:]))
+            count += 1
+    writer.log_counters(log)
+    log.info('extracted %d barcodes from "%s"', count, forward_fp)
+    return count
+
+
+def write_split_library_log(log_fp, mapping_file, read_fp_list, barcodes_fp_list, counts, sample_counts, lengths):
+    with open(log_fp, 'wt') as log_file:
+        log_file.write('Input file paths\n')
+        log_file.write('Mapping filepath: {}\n'.format(mapping_file))
+        log_file.write('Sequence read filepath: {}\n'.format(', '.join(read_fp_list)))
+        log_file.write('Barcode read filepath: {}\n'.format(', '.join(barcodes_fp_list)))
+        log_file.write('\nQuality filter results\n')
+        log_file.write('Total number of input sequences: {}\n'.format(counts['input']))
+        log_file.write('Barcode not in mapping file: {}\n'.format(counts['unassigned']))
+        if 'index_hopped' in counts:
+            log_file.write('Index pair not in mapping file: {}\n'.format(counts['index_hopped']))
+        log_file.write('Read too short after quality truncation: 0\n')
+        log_file.write('Count of N characters exceeds limit: {}\n'.format(counts['filtered']))
+        log_file.write('Illumina quality digit = 0: 0\n')
+        log_file.write('Barcode errors exceed max: 0\n')
+        log_file.write('\nResult summary (after quality filtering)\n')
+        log_file.write('Median sequence length: {:.2f}\n'.format(statistics.median(lengths) if lengths else 0))
+        for sample_id, sample_count in sorted(sample_counts.items(), key=lambda c: -c[1]):
+            log_file.write('{}\t{}\n'.format(sample_id, sample_count))
+        log_file.write('\nTotal number seqs written\t{}\n'.format(sum(sample_counts.values())))
+
+
+def split_libraries(read_fp_list, barcodes_fp_list, output_dir, mapping_file, barcode_length,
+                    max_barcode_errors=0, barcode_offset=0, rev_comp_barcode=True, sequence_max_n=0,
+                    write_buffer_size=512 * 2**20, index2_fp_list=None, index2_length=None, rev_comp_index2=False,
+                    index_caches=None):
+    """
+    split_libraries_fastq.py -q 0 --store_demultiplexed_fastq: label every read with its sample
+    and write seqs.fastq and split_library_log.txt. Reads are numbered across all read files
+    in the order given, as QIIME does.
+
+    With index2_fp_list the barcode files hold i7 and index2_fp_list the i5 reads of a dual
+    indexed run. Reads with a known i7 and a known i5 that are not a pair in the mapping file
+    are counted as index hopping in index_hopping.txt and left unassigned.
+
+    index_caches maps barcode or i5 file paths to an IndexCache of the already decoded
+    barcodes, which is used instead of reading that file.
+    """
+    log = logging.getLogger(name=__name__)
+    counts = {'input': 0, 'unassigned': 0, 'filtered': 0}
+    index_caches = index_caches or {}
+    matcher = BarcodeMatcher(
+        mapping_file, max_barcode_errors, rev_comp_barcode=rev_comp_barcode,
+        dual_index=index2_fp_list is not None, rev_comp_index2=rev_comp_index2)
+    if index2_fp_list is None:
+        index2_fp_list = [None] * len(read_fp_list)
+    index2_length = index2_length or barcode_length
+    sample_counts = {}
+    lengths = []
+    seq_number = 0
+    seqs_fp = os.path.join(output_dir, 'seqs.fastq')
+    with BufferedSampleWriter(memory_budget=write_buffer_size) as writer:
+        writer.write(seqs_fp, '')
+        for read_fp, barcodes_fp, index2_fp in zip(read_fp_list, barcodes_fp_list, index2_fp_list):
+            log.info('splitting "%s" with "%s"', read_fp, ', '.join(fp for fp in (barcodes_fp, index2_fp) if fp))
+            barcodes_cache = index_caches.get(barcodes_fp)
+            index2_cache = index_caches.get(index2_fp)
+            fastq_fp_list = [read_fp]
+            if barcodes_cache is None:
+                fastq_fp_list.append(barcodes_fp)
+            if index2_fp is not None and index2_cache is None:
+                fastq_fp_list.append(index2_fp)
+            file_read_count = 0
+            for records in SynchronizedReader(fastq_fp_list):
+                header, seq, _, qual = records[0]
+                counts['input'] += 1
+                if counts['input'] & 0xffff == 0:
+                    report_reads(counts['input'])
+                record_number = file_read_count
+                file_read_count += 1
+                if barcodes_cache is None:
+                    barcode = records[1][1][barcode_offset:barcode_offset + barcode_length]
+                else:
+                    # past the end of the cache check_read_id raises before get_barcode would
+                    if record_number % index_cache_check_every == 0 or record_number >= barcodes_cache.record_count:
+                        barcodes_cache.check_read_id(record_number, header)
+                    barcode = barcodes_cache.get_barcode(record_number)
+                index2 = None
+                if index2_cache is not None:
+                    if record_number % index_cache_check_every == 0 or record_number >= index2_cache.record_count:
+                        index2_cache.check_read_id(record_number, header)
+                    index2 = index2_cache.get_barcode(record_number)
+                elif index2_fp is not None:
+                    index2 = records[-1][1][:index2_length]
+                match = matcher.match(barcode, index2)
+                if match is None:
+                    counts['unassigned'] += 1
+                    continue
+                if seq.upper().count('N') > sequence_max_n:
+                    counts['filtered'] += 1
+                    continue
+                sample_id, barcode, new_barcode, bc_diffs = match
+                writer.write(seqs_fp, '@{}_{} {} orig_bc={} new_bc={} bc_diffs={}\n{}\n+\n{}\n'.format(
+                    sample_id, seq_number, header[1:], barcode, new_barcode, bc_diffs, seq, qual))
+                seq_number += 1
+                sample_counts[sample_id] = sample_counts.get(sample_id, 0) + 1
+                lengths.append(len(seq))
+            for cache in (barcodes_cache, index2_cache):
+                if cache is not None and file_read_count != cache.record_count:
+                    raise PipelineException('"{}" has {} reads but the index cache "{}" has {} records'.format(
+                        read_fp, file_read_count, cache.cache_fp, cache.record_count))
+    writer.log_counters(log)
+    if matcher.dual_index:
+        # index hopping is reported apart from unknown barcodes
+        counts['index_hopped'] = matcher.get_index_hopped_count()
+        counts['unassigned'] -= counts['index_hopped']
+    write_split_library_log(
+        os.path.join(output_dir, 'split_library_log.txt'),
+        mapping_file, read_fp_list, barcodes_fp_list, counts, sample_counts, lengths)
+    if matcher.dual_index:
+        write_index_hopping_report(
+            os.path.join(output_dir, 'index_hopping.txt'), matcher.pair_table, matcher.hopped_counts, seq_number)
+        log.info('%d reads with an index pair that is not in the mapping file', counts['index_hopped'])
+    log.info('%d of %d reads assigned to %d samples', seq_number, counts['input'], len(sample_counts))
+    return counts, sample_counts
+
+
+def get_sample_id(seqs_header):
+    # '@S1_42 M001:... 1:N:0:1 orig_bc=...' -> 'S1'
+    return seqs_header.split(None, 1)[0][1:].rsplit('_', 1)[0]
+
+
+def split_sequence_file_on_sample_ids(seqs_fp, output_dir, dereplicate_minuniquesize=0,
+                                      dereplicate_memory_budget=2**28, write_buffer_size=512 * 2**20, index_every=0):
+    """
+    split_sequence_file_on_sample_ids.py --file_type fastq: one SAMPLE_ID.fastq per sample.
+    With dereplicate_minuniquesize each sample is also dereplicated as it is written, to
+    SAMPLE_ID.derepminN.fasta, with dereplicate_memory_budget shared by all samples.
+    """
+    log = logging.getLogger(name=__name__)
+    sample_fps = {}
+    sample_counts = {}
+    dereplicators = SampleDereplicators(memory_budget=dereplicate_memory_budget, spill_dir=output_dir)
+    with BufferedSampleWriter(memory_budget=write_buffer_size, index_every=index_every) as writer, \
+            open(seqs_fp, 'rt') as seqs_file:
+        for header, seq, plus, qual in iter_fastq_records(seqs_file):
+            sample_id = get_sample_id(header)
+            if sample_id not in sample_fps:
+                sample_fps[sample_id] = os.path.join(output_dir, sample_id + '.fastq')
+                sample_counts[sample_id] = 0
+            writer.write(sample_fps[sample_id], '{}\n{}\n+\n{}\n'.format(header, seq, qual))
+            sample_counts[sample_id] += 1
+            if dereplicate_minuniquesize > 0:
+                dereplicators.add(sample_id, seq)
+    writer.log_counters(log)
+    if dereplicators.budget_spill_count > 0:
+        log.info('dereplication spilled to disk %d times to stay within %.0f MB',
+                 dereplicators.budget_spill_count, dereplicate_memory_budget / 2**20)
+    for sample_id, dereplicator in dereplicators.items():
+        dereplicator.write_fasta(
+            os.path.join(output_dir, '{}.derepmin{}.fasta'.format(sample_id, dereplicate_minuniquesize)),
+            minuniquesize=dereplicate_minuniquesize)
+    return sample_counts
+
+
+def get_sample_file_names(sample_ids, index_every=0, dereplicate_minuniquesize=0):
+    """Names of the files split_sequence_file_on_sample_ids writes for these samples."""
+    file_names = []
+    for sample_id in sample_ids:
+        file_names.append(sample_id + '.fastq')
+        if index_every > 0:
+            file_names.append(get_index_fp(sample_id + '.fastq'))
+        if dereplicate_minuniquesize > 0:
+            file_names.append('{}.derepmin{}.fasta'.format(sample_id, dereplicate_minuniquesize))
+    return file_names
+
+
+def demultiplex_to_samples(read_fp_list, output_dir, file_name, mapping_file, barcode_length, index_fp=None,
+                           index2_fp=None, max_barcode_errors=0, barcode_offset=0, rev_comp_barcode=True,
+                           sequence_max_n=0, write_buffer_size=512 * 2**20, index_every=0, index2_length=None,
+                           rev_comp_index2=False):
+    """
+    Steps 01 to 04 in one pass for the pipeline's lean mode: writes the per-sample files the
+    last step would write, with the same names and records, and the split library log, but
+    none of barcodes.fastq, seqs.fastq or the combined paired end sample files in between.
+    Without index_fp the barcode is cut from the start of the forward reads.
+    """
+    log = logging.getLogger(name=__name__)
+    matcher = BarcodeMatcher(
+        mapping_file, max_barcode_errors, rev_comp_barcode=rev_comp_barcode,
+        dual_index=index2_fp is not None, rev_comp_index2=rev_comp_index2)
+    paired = len(read_fp_list) == 2
+    trim = 0 if index_fp is not None else barcode_offset + barcode_length
+    index2_length = index2_length or barcode_length
+    counts = {'input': 0, 'unassigned': 0, 'filtered': 0}
+    sample_counts = {}
+    lengths = []
+    seq_number = 0
+    sample_fps = {}
+    fastq_fp_list = list(read_fp_list) + [fp for fp in (index_fp, index2_fp) if fp is not None]
+    with BufferedSampleWriter(memory_budget=write_buffer_size, index_every=index_every) as writer:
+        for records in SynchronizedReader(fastq_fp_list):
+            counts['input'] += len(read_fp_list)
+            if counts['input'] & 0xffff == 0:
+                report_reads(counts['input'])
+            barcode_seq = records[len(read_fp_list)][1] if index_fp is not None else records[0][1]
+            index2 = records[-1][1][:index2_length] if index2_fp is not None else None
+            match = matcher.match(barcode_seq[barcode_offset:barcode_offset + barcode_length], index2)
+            if match is None:
+                counts['unassigned'] += len(read_fp_list)
+                continue
+            sample_id, barcode, new_barcode, bc_diffs = match
+            if sample_id not in sample_fps:
+                if paired:
+                    sample_fps[sample_id] = [
+                        os.path.join(output_dir, '{}_{}_R{}.fastq'.format(file_name, sample_id, n)) for n in (1, 2)]
+                else:
+                    sample_fps[sample_id] = [os.path.join(output_dir, '{}_{}.fastq'.format(file_name, sample_id))]
+            for (header, seq, _, qual), sample_fp in zip(records, sample_fps[sample_id]):
+                seq = seq[trim:]
+                if seq.upper().count('N') > sequence_max_n:
+                    counts['filtered'] += 1
+                    continue
+                # step 04 drops the read number from the sample label of paired end reads
+                label = sample_id if paired else '{}_{}'.format(sample_id, seq_number)
+                writer.write(sample_fp, '@{} {} orig_bc={} new_bc={} bc_diffs={}\n{}\n+\n{}\n'.format(
+                    label, header[1:], barcode, new_barcode, bc_diffs, seq, qual[trim:]))
+                seq_number += 1
+                sample_counts[sample_id] = sample_counts.get(sample_id, 0) + 1
+                lengths.append(len(seq))
+    writer.log_counters(log)
+    if matcher.dual_index:
+        # counted per read file, as split_libraries does
+        hopped_counts = {pair: count * len(read_fp_list) for pair, count in matcher.hopped_counts.items()}
+        counts['index_hopped'] = sum(hopped_counts.values())
+        counts['unassigned'] -= counts['index_hopped']
+        write_index_hopping_report(
+            os.path.join(output_dir, file_name + '_index_hopping.txt'), matcher.pair_table, hopped_counts, seq_number)
+    write_split_library_log(
+        os.path.join(output_dir, file_name + '_split_library_log.txt'),
+        mapping_file, read_fp_list, [index_fp or read_fp_list[0]], counts, sample_counts, lengths)
+    log.info('%d of %d reads written to %d samples', seq_number, counts['input'], len(sample_counts))
+    return counts, sample_counts
@@ -0,0 +1,239 @@
+"""
+Native full-length dereplication (what vsearch -derep_fulllength -sizeout -minuniquesize does).
+
+Sequences made only of A, C, G and T are stored as 2-bit packed integers; anything else is
+stored as bytes. When the counts outgrow the memory budget they are spilled to partition
+files on disk; when the output is written each partition is sorted on its own and the sorted
+partitions are merged as they are read.
+"""
+import argparse
+import heapq
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+from pipeline_util import *
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-i', '--input-file', required=True,
+                            help='FASTQ or FASTA file, optionally gzipped')
+    arg_parser.add_argument('-o', '--output-file', required=True,
+                            help='size annotated FASTA output sorted by decreasing abundance')
+    arg_parser.add_argument('--minuniquesize', default=1, type=int)
+    arg_parser.add_argument('--memory-mb', default=1024, type=int,
+                            help='spill counts to disk above this many megabytes')
+    arg_parser.add_argument('--relabel', default='Uniq')
+    args = arg_parser.parse_args()
+
+    dereplicate_file(
+        args.input_file, args.output_file,
+        minuniquesize=args.minuniquesize,
+        memory_budget=args.memory_mb * 2**20,
+        relabel=args.relabel)
+
+
+_pack_table = str.maketrans('ACGT', '0123')
+_unpack_table = {'00': 'A', '01': 'C', '10': 'G', '11': 'T'}
+_acgt = frozenset('ACGT')
+
+
+def pack_sequence(seq):
+    # a leading '1' keeps leading A's (zeros) so the length is part of the packed value
+    seq = seq.upper()
+    if _acgt.issuperset(seq):
+        return int('1' + seq.translate(_pack_table), 4)
+    else:
+        return seq.encode('ascii')
+
+
+def unpack_sequence(key):
+    if isinstance(key, bytes):
+        return key.decode('ascii')
+    bits = bin(key)[3:]
+    return ''.join(_unpack_table[bits[i:i + 2]] for i in range(0, len(bits), 2))
+
+
+def get_key_size(key):
+    # bytes held by one entry: the key object plus a dict slot and the count
+    return sys.getsizeof(key) + 64
+
+
+class Dereplicator:
+    def __init__(self, memory_budget=2**30, spill_dir=None, partition_count=16):
+        """memory_budget: None when the dereplicator is spilled by its owner, as SampleDereplicators does"""
+        self.counts = {}
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self.spill_dir = spill_dir
+        self.partition_count = partition_count
+        self.partition_fps = []
+        self.spill_count = 0
+        self.sequence_count = 0
+
+    def add(self, seq, count=1):
+        key = pack_sequence(seq)
+        if key in self.counts:
+            self.counts[key] += count
+        else:
+            self.counts[key] = count
+            self.memory_used += get_key_size(key)
+            if self.memory_budget is not None and self.memory_used > self.memory_budget:
+                self.spill()
+        self.sequence_count += count
+
+    def spill(self):
+        log = logging.getLogger(name=__name__)
+        if len(self.partition_fps) == 0:
+            self.spill_dir = tempfile.mkdtemp(prefix='derep_', dir=self.spill_dir)
+            self.partition_fps = [
+                os.path.join(self.spill_dir, 'partition_{}.txt'.format(n))
+                for n
+                in range(self.partition_count)
+            ]
+        log.debug('spilling %d unique sequences to "%s"', len(self.counts), self.spill_dir)
+        partition_files = [open(fp, 'at') for fp in self.partition_fps]
+        for key, count in self.counts.items():
+            if isinstance(key, bytes):
+                partition = hash(key) % self.partition_count
+                partition_files[partition].write('b{}\t{}\n'.format(key.decode('ascii'), count))
+            else:
+                partition = key % self.partition_count
+                partition_files[partition].write('{:x}\t{}\n'.format(key, count))
+        for partition_file in partition_files:
+            partition_file.close()
+        self.counts = {}
+        self.memory_used = 0
+        self.spill_count += 1
+
+    def sort_partitions(self, minuniquesize=1):
+        """Sort each spilled partition on its own into a file of count<TAB>sequence lines."""
+        self.spill()
+        sorted_fps = []
+        for partition_fp in self.partition_fps:
+            counts = {}
+            with open(partition_fp, 'rt') as partition_file:
+                for line in partition_file:
+                    key, count = line.rstrip('\n').split('\t')
+                    key = key[1:].encode('ascii') if key.startswith('b') else int(key, 16)
+                    counts[key] = counts.get(key, 0) + int(count)
+            uniques = sorted(
+                ((unpack_sequence(key), count) for key, count in counts.items() if count >= minuniquesize),
+                key=abundance_order)
+            sorted_fp = partition_fp.replace('partition_', 'sorted_')
+            with open(sorted_fp, 'wt') as sorted_file:
+                for seq, count in uniques:
+                    sorted_file.write('{}\t{}\n'.format(count, seq))
+            os.remove(partition_fp)
+            sorted_fps.append(sorted_fp)
+        self.partition_fps = []
+        return sorted_fps
+
+    def get_sorted_uniques(self, minuniquesize=1):
+        # (sequence, count) by decreasing abundance, ties broken by sequence; spilled counts
+        # are merged from the sorted partitions so only one partition is ever held in memory
+        if len(self.partition_fps) == 0:
+            yield from sorted(
+                ((unpack_sequence(key), count) for key, count in self.counts.items() if count >= minuniquesize),
+                key=abundance_order)
+            return
+        spill_dir = self.spill_dir
+        sorted_files = [open(fp, 'rt') for fp in self.sort_partitions(minuniquesize)]
+        try:
+            yield from heapq.merge(*[iter_sorted_partition(f) for f in sorted_files], key=abundance_order)
+        finally:
+            for sorted_file in sorted_files:
+                sorted_file.close()
+            shutil.rmtree(spill_dir)
+
+    def write_fasta(self, output_fp, minuniquesize=1, relabel='Uniq'):
+        unique_count = 0
+        with open(output_fp, 'wt') as output_file:
+            for unique_count, (seq, count) in enumerate(self.get_sorted_uniques(minuniquesize), start=1):
+                output_file.write('>{}{};size={};\n{}\n'.format(relabel, unique_count, count, seq))
+        return unique_count
+
+
+def abundance_order(unique):
+    seq, count = unique
+    return -count, seq
+
+
+def iter_sorted_partition(sorted_file):
+    for line in sorted_file:
+        count, seq = line.rstrip('\n').split('\t')
+        yield seq, int(count)
+
+
+class SampleDereplicators:
+    """
+    One Dereplicator per sample, all within one memory budget. When their counts outgrow it
+    the largest are spilled first until half of the budget is free again, so a mapping file
+    with many samples uses no more memory than one with a few.
+    """
+    def __init__(self, memory_budget=2**28, spill_dir=None):
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.dereplicators = {}
+        self.memory_used = 0
+        self.budget_spill_count = 0
+
+    def add(self, sample_id, seq):
+        dereplicator = self.dereplicators.get(sample_id)
+        if dereplicator is None:
+            dereplicator = self.dereplicators[sample_id] = Dereplicator(memory_budget=None, spill_dir=self.spill_dir)
+        memory_used = dereplicator.memory_used
+        dereplicator.add(seq)
+        self.memory_used += dereplicator.memory_used - memory_used
+        if self.memory_used > self.memory_budget:
+            self.spill_largest()
+
+    def spill_largest(self):
+        self.budget_spill_count += 1
+        for dereplicator in sorted(self.dereplicators.values(), key=lambda d: d.memory_used, reverse=True):
+            if self.memory_used <= self.memory_budget // 2:
+                break
+            self.memory_used -= dereplicator.memory_used
+            dereplicator.spill()
+
+    def items(self):
+        return self.dereplicators.items()
+
+
+def iter_sequences(input_fp):
+    with open_fastq(input_fp) as input_file:
+        first_line = input_file.readline()
+        input_file.seek(0)
+        if first_line.startswith('>'):
+            seq = []
+            for line in input_file:
+                if line.startswith('>'):
+                    if seq:
+                        yield ''.join(seq)
+                    seq = []
+                else:
+                    seq.append(line.strip())
+            if seq:
+                yield ''.join(seq)
+        else:
+            for _, seq, _, _ in iter_fastq_records(input_file):
+                yield seq
+
+
+def dereplicate_file(input_fp, output_fp, minuniquesize=1, memory_budget=2**30, relabel='Uniq'):
+    log = logging.getLogger(name=__name__)
+    dereplicator = Dereplicator(memory_budget=memory_budget, spill_dir=os.path.dirname(os.path.abspath(output_fp)))
+    for seq in iter_sequences(input_fp):
+        dereplicator.add(seq)
+    unique_count = dereplicator.write_fasta(output_fp, minuniquesize=minuniquesize, relabel=relabel)
+    log.info('%d sequences, %d unique with size >= %d written to "%s"',
+             dereplicator.sequence_count, unique_count, minuniquesize, output_fp)
+    return unique_count
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Detect how barcodes sit in the reads from a few thousand records: forward or reverse
+complement orientation, and at which offset. Every candidate window of every sampled read is
+looked up in the set of mapping file barcodes, and the layout with the most matches wins.
+
+    python detect_barcodes.py -i READS_OR_INDEX.fastq -m MAPPING_FILE -b BARCODE_LENGTH
+"""
+import argparse
+import itertools
+import logging
+
+from pipeline_util import *
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-i', '--input-file', required=True,
+                            help='index reads (-d mode) or reads that start with their barcode')
+    arg_parser.add_argument('-m', '--mapping-file', required=True)
+    arg_parser.add_argument('-b', '--barcode-length', required=True, type=int)
+    arg_parser.add_argument('--sample-size', default=5000, type=int)
+    arg_parser.add_argument('--max-offset', default=None, type=int)
+    args = arg_parser.parse_args()
+
+    layout = detect_barcode_layout(
+        args.input_file, args.mapping_file, args.barcode_length,
+        sample_size=args.sample_size, max_offset=args.max_offset)
+    for (rev_comp_barcode, offset), rate in sorted(layout['match_rates'].items(), key=lambda c: -c[1])[:10]:
+        print('{:<18} offset {:>3}: {:.1%}'.format(
+            'reverse complement' if rev_comp_barcode else 'forward', offset, rate))
+    print('best: {} at offset {} ({:.1%} of {} reads)'.format(
+        'reverse complement' if layout['rev_comp_barcode'] else 'forward',
+        layout['barcode_offset'], layout['match_rate'], layout['sampled_reads']))
+
+
+def detect_barcode_layout(barcode_fp, mapping_file, barcode_length, sample_size=5000, max_offset=None):
+    """
+    Returns {'rev_comp_barcode', 'barcode_offset', 'match_rate', 'sampled_reads', 'match_rates'}
+    where match_rates maps every (rev_comp_barcode, offset) tried to its match rate.
+    """
+    barcodes = frozenset(get_mapping_barcodes(mapping_file))
+    with open_fastq(barcode_fp) as barcode_file:
+        seqs = [seq.upper() for _, seq, _, _ in itertools.islice(iter_fastq_records(barcode_file), sample_size)]
+    if len(seqs) == 0:
+        raise PipelineException('no reads in "{}" to detect barcodes from'.format(barcode_fp))
+
+    forward_counts = {}
+    rev_comp_counts = {}
+    for seq in seqs:
+        last_offset = len(seq) - barcode_length
+        if max_offset is not None:
+            last_offset = min(last_offset, max_offset)
+        rc_seq = reverse_complement(seq)
+        # the reverse complement of the window at offset o is the window at len - o - length of rc_seq
+        rc_end = len(seq) - barcode_length
+        for offset in range(last_offset + 1):
+            if seq[offset:offset + barcode_length] in barcodes:
+                forward_counts[offset] = forward_counts.get(offset, 0) + 1
+            rc_start = rc_end - offset
+            if rc_seq[rc_start:rc_start + barcode_length] in barcodes:
+                rev_comp_counts[offset] = rev_comp_counts.get(offset, 0) + 1
+
+    match_rates = {}
+    for offset, count in forward_counts.items():
+        match_rates[(False, offset)] = count / len(seqs)
+    for offset, count in rev_comp_counts.items():
+        match_rates[(True, offset)] = count / len(seqs)
+    if len(match_rates) == 0:
+        raise PipelineException('no mapping file barcode found in the first {} reads of "{}"'.format(len(seqs), barcode_fp))
+    # prefer the current defaults (reverse complement at offset 0) on ties
+    (rev_comp_barcode, offset), rate = max(
+        match_rates.items(),
+        key=lambda c: (c[1], c[0][0], -c[0][1]))
+    return {
+        'rev_comp_barcode': rev_comp_barcode,
+        'barcode_offset': offset,
+        'match_rate': rate,
+        'sampled_reads': len(seqs),
+        'match_rates': match_rates,
+    }
+
+
+if __name__ == '__main__':
+    main()
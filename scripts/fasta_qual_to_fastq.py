@@ -1,5 +1,6 @@
 import argparse
 import itertools
+import os
 
 
 def grouper(iterable, n, fillvalue=None):
@@ -14,10 +15,20 @@ def main():
     arg_parser.add_argument('--fasta')
     arg_parser.add_argument('--qual')
     arg_parser.add_argument('--fastq')
+    arg_parser.add_argument('--profile', action='store_true', default=False,
+                            help='write a sampling profile next to the FASTQ file')
 
     args = arg_parser.parse_args()
 
-    fasta_qual_to_fastq(**args.__dict__)
+    if args.profile:
+        from profiler import SamplingProfiler
+        with SamplingProfiler() as profiler:
+            fasta_qual_to_fastq(args.fasta, args.qual, args.fastq)
+        profiler.write(
+            os.path.dirname(os.path.abspath(args.fastq)),
+            prefix=os.path.splitext(os.path.basename(args.fastq))[0] + '_profile')
+    else:
+        fasta_qual_to_fastq(args.fasta, args.qual, args.fastq)
 
 
 def fasta_qual_to_fastq(fasta, qual, fastq):
@@ -0,0 +1,148 @@
+"""
+Decoded index file cache for -d mode. Every pipeline started on a run reads the same index
+FASTQ, so instead of decompressing and parsing it once per input file the barcodes are
+decoded once into WORK_DIR/index_cache/INDEX_NAME.PATH_HASH.OFFSET_LENGTH.bcx and memory-mapped
+by every worker after that. PATH_HASH tells apart index files with the same name in different
+run directories.
+
+The cache holds one 2-bit packed barcode code (0 for barcodes with an N) and one CRC32 of the
+read ID per record, in record order, so reads are matched to their barcode by record number
+and the read IDs can still be checked.
+
+    python index_cache.py INDEX_FILE -b BARCODE_LENGTH -w WORK_DIR
+"""
+import argparse
+import array
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+from pipeline_util import *
+from dereplicate import pack_sequence, unpack_sequence
+
+
+cache_dir_name = 'index_cache'
+cache_magic = b'BCX1'
+# magic, barcode offset, barcode length, record count, index file size, index file mtime in ns
+cache_header = struct.Struct('<4sIIQQQ')
+max_cached_barcode_length = 31  # the packed code with its leading 1 has to fit 64 bits
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('index_file')
+    arg_parser.add_argument('-b', '--barcode-length', required=True, type=int)
+    arg_parser.add_argument('-w', '--work-dir', required=True)
+    arg_parser.add_argument('--barcode-offset', default=0, type=int)
+    args = arg_parser.parse_args()
+
+    cache = get_index_cache(args.index_file, args.work_dir, args.barcode_length, args.barcode_offset)
+    print('{}\t{} records'.format(cache.cache_fp, cache.record_count))
+
+
+def get_cache_fp(index_fp, work_dir, barcode_length, barcode_offset=0):
+    # the name is only there to be read, the hash of the full path tells the caches apart
+    name = os.path.basename(index_fp)
+    path_hash = hashlib.sha256(os.path.realpath(index_fp).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(
+        work_dir, cache_dir_name, '{}.{}.{}_{}.bcx'.format(name, path_hash, barcode_offset, barcode_length))
+
+
+def get_source_stamp(index_fp):
+    stat = os.stat(index_fp)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def build_index_cache(index_fp, cache_fp, barcode_length, barcode_offset=0):
+    log = logging.getLogger(name=__name__)
+    if barcode_length > max_cached_barcode_length:
+        raise PipelineException('barcodes longer than {} bases cannot be cached'.format(max_cached_barcode_length))
+    log.info('decoding "%s" into "%s"', index_fp, cache_fp)
+    size, mtime = get_source_stamp(index_fp)
+    codes = array.array('Q')
+    read_id_crcs = array.array('I')
+    barcode_end = barcode_offset + barcode_length
+    with open_fastq(index_fp) as index_file:
+        for header, seq, _, _ in iter_fastq_records(index_file):
+            code = pack_sequence(seq[barcode_offset:barcode_end])
+            codes.append(code if isinstance(code, int) else 0)
+            read_id_crcs.append(zlib.crc32(get_read_id(header).encode('ascii')))
+    tmp_fp = '{}.{}.tmp'.format(cache_fp, os.getpid())
+    with open(tmp_fp, 'wb') as cache_file:
+        cache_file.write(cache_header.pack(cache_magic, barcode_offset, barcode_length, len(codes), size, mtime))
+        codes.tofile(cache_file)
+        read_id_crcs.tofile(cache_file)
+    os.replace(tmp_fp, cache_fp)
+    return len(codes)
+
+
+def get_index_cache(index_fp, work_dir, barcode_length, barcode_offset=0):
+    """
+    Open the cache for index_fp, building it first if it is missing or older than the index
+    file. Workers started at the same time wait on a lock so the index is decoded only once.
+    """
+    cache_fp = get_cache_fp(index_fp, work_dir, barcode_length, barcode_offset)
+    os.makedirs(os.path.dirname(cache_fp), exist_ok=True)
+    with open(cache_fp + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            cache = IndexCache(cache_fp)
+            if cache.source_stamp != get_source_stamp(index_fp):
+                cache.close()
+                cache = None
+        except (OSError, PipelineException):
+            cache = None
+        if cache is None:
+            build_index_cache(index_fp, cache_fp, barcode_length, barcode_offset)
+            cache = IndexCache(cache_fp)
+    return cache
+
+
+class IndexCache:
+    def __init__(self, cache_fp):
+        self.cache_fp = cache_fp
+        with open(cache_fp, 'rb') as cache_file:
+            self.mmap = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.barcode_offset, self.barcode_length, self.record_count, size, mtime = \
+            cache_header.unpack_from(self.mmap)
+        if magic != cache_magic or len(self.mmap) != cache_header.size + 12 * self.record_count:
+            self.close()
+            raise PipelineException('"{}" is not a complete index cache'.format(cache_fp))
+        self.source_stamp = (size, mtime)
+        codes_end = cache_header.size + 8 * self.record_count
+        self.codes = memoryview(self.mmap)[cache_header.size:codes_end].cast('Q')
+        self.read_id_crcs = memoryview(self.mmap)[codes_end:].cast('I')
+        self.barcodes = {0: 'N' * self.barcode_length}
+
+    def get_barcode(self, record_number):
+        # few distinct codes per run, so decoded barcodes are kept
+        code = self.codes[record_number]
+        barcode = self.barcodes.get(code)
+        if barcode is None:
+            barcode = self.barcodes[code] = unpack_sequence(code)
+        return barcode
+
+    def check_read_id(self, record_number, header):
+        if record_number >= self.record_count:
+            raise PipelineException('read "{}" is past the {} records of the index cache "{}"'.format(
+                header, self.record_count, self.cache_fp))
+        if zlib.crc32(get_read_id(header).encode('ascii')) != self.read_id_crcs[record_number]:
+            raise PipelineException('read "{}" does not match record {} of the index cache "{}"'.format(
+                header, record_number, self.cache_fp))
+
+    def close(self):
+        if self.mmap is not None:
+            for view in ('codes', 'read_id_crcs'):
+                if hasattr(self, view):
+                    getattr(self, view).release()
+            self.mmap.close()
+            self.mmap = None
+
+
+if __name__ == '__main__':
+    main()
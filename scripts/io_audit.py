@@ -0,0 +1,102 @@
+"""
+I/O audit of the pipeline steps: the bytes each step wrote and read, per artifact, including
+artifacts a step removed before it finished. The audit for each input file is kept in
+WORK_DIR/io_audit/INPUT_NAME.json and the total written is compared with the size of the
+final per-sample outputs.
+
+    python io_audit.py WORK_DIR
+"""
+import argparse
+import json
+import os
+import sys
+
+
+audit_dir_name = 'io_audit'
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('work_dir')
+    args = arg_parser.parse_args()
+
+    audit_dir = os.path.join(args.work_dir, audit_dir_name)
+    for audit_file_name in sorted(os.listdir(audit_dir)):
+        audit = IOAudit.load(os.path.join(audit_dir, audit_file_name))
+        print(audit.input_name)
+        for line in audit.format_report():
+            print('  ' + line)
+    return 0
+
+
+class IOAudit:
+    def __init__(self, work_dir, input_name):
+        self.input_name = input_name
+        self.audit_fp = os.path.join(work_dir, audit_dir_name, input_name + '.json')
+        self.steps = {}
+        if os.path.exists(self.audit_fp):
+            with open(self.audit_fp, 'rt') as audit_file:
+                self.steps = json.load(audit_file)
+
+    @classmethod
+    def load(cls, audit_fp):
+        work_dir = os.path.dirname(os.path.dirname(audit_fp))
+        input_name = os.path.splitext(os.path.basename(audit_fp))[0]
+        return cls(work_dir, input_name)
+
+    def record(self, step_name, output_fp_list, read_fp_list, removed=None, final=False):
+        """
+        output_fp_list: the files the step wrote and kept
+        read_fp_list: files the step read, once per time it read them
+        removed: {artifact: bytes} for files the step wrote and removed again
+        """
+        written = {
+            os.path.basename(output_fp): os.path.getsize(output_fp)
+            for output_fp
+            in output_fp_list
+        }
+        written.update(removed or {})
+        read = {}
+        for read_fp in read_fp_list:
+            read[read_fp] = read.get(read_fp, 0) + os.path.getsize(read_fp)
+        self.steps[step_name] = {
+            'written': written,
+            'read': read,
+            'removed': sorted(removed or {}),
+            'final': final,
+        }
+        self.save()
+
+    def save(self):
+        audit_dir = os.path.dirname(self.audit_fp)
+        if not os.path.isdir(audit_dir):
+            os.makedirs(audit_dir, exist_ok=True)
+        tmp_fp = self.audit_fp + '.tmp'
+        with open(tmp_fp, 'wt') as audit_file:
+            json.dump(self.steps, audit_file, indent=2, sort_keys=True)
+        os.replace(tmp_fp, self.audit_fp)
+
+    def get_totals(self):
+        written = sum(sum(step['written'].values()) for step in self.steps.values())
+        read = sum(sum(step['read'].values()) for step in self.steps.values())
+        final = sum(sum(step['written'].values()) for step in self.steps.values() if step['final'])
+        return written, read, final
+
+    def format_report(self):
+        lines = []
+        for step_name in sorted(self.steps):
+            step = self.steps[step_name]
+            lines.append('{}: wrote {:.1f} MB in {} files, read {:.1f} MB{}'.format(
+                step_name, sum(step['written'].values()) / 2**20, len(step['written']),
+                sum(step['read'].values()) / 2**20,
+                ', removed {}'.format(', '.join(step['removed'])) if step['removed'] else ''))
+            for artifact, size in sorted(step['written'].items(), key=lambda a: -a[1])[:5]:
+                lines.append('    {:>10.1f} MB  {}'.format(size / 2**20, artifact))
+        written, read, final = self.get_totals()
+        lines.append('total: wrote {:.1f} MB, read {:.1f} MB, final outputs {:.1f} MB ({:.2f}x written per final byte)'.format(
+            written / 2**20, read / 2**20, final / 2**20, written / final if final else 0))
+        return lines
+
+
+if __name__ == '__main__':
+    sys.exit(main())
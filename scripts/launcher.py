@@ -0,0 +1,462 @@
+"""
+Run the pipeline across nodes as independent tasks. prepare turns the input files into tasks:
+a file larger than --shard-mb is split into record-aligned shards (with its paired and index
+reads), each run as its own task, and smaller files are one task each. Every task has its own
+work directory, so the tasks share nothing while they run, and collect merges the final
+per-sample files, read ledgers, I/O audits and command metrics of each input into WORK_DIR as
+if the input had been run whole.
+
+    python launcher.py prepare -i INPUT_DIR -w WORK_DIR [--shard-mb 4096] -- -m MAPPING -b 12 ...
+    sbatch WORK_DIR/launcher/array.sbatch     (a SLURM job array, one array task per task)
+    python launcher.py collect WORK_DIR
+
+WORK_DIR/launcher/tasks.txt has one command line per task for TACC's LAUNCHER instead of a
+job array. The local command runs prepare, every task and collect on this machine with a pool
+of worker processes standing in for SLURM:
+
+    python launcher.py local -i INPUT_DIR -w WORK_DIR [--workers 4] -- -m MAPPING -b 12 ...
+"""
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+
+from pipeline_util import *
+from append_runs import append_fastq
+from io_audit import IOAudit
+from ledger import ReadLedger, reconcile
+from output_registry import OutputRegistry
+from plan import get_available_cores, get_input_fp_list, get_stream_fp_list
+from read_store import write_read_stores
+from record_index import get_index_fp
+from readahead import SynchronizedReader
+from scheduler import get_input_bytes
+import pipeline
+
+
+launcher_dir_name = 'launcher'
+tasks_file_name = 'tasks.json'
+sbatch_template = """#!/bin/bash
+
+#SBATCH -J demux
+#SBATCH -N 1
+#SBATCH -n 1
+#SBATCH -p {partition}
+#SBATCH -t {time}
+{account}#SBATCH --array=0-{last_task_id}
+#SBATCH -o {log_dir}/array_%a.out
+
+{task_command} $SLURM_ARRAY_TASK_ID
+"""
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser()
+    subparsers = arg_parser.add_subparsers(dest='command')
+    prepare_parser = subparsers.add_parser('prepare')
+    add_prepare_arguments(prepare_parser)
+    local_parser = subparsers.add_parser('local')
+    add_prepare_arguments(local_parser)
+    local_parser.add_argument('--workers', default=0, type=int,
+                              help='tasks at a time (default: the cores on the machine)')
+    run_task_parser = subparsers.add_parser('run-task')
+    run_task_parser.add_argument('work_dir')
+    run_task_parser.add_argument('task_id', type=int)
+    collect_parser = subparsers.add_parser('collect')
+    collect_parser.add_argument('work_dir')
+    collect_parser.add_argument('--keep-task-dirs', action='store_true', default=False,
+                                help='keep the shards, task work directories and task list after collecting')
+    args = arg_parser.parse_args()
+
+    if args.command in ('prepare', 'local'):
+        pipeline_args = args.pipeline_args[1:] if args.pipeline_args[:1] == ['--'] else args.pipeline_args
+        tasks = prepare(
+            args.input_dir, args.work_dir, pipeline_args, paired_ends=args.paired_ends, index_file=args.index_file,
+            index2_file=args.index2_file, shard_bytes=int(args.shard_mb * 2**20), task_prefix=args.task_prefix,
+            partition=args.partition, time_limit=args.time, account=args.account)
+        if args.command == 'prepare':
+            launcher_dir = os.path.join(args.work_dir, launcher_dir_name)
+            print('{} tasks, submit them with one of'.format(len(tasks['tasks'])))
+            print('  sbatch {}'.format(os.path.join(launcher_dir, 'array.sbatch')))
+            print('  LAUNCHER_JOB_FILE={} $TACC_LAUNCHER_DIR/paramrun'.format(os.path.join(launcher_dir, 'tasks.txt')))
+            print('then merge their outputs with')
+            print('  python {} collect {}'.format(os.path.abspath(__file__), args.work_dir))
+            return 0
+        failed = run_local(args.work_dir, workers=args.workers or get_available_cores())
+        if len(failed) > 0:
+            return 1
+        collect(args.work_dir)
+        return 0
+    elif args.command == 'run-task':
+        return run_task(args.work_dir, args.task_id)
+    elif args.command == 'collect':
+        collect(args.work_dir, keep_task_dirs=args.keep_task_dirs)
+        return 0
+    else:
+        arg_parser.print_help()
+        return 1
+
+
+def add_prepare_arguments(arg_parser):
+    arg_parser.add_argument('-i', '--input-dir', required=True,
+                            help='directory of input files (or a single file)')
+    arg_parser.add_argument('-w', '--work-dir', required=True)
+    arg_parser.add_argument('-p', '--paired-ends', default='')
+    arg_parser.add_argument('-d', '--index-file', default='')
+    arg_parser.add_argument('--index2-file', default='')
+    arg_parser.add_argument('--shard-mb', default=4096, type=float,
+                            help='split input files larger than this (all of their reads, uncompressed) into shards '
+                                 'of about this size, 0 to never split')
+    arg_parser.add_argument('--task-prefix', default='',
+                            help='command the task command lines start with, e.g. "singularity exec IMAGE"')
+    arg_parser.add_argument('--partition', default='normal')
+    arg_parser.add_argument('--time', default='24:00:00')
+    arg_parser.add_argument('--account', default='')
+    arg_parser.add_argument('pipeline_args', nargs=argparse.REMAINDER)
+
+
+def get_input_name(input_fp):
+    # the name Pipeline gives the step directories, ledger and audit of an input file
+    return os.path.basename(os.path.splitext(input_fp)[0])
+
+
+def get_launcher_dir(work_dir):
+    return os.path.join(work_dir, launcher_dir_name)
+
+
+def load_tasks(work_dir):
+    with open(os.path.join(get_launcher_dir(work_dir), tasks_file_name), 'rt') as tasks_file:
+        return json.load(tasks_file)
+
+
+def get_task_command(task_prefix, work_dir, task_id=None):
+    command = shlex.split(task_prefix) + [sys.executable, os.path.abspath(__file__), 'run-task', work_dir]
+    if task_id is not None:
+        command.append(str(task_id))
+    return ' '.join(shlex.quote(word) for word in command)
+
+
+def write_shards(stream_fp_list, shard_parent_dir, shard_count):
+    """
+    Split the aligned records of the streams into shard_count shards of about the same size,
+    returns a list of shard stream lists. Shards keep the names of the streams (without .gz).
+    """
+    shard_bytes = get_input_bytes(stream_fp_list) / shard_count
+    shard_fp_lists = []
+    shard_files = []
+    written = 0
+    try:
+        for records in SynchronizedReader(stream_fp_list):
+            if written >= shard_bytes * len(shard_fp_lists) and len(shard_fp_lists) < shard_count:
+                for shard_file in shard_files:
+                    shard_file.close()
+                shard_dir = os.path.join(shard_parent_dir, '{:03d}'.format(len(shard_fp_lists)))
+                os.makedirs(shard_dir)
+                shard_fp_lists.append([
+                    os.path.join(shard_dir, re.sub(r'\.gz$', '', os.path.basename(stream_fp)))
+                    for stream_fp
+                    in stream_fp_list
+                ])
+                shard_files = [open(shard_fp, 'wt') for shard_fp in shard_fp_lists[-1]]
+            for shard_file, record in zip(shard_files, records):
+                text = '{}\n{}\n{}\n{}\n'.format(*record)
+                shard_file.write(text)
+                written += len(text)
+    finally:
+        for shard_file in shard_files:
+            shard_file.close()
+    return shard_fp_lists
+
+
+def prepare(input_dir, work_dir, pipeline_args, paired_ends='', index_file='', index2_file='', shard_bytes=0,
+            task_prefix='', partition='normal', time_limit='24:00:00', account=''):
+    log = logging.getLogger(name=__name__)
+    # tasks run from wherever the array task or LAUNCHER starts them
+    work_dir, paired_ends, index_file, index2_file = [
+        os.path.abspath(path) if path != '' else ''
+        for path
+        in (work_dir, paired_ends, index_file, index2_file)
+    ]
+    launcher_dir = get_launcher_dir(work_dir)
+    tasks_fp = os.path.join(launcher_dir, tasks_file_name)
+    if os.path.exists(tasks_fp):
+        raise PipelineException('"{}" already has tasks, collect them or remove "{}"'.format(work_dir, launcher_dir))
+    input_fp_list = [os.path.abspath(input_fp) for input_fp in get_input_fp_list(input_dir)]
+    if len(input_fp_list) == 0:
+        raise PipelineException('there are no files to process in "{}"'.format(input_dir))
+    args = pipeline.get_args(['-i', input_fp_list[0], '-w', work_dir] + list(pipeline_args))
+    if args.append is True:
+        raise PipelineException('tasks cannot --append, run pipeline.py --append on the collected outputs')
+    if args.dereplicate_minuniquesize > 0 and shard_bytes > 0:
+        # per-shard dereplication would not add up to the dereplication of the whole file
+        log.warning('--dereplicate-minuniquesize is given, input files will not be split')
+        shard_bytes = 0
+    shard_dir = os.path.join(launcher_dir, 'shards')
+    shutil.rmtree(shard_dir, ignore_errors=True)
+
+    tasks = []
+    for input_fp in input_fp_list:
+        stream_fp_list = get_stream_fp_list(input_fp, paired_ends, index_file)
+        if index2_file != '':
+            stream_fp_list.append(index2_file)
+        input_bytes = get_input_bytes(stream_fp_list)
+        shard_count = 1 if shard_bytes <= 0 else max(1, int(math.ceil(input_bytes / shard_bytes)))
+        if shard_count == 1:
+            shard_fp_lists = [stream_fp_list]
+        else:
+            log.info('splitting "%s" (%.1f MB) into %d shards', input_fp, input_bytes / 2**20, shard_count)
+            shard_fp_lists = write_shards(stream_fp_list, os.path.join(shard_dir, get_input_name(input_fp)), shard_count)
+        for shard, shard_fp_list in enumerate(shard_fp_lists):
+            task_id = len(tasks)
+            task_work_dir = os.path.join(launcher_dir, 'work', '{:04d}'.format(task_id))
+            argv = ['-i', shard_fp_list[0], '-w', task_work_dir]
+            remaining = shard_fp_list[1:]
+            for option, path in (('-p', paired_ends), ('-d', index_file), ('--index2-file', index2_file)):
+                if path != '':
+                    argv.extend([option, remaining.pop(0)])
+            # read stores are written from the merged FASTQ files by collect
+            argv.extend(list(pipeline_args) + ['--output-format', 'fastq'])
+            tasks.append({
+                'task_id': task_id,
+                'input_fp': input_fp,
+                'shard': shard,
+                'shard_count': len(shard_fp_lists),
+                'task_input_fp': shard_fp_list[0],
+                'work_dir': task_work_dir,
+                'argv': argv,
+            })
+
+    os.makedirs(os.path.join(launcher_dir, 'logs'), exist_ok=True)
+    with open(os.path.join(launcher_dir, 'tasks.txt'), 'wt') as launcher_file:
+        for task in tasks:
+            launcher_file.write(get_task_command(task_prefix, work_dir, task['task_id']) + '\n')
+    with open(os.path.join(launcher_dir, 'array.sbatch'), 'wt') as sbatch_file:
+        sbatch_file.write(sbatch_template.format(
+            partition=partition,
+            time=time_limit,
+            account='#SBATCH -A {}\n'.format(account) if account != '' else '',
+            last_task_id=len(tasks) - 1,
+            log_dir=os.path.abspath(os.path.join(launcher_dir, 'logs')),
+            task_command=get_task_command(task_prefix, work_dir)))
+    prepared = {
+        'final_step': 'step_04_make_paired_end_files' if paired_ends != '' else 'step_03_demultiplex',
+        'index_every': args.index_every,
+        'output_format': args.output_format,
+        'read_store_encoding': args.read_store_encoding,
+        'tasks': tasks,
+    }
+    tmp_fp = tasks_fp + '.tmp'
+    with open(tmp_fp, 'wt') as tasks_file:
+        json.dump(prepared, tasks_file, indent=2)
+    os.replace(tmp_fp, tasks_fp)
+    log.info('prepared %d tasks for %d input files in "%s"', len(tasks), len(input_fp_list), launcher_dir)
+    return prepared
+
+
+def get_done_fp(work_dir, task_id):
+    return os.path.join(get_launcher_dir(work_dir), 'done', '{:04d}.json'.format(task_id))
+
+
+def run_task(work_dir, task_id):
+    """Run one task and mark it done when the pipeline exits with 0, returns the exit code."""
+    log = logging.getLogger(name=__name__)
+    task = load_tasks(work_dir)['tasks'][task_id]
+    if os.path.exists(get_done_fp(work_dir, task_id)):
+        log.info('task %d is done already', task_id)
+        return 0
+    os.makedirs(task['work_dir'], exist_ok=True)
+    log_fp = os.path.join(get_launcher_dir(work_dir), 'logs', '{:04d}.log'.format(task_id))
+    with open(log_fp, 'a') as log_file:
+        start = time.time()
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline.py')] + task['argv'],
+            stdout=log_file,
+            stderr=subprocess.STDOUT)
+        metrics = wait_and_measure(process, start=start, sample_tree=True)
+    metrics['peak_rss_kb'] = max(metrics['max_rss_kb'], metrics['sampled_tree_max_rss_kb'])
+    if metrics['exit_code'] != 0:
+        log.error('task %d failed with exit code %d, see "%s"', task_id, metrics['exit_code'], log_fp)
+        return metrics['exit_code']
+    done_fp = get_done_fp(work_dir, task_id)
+    os.makedirs(os.path.dirname(done_fp), exist_ok=True)
+    with open(done_fp, 'wt') as done_file:
+        json.dump(metrics, done_file, indent=2, sort_keys=True)
+    log.info('task %d finished in %.0f s, peak RSS %.2f GB', task_id, metrics['seconds'], metrics['peak_rss_kb'] / 2**20)
+    return 0
+
+
+def run_task_in_worker(work_dir_and_task_id):
+    work_dir, task_id = work_dir_and_task_id
+    return task_id, run_task(work_dir, task_id)
+
+
+def run_local(work_dir, workers=1):
+    """Run the tasks in worker processes on this machine, as the array tasks would run on nodes, returns the failed ids."""
+    log = logging.getLogger(name=__name__)
+    task_ids = [task['task_id'] for task in load_tasks(work_dir)['tasks']]
+    failed = []
+    with multiprocessing.get_context('fork').Pool(min(workers, len(task_ids))) as pool:
+        for task_id, exit_code in pool.imap_unordered(run_task_in_worker, [(work_dir, i) for i in task_ids]):
+            if exit_code != 0:
+                failed.append(task_id)
+    if len(failed) > 0:
+        log.error('%d of %d tasks failed: %s', len(failed), len(task_ids), ', '.join(str(i) for i in sorted(failed)))
+    return failed
+
+
+# peaks, ratios and exit codes of command metrics, the shards' values are not added up
+peak_metric_names = frozenset((
+    'max_rss_kb', 'sampled_max_rss_kb', 'sampled_tree_max_rss_kb', 'peak_rss_kb', 'cpu_utilization', 'exit_code'))
+
+
+def merge_counts(total, part):
+    # sums the numbers of nested count dictionaries such as ledgers, audits and metrics
+    for key, value in part.items():
+        if isinstance(value, dict):
+            merge_counts(total.setdefault(key, {}), value)
+        elif isinstance(value, list):
+            total.setdefault(key, []).extend(value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            if key in peak_metric_names:
+                # by magnitude, so a command killed by a signal (negative exit code) is kept
+                total[key] = max(total.get(key, 0), value, key=abs)
+            else:
+                total[key] = total.get(key, 0) + value
+        else:
+            total.setdefault(key, value)
+    return total
+
+
+def get_assigned_read_count(task):
+    """Reads split_libraries wrote for a task, the seq_number its labels continue from in the next shard."""
+    steps = ReadLedger(task['work_dir'], get_input_name(task['task_input_fp'])).steps
+    if 'step_02_split_libraries' not in steps:
+        raise PipelineException('task {} has no split_libraries counts in its read ledger'.format(task['task_id']))
+    return sum(steps['step_02_split_libraries']['assigned'].values())
+
+
+def renumber_fastq(input_fp, output_fp, seq_offset):
+    """Copy the records of input_fp to output_fp with seq_offset added to the N of their SAMPLE_N labels."""
+    with open(input_fp, 'rt') as input_file, open(output_fp, 'wt') as output_file:
+        for header, seq, plus, qual in iter_fastq_records(input_file):
+            label, rest = header.split(' ', 1)
+            sample_id, seq_number = label.rsplit('_', 1)
+            output_file.write('{}_{} {}\n{}\n{}\n{}\n'.format(
+                sample_id, int(seq_number) + seq_offset, rest, seq, plus, qual))
+
+
+def collect_final_dir(tasks, final_step, output_dir, index_every):
+    """
+    Move (one task) or append in shard order (several) the final files of the tasks to output_dir.
+    Every shard numbers its SAMPLE_N read labels from 0, so single-end labels are renumbered to
+    continue from the shards before them; step 04 drops the numbers from paired-end labels.
+    """
+    task_final_dirs = [
+        os.path.join(task['work_dir'], final_step, get_input_name(task['task_input_fp']))
+        for task
+        in tasks
+    ]
+    os.makedirs(os.path.dirname(output_dir), exist_ok=True)
+    if len(tasks) == 1:
+        os.rename(task_final_dirs[0], output_dir)
+        return
+    tmp_dir = output_dir + '.collecting'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    registry = OutputRegistry(tmp_dir)
+    renumber = final_step == 'step_03_demultiplex'
+    seq_offset = 0
+    for task, task_final_dir in zip(tasks, task_final_dirs):
+        for fp in OutputRegistry.load(task_final_dir).get_paths():
+            name = os.path.basename(fp)
+            if name.endswith('.fastq'):
+                if renumber and seq_offset > 0:
+                    renumbered_fp = os.path.join(tmp_dir, name + '.renumbered')
+                    renumber_fastq(fp, renumbered_fp, seq_offset)
+                    append_fastq(renumbered_fp, os.path.join(tmp_dir, name), index_every=index_every)
+                    os.remove(renumbered_fp)
+                else:
+                    append_fastq(fp, os.path.join(tmp_dir, name), index_every=index_every)
+                if os.path.exists(get_index_fp(os.path.join(tmp_dir, name))):
+                    registry.add_files([os.path.basename(get_index_fp(name))])
+            elif name.endswith('.idx'):
+                # extended by append_fastq
+                continue
+            else:
+                # split library logs and the like, one per shard
+                name = 'shard{:03d}_{}'.format(task['shard'], name)
+                shutil.copyfile(fp, os.path.join(tmp_dir, name))
+            registry.add_files([name])
+        if renumber:
+            seq_offset += get_assigned_read_count(task)
+    registry.save()
+    os.rename(tmp_dir, output_dir)
+
+
+def collect(work_dir, keep_task_dirs=False):
+    """Merge the outputs of the finished tasks into WORK_DIR, input by input."""
+    log = logging.getLogger(name=__name__)
+    prepared = load_tasks(work_dir)
+    not_done = [task['task_id'] for task in prepared['tasks'] if not os.path.exists(get_done_fp(work_dir, task['task_id']))]
+    if len(not_done) > 0:
+        raise PipelineException('{} tasks have not finished: {}'.format(len(not_done), ', '.join(str(i) for i in not_done)))
+
+    tasks_by_input = {}
+    for task in prepared['tasks']:
+        tasks_by_input.setdefault(task['input_fp'], []).append(task)
+    for input_fp, tasks in tasks_by_input.items():
+        input_name = get_input_name(input_fp)
+        tasks = sorted(tasks, key=lambda t: t['shard'])
+        # the merged counts are written again from the task counts, so collect can be run again
+        ledger = ReadLedger(work_dir, input_name)
+        ledger.steps = {}
+        audit = IOAudit(work_dir, input_name)
+        audit.steps = {}
+        metrics = {}
+        for task in tasks:
+            task_input_name = get_input_name(task['task_input_fp'])
+            merge_counts(ledger.steps, ReadLedger(task['work_dir'], task_input_name).steps)
+            merge_counts(audit.steps, IOAudit(task['work_dir'], task_input_name).steps)
+            metrics_fp = os.path.join(task['work_dir'], 'metrics', task_input_name + '.json')
+            if os.path.exists(metrics_fp):
+                with open(metrics_fp, 'rt') as metrics_file:
+                    merge_counts(metrics, json.load(metrics_file))
+        if len(ledger.steps) > 0:
+            ledger.save()
+        if len(audit.steps) > 0:
+            audit.save()
+        if len(metrics) > 0:
+            metrics_fp = os.path.join(work_dir, 'metrics', input_name + '.json')
+            os.makedirs(os.path.dirname(metrics_fp), exist_ok=True)
+            with open(metrics_fp, 'wt') as metrics_file:
+                json.dump(metrics, metrics_file, indent=2, sort_keys=True)
+        for problem in reconcile(ledger.steps):
+            log.warning('read ledger of "%s": %s', input_name, problem)
+
+        output_dir = os.path.join(work_dir, prepared['final_step'], input_name)
+        if os.path.isdir(output_dir) and len(os.listdir(output_dir)) > 0:
+            log.info('"%s" is collected already', output_dir)
+        else:
+            collect_final_dir(tasks, prepared['final_step'], output_dir, prepared['index_every'])
+            log.info('collected %d tasks of "%s" in "%s"', len(tasks), input_fp, output_dir)
+        write_read_stores(output_dir, prepared['output_format'], encoding=prepared['read_store_encoding'])
+
+    if not keep_task_dirs:
+        # the logs stay, and prepare can be run again for new inputs
+        launcher_dir = get_launcher_dir(work_dir)
+        for dir_name in ('shards', 'work', 'done'):
+            shutil.rmtree(os.path.join(launcher_dir, dir_name), ignore_errors=True)
+        os.remove(os.path.join(launcher_dir, tasks_file_name))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+"""
+Read-conservation ledger. Each step records how many reads it took in and where they went
+(per sample, unassigned or filtered), from counts it already has during its normal pass.
+The ledger for each input file is kept in WORK_DIR/ledger/INPUT_NAME.json and reconcile()
+checks that reads in == assigned + unassigned + filtered within each step and that nothing
+was lost between steps.
+
+    python ledger.py WORK_DIR
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+
+
+ledger_dir_name = 'ledger'
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('work_dir')
+    args = arg_parser.parse_args()
+
+    ledger_dir = os.path.join(args.work_dir, ledger_dir_name)
+    problem_count = 0
+    for ledger_file_name in sorted(os.listdir(ledger_dir)):
+        ledger = ReadLedger.load(os.path.join(ledger_dir, ledger_file_name))
+        problems = reconcile(ledger.steps)
+        print('{}: {}'.format(ledger.input_name, 'OK' if len(problems) == 0 else '{} problems'.format(len(problems))))
+        for problem in problems:
+            print('  ' + problem)
+        problem_count += len(problems)
+    return 0 if problem_count == 0 else 1
+
+
+class ReadLedger:
+    def __init__(self, work_dir, input_name):
+        self.input_name = input_name
+        self.ledger_fp = os.path.join(work_dir, ledger_dir_name, input_name + '.json')
+        self.steps = {}
+        if os.path.exists(self.ledger_fp):
+            with open(self.ledger_fp, 'rt') as ledger_file:
+                self.steps = json.load(ledger_file)
+
+    @classmethod
+    def load(cls, ledger_fp):
+        work_dir = os.path.dirname(os.path.dirname(ledger_fp))
+        input_name = os.path.splitext(os.path.basename(ledger_fp))[0]
+        return cls(work_dir, input_name)
+
+    def record(self, step_name, reads_in, assigned, unassigned=0, filtered=None):
+        """
+        assigned: {sample or output: read count}
+        filtered: {reason: read count} for reads the step dropped on purpose
+        """
+        self.steps[step_name] = {
+            'in': reads_in,
+            'assigned': dict(assigned),
+            'unassigned': unassigned,
+            'filtered': dict(filtered or {}),
+        }
+        self.save()
+
+    def save(self):
+        ledger_dir = os.path.dirname(self.ledger_fp)
+        if not os.path.isdir(ledger_dir):
+            os.makedirs(ledger_dir, exist_ok=True)
+        tmp_fp = self.ledger_fp + '.tmp'
+        with open(tmp_fp, 'wt') as ledger_file:
+            json.dump(self.steps, ledger_file, indent=2, sort_keys=True)
+        os.replace(tmp_fp, self.ledger_fp)
+
+
+def get_assigned_total(step):
+    return sum(step['assigned'].values())
+
+
+def reconcile(steps):
+    """Return a list of problems, empty when every read is accounted for."""
+    problems = []
+    step_names = sorted(steps)
+    for step_name in step_names:
+        step = steps[step_name]
+        accounted = get_assigned_total(step) + step['unassigned'] + sum(step['filtered'].values())
+        if accounted != step['in']:
+            problems.append('{}: {} reads in but {} accounted for ({} lost)'.format(
+                step_name, step['in'], accounted, step['in'] - accounted))
+
+    for previous_name, next_name in zip(step_names, step_names[1:]):
+        previous_out = get_assigned_total(steps[previous_name])
+        if steps[next_name]['in'] != previous_out:
+            problems.append('{} -> {}: {} reads out but {} reads in ({} lost)'.format(
+                previous_name, next_name, previous_out, steps[next_name]['in'],
+                previous_out - steps[next_name]['in']))
+        # per-sample counts carry over when both steps are keyed by sample
+        previous_assigned = steps[previous_name]['assigned']
+        next_assigned = steps[next_name]['assigned']
+        for sample_id in sorted(set(previous_assigned) & set(next_assigned)):
+            if previous_assigned[sample_id] != next_assigned[sample_id]:
+                problems.append('{} -> {}: sample "{}" has {} reads then {}'.format(
+                    previous_name, next_name, sample_id, previous_assigned[sample_id], next_assigned[sample_id]))
+    return problems
+
+
+def parse_split_library_log(log_fp):
+    """
+    Counts from split_libraries_fastq.py's split_library_log.txt (written by both backends):
+    returns (reads in, {sample: reads}, unassigned, {filter: reads})
+    """
+    filter_names = (
+        'Read too short after quality truncation',
+        'Count of N characters exceeds limit',
+        'Illumina quality digit = 0',
+        'Barcode errors exceed max',
+    )
+    reads_in = 0
+    unassigned = 0
+    filtered = {}
+    assigned = {}
+    in_summary = False
+    with open(log_fp, 'rt') as log_file:
+        for line in log_file:
+            line = line.rstrip('\n')
+            match = re.match(r'^(.+): (\d+)$', line)
+            if line.startswith('Result summary'):
+                in_summary = True
+            elif line.startswith('Total number seqs written'):
+                in_summary = False
+            elif match and match.group(1) == 'Total number of input sequences':
+                reads_in = int(match.group(2))
+            elif match and match.group(1) in ('Barcode not in mapping file', 'Index pair not in mapping file'):
+                # dual index runs count index hopping apart from unknown barcodes
+                unassigned += int(match.group(2))
+            elif match and match.group(1) in filter_names:
+                filtered[match.group(1)] = int(match.group(2))
+            elif in_summary and '\t' in line:
+                sample_id, count = line.rsplit('\t', 1)
+                assigned[sample_id] = int(count)
+    return reads_in, assigned, unassigned, filtered
+
+
+if __name__ == '__main__':
+    sys.exit(main())
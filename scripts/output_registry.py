@@ -0,0 +1,93 @@
+"""
+The files a step wrote to its output directory. Steps register the files they create, rename
+only those, and save the list to OUTPUT_DIR/.outputs so the next step can read its input files
+from it instead of globbing the directory. On Lustre a glob of a directory with thousands of
+sample files is slow, and before the registry step 03 globbed and renamed the whole directory
+once for every seqs file.
+
+Output directories written before the registry existed are listed once when loaded.
+"""
+import fnmatch
+import os
+
+from pipeline_util import *
+
+
+manifest_name = '.outputs'
+
+
+def get_single_path(registry, pattern):
+    paths = registry.get_paths(pattern)
+    if len(paths) != 1:
+        raise PipelineException('found {} files matching "{}" in the outputs of "{}", expected 1'.format(
+            len(paths), pattern, registry.output_dir))
+    return paths[0]
+
+
+class OutputRegistry:
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.manifest_fp = os.path.join(output_dir, manifest_name)
+        self.names = []
+        self.name_set = set()
+
+    @classmethod
+    def load(cls, output_dir):
+        registry = cls(output_dir)
+        if os.path.exists(registry.manifest_fp):
+            with open(registry.manifest_fp, 'rt') as manifest_file:
+                registry.add_files(line.rstrip('\n') for line in manifest_file if line.strip() != '')
+        else:
+            registry.add_new_files()
+        return registry
+
+    def add_files(self, names):
+        """Register files the step wrote, returns the names that were not registered yet."""
+        added = []
+        for name in names:
+            if name not in self.name_set:
+                self.names.append(name)
+                self.name_set.add(name)
+                added.append(name)
+        return added
+
+    def add_new_files(self):
+        """Register whatever an external tool wrote, with a single listing of the directory."""
+        return self.add_files(sorted(
+            entry.name
+            for entry
+            in os.scandir(self.output_dir)
+            if entry.is_file() and entry.name != manifest_name and entry.name not in self.name_set))
+
+    def remove(self, name):
+        os.remove(os.path.join(self.output_dir, name))
+        self.names.remove(name)
+        self.name_set.discard(name)
+
+    def rename_with_prefix(self, file_name, names):
+        """Rename the given files as rename_files_in_dir does, returns the new names."""
+        renamed = {}
+        for name in names:
+            new_name = get_renamed_basename(name, file_name)
+            if new_name is None:
+                continue
+            os.rename(os.path.join(self.output_dir, name), os.path.join(self.output_dir, new_name))
+            renamed[name] = new_name
+        self.names = [renamed.get(name, name) for name in self.names]
+        self.name_set = set(self.names)
+        return [renamed[name] for name in names if name in renamed]
+
+    def get_paths(self, pattern='*'):
+        return [
+            os.path.join(self.output_dir, name)
+            for name
+            in sorted(self.names)
+            if fnmatch.fnmatchcase(name, pattern)
+        ]
+
+    def save(self):
+        tmp_fp = self.manifest_fp + '.tmp'
+        with open(tmp_fp, 'wt') as manifest_file:
+            for name in self.names:
+                manifest_file.write(name + '\n')
+        os.replace(tmp_fp, self.manifest_fp)
@@ -9,25 +9,49 @@ import argparse
 import glob
 import gzip
 import itertools
+import json
 import logging
 import os
 import re
 import shutil
 import sys
-import qiime
+import tempfile
 
 from pipeline_util import *
 from fasta_qual_to_fastq import fasta_qual_to_fastq
+from backends import get_backend
+from buffered_writer import BufferedSampleWriter
+from append_runs import SampleAppender
+from dereplicate import dereplicate_file
+from detect_barcodes import detect_barcode_layout
+from index_cache import get_index_cache
+from io_audit import IOAudit
+from ledger import ReadLedger, parse_split_library_log, reconcile
+from output_registry import OutputRegistry, get_single_path
+from profiler import SamplingProfiler
+from progress import ProgressReporter, report_reads
+from read_store import write_read_stores
+from record_index import build_index, get_index_fp
 
 
 def main():
     logging.basicConfig(level=logging.INFO)
     args = get_args()
 
-    Pipeline(**args.__dict__).run(input_file=args.input_file)
+    if args.plan:
+        from plan import make_plan, print_plan
+        print_plan(make_plan(**args.__dict__))
+        return 0
+
+    try:
+        Pipeline(**args.__dict__).run(input_file=args.input_file)
+    except CommandKilledException as e:
+        # scheduler.py runs a job again with more memory when it exits with killed_exit_code
+        logging.getLogger(name='run').error('%s', e)
+        return killed_exit_code
     return 0
 
-def get_args():
+def get_args(argv=None):
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('-i', '--input-file', required=True,
                             help='path to the input file')
@@ -46,8 +70,62 @@ def get_args():
 
     arg_parser.add_argument('-d', '--index-file', default='',
                             help='path to index file')
+    arg_parser.add_argument('--index2-file', default='',
+                            help='path to the i5 index file of a dual indexed run (with -d for the i7 index file, '
+                                 'native backend only)')
+    arg_parser.add_argument('--index2-length', default=None, type=int,
+                            help='length of the i5 indexes (default: --barcode-length)')
+    arg_parser.add_argument('--rev-comp-index2', action='store_true', default=False,
+                            help='reverse complement the i5 index reads before looking them up')
+    arg_parser.add_argument('--no-index-cache', dest='index_cache', action='store_false', default=True,
+                            help='with -d and the native backend, read the index files directly instead of '
+                                 'decoding them once into WORK_DIR/index_cache for every input file to share')
     arg_parser.add_argument('-e', '--max-barcode-errors', default=0,
                             help='--max_barcode_errors for qiime split_libraries_fastq')
+    arg_parser.add_argument('--backend', default='qiime', choices=('qiime', 'native'),
+                            help='run steps 01 to 03 with the QIIME scripts or with the native demultiplexer')
+    arg_parser.add_argument('--dereplicate-minuniquesize', default=0, type=int,
+                            help='with the native backend, also dereplicate each sample in step 03 and keep '
+                                 'unique sequences seen at least this many times')
+    arg_parser.add_argument('--write-buffer-mb', default=512, type=int,
+                            help='memory for buffering per-sample output before it is written')
+    arg_parser.add_argument('--index-every', default=1024, type=int,
+                            help='write a .idx record offset index next to every per-sample file, with the offset '
+                                 'of every N-th record (0 for no index)')
+    arg_parser.add_argument('--detect-barcodes', action='store_true', default=False,
+                            help='detect barcode orientation and offset from a sample of reads before '
+                                 'demultiplexing (a non-zero offset needs the native backend)')
+    arg_parser.add_argument('--scratch-dir', default='',
+                            help='stage intermediate step directories on fast local storage such as /tmp or '
+                                 '$SCRATCH and move only the final per-sample files to WORK_DIR')
+    arg_parser.add_argument('--resource-sample-interval', default=1.0, type=float,
+                            help='seconds between samples of the RSS and I/O of external commands from /proc')
+    arg_parser.add_argument('--profile', action='store_true', default=False,
+                            help='sample the Python stack of every step and write per-function, per-line and '
+                                 'collapsed-stack profiles to the step directory')
+    arg_parser.add_argument('--profile-interval', default=0.005, type=float,
+                            help='seconds between profile samples')
+    arg_parser.add_argument('--progress', action='store_true', default=False,
+                            help='also log the progress written to WORK_DIR/progress/INPUT.json')
+    arg_parser.add_argument('--progress-interval', default=10.0, type=float,
+                            help='seconds between progress updates')
+    arg_parser.add_argument('--append', action='store_true', default=False,
+                            help='skip the input if WORK_DIR already has it (by SHA-256 of the input files), otherwise '
+                                 'process it and append its per-sample reads to WORK_DIR/samples')
+    arg_parser.add_argument('--output-format', default='fastq', choices=('fastq', 'read-store', 'both'),
+                            help='write the final per-sample reads as FASTQ, as memory-mappable .rds read stores '
+                                 '(see read_store.py) or as both')
+    arg_parser.add_argument('--read-store-encoding', default='uint8', choices=('uint8', '2bit'),
+                            help='bases of the read stores as one byte each or packed 4 to a byte')
+    arg_parser.add_argument('--lean', action='store_true', default=False,
+                            help='with the native backend, demultiplex in one pass and write only the final '
+                                 'per-sample files (no barcodes, seqs or combined paired end files in between)')
+    arg_parser.add_argument('--plan', action='store_true', default=False,
+                            help='estimate runtime, disk usage and worker count from a sample of reads and exit')
+    arg_parser.add_argument('--plan-sample-size', default=2000, type=int,
+                            help='number of reads sampled by --plan')
+    arg_parser.add_argument('--plan-cores', default=0, type=int,
+                            help='cores available to --plan (default: detect)')
 
     '''
     arg_parser.add_argument('--uchime-ref-db-fp', default='/16SrDNA/pr2/pr2_gb203_version_4.5.fasta',
@@ -71,7 +149,7 @@ def get_args():
     arg_parser.add_argument('--vsearch-derep-minuniquesize', required=True, type=int,
                             help='minimum unique size for vsearch -derep_fulllength')
     '''
-    args = arg_parser.parse_args()
+    args = arg_parser.parse_args(argv)
     return args
 
 
@@ -84,6 +162,25 @@ class Pipeline:
             paired_ends,
             index_file,
             max_barcode_errors,
+            backend='qiime',
+            dereplicate_minuniquesize=0,
+            write_buffer_mb=512,
+            index_every=1024,
+            detect_barcodes=False,
+            index2_file='',
+            index2_length=None,
+            rev_comp_index2=False,
+            index_cache=True,
+            scratch_dir='',
+            lean=False,
+            resource_sample_interval=1.0,
+            append=False,
+            output_format='fastq',
+            read_store_encoding='uint8',
+            progress=False,
+            progress_interval=10.0,
+            profile=False,
+            profile_interval=0.005,
             **kwargs  # allows some command line arguments to be ignored
             ):
         
@@ -104,36 +201,225 @@ class Pipeline:
         self.index_file = False
         if self.index_file_path != '':
             self.index_file = True
-            
+        self.index2_file_path = index2_file
+        self.index2_length = index2_length or barcode_length
+        self.index_cache = index_cache
+        if self.index2_file_path != '' and self.index_file is False:
+            raise PipelineException('--index2-file needs the i7 index file given with -d')
+        self.dereplicate_minuniquesize = dereplicate_minuniquesize
+        self.write_buffer_size = write_buffer_mb * 2**20
+        self.index_every = index_every
+        self.detect_barcodes = detect_barcodes
+        self.scratch_dir = scratch_dir
+        self.stage_dir = None
+        self.lean = lean
+        self.append = append
+        self.output_format = output_format
+        self.read_store_encoding = read_store_encoding
+        if self.append is True and self.output_format == 'read-store':
+            raise PipelineException('--append adds FASTQ files to the project, use --output-format fastq or both')
+        if self.lean is True and backend != 'native':
+            raise PipelineException('--lean needs the native backend')
+        if self.lean is True and self.dereplicate_minuniquesize > 0:
+            raise PipelineException('--lean does not dereplicate samples, leave out --dereplicate-minuniquesize')
+        # split_libraries_fastq.py is run with --rev_comp_barcode unless detection finds otherwise
+        self.rev_comp_barcode = True
+        self.barcode_offset = 0
+        self.backend = get_backend(
+            backend,
+            mapping_file=self.mapping_file,
+            barcode_length=self.barcode_length,
+            max_barcode_errors=self.max_barcode_errors,
+            write_buffer_size=self.write_buffer_size,
+            index_every=self.index_every,
+            index2_length=index2_length,
+            rev_comp_index2=rev_comp_index2,
+            sample_interval=resource_sample_interval)
+        name, ext = os.path.splitext(self.input_file)
+        self.ledger = ReadLedger(self.work_dir, os.path.basename(name))
+        self.io_audit = IOAudit(self.work_dir, os.path.basename(name))
+        self.metrics_fp = os.path.join(self.work_dir, 'metrics', os.path.basename(name) + '.json')
+        self.progress = ProgressReporter(
+            self.work_dir, os.path.basename(name), interval=progress_interval, to_stderr=progress)
+        self.profile = profile
+        self.profile_interval = profile_interval
+        self.profiler = None
+        # the output directory of the step that is running, when it was empty at its start
+        self.running_step_dir = None
 
 
     def run(self, input_file):
-        output_dir_list = list()
-        if self.index_file is False:
-            output_dir_list.append(self.step_01_remove_barcodes(input_file=input_file))
-            output_dir_list.append(self.step_02_split_libraries(input_dir=output_dir_list[-1]))
-        else:
-            output_dir_list.append(self.step_02_split_libraries(input_file=input_file))
-        output_dir_list.append(self.step_03_demultiplex(input_dir=output_dir_list[-1]))
-        if self.paired_ends is True:
-            output_dir_list.append(self.step_04_make_paired_end_files(input_dir=output_dir_list[-1]))
+        try:
+            output_dir_list = self.run_steps(input_file)
+        except BaseException:
+            self.progress.close(state='failed')
+            if self.profiler is not None:
+                # a service worker runs the next job in this process, its sampler must not keep running
+                self.profiler.stop()
+                self.profiler = None
+            if self.running_step_dir is not None:
+                # partial outputs would make the next run skip the step
+                logging.getLogger(name='run').warning(
+                    'removing the outputs of the failed step in "%s"', self.running_step_dir)
+                shutil.rmtree(self.running_step_dir, ignore_errors=True)
+                self.running_step_dir = None
+            raise
+        self.progress.close()
+        return output_dir_list
 
+
+    def run_steps(self, input_file):
+        log = logging.getLogger(name='run')
+        output_dir_list = list()
+        if self.append is True:
+            appender = SampleAppender(self.work_dir)
+            input_hash, appended_run = appender.find_run(self.get_input_fp_list(input_file), os.path.basename(input_file))
+            if appended_run is not None:
+                log.info('"%s" was appended to "%s" on %s, nothing to do',
+                         input_file, appender.samples_dir, appended_run['appended_at'])
+                return [appender.samples_dir]
+        if self.detect_barcodes is True:
+            self.step_00_detect_barcodes(input_file=input_file)
+        if self.scratch_dir != '':
+            final_dir = self.get_final_dir()
+            if os.path.isdir(final_dir) and len(os.listdir(final_dir)) > 0:
+                log.info('final output directory "%s" is not empty, nothing to stage', final_dir)
+                self.write_read_stores(final_dir)
+                if self.append is True:
+                    appender.append_run(
+                        input_hash, os.path.basename(input_file), final_dir, self.get_final_file_name(input_file),
+                        index_every=self.index_every)
+                    return [final_dir, appender.samples_dir]
+                return [final_dir]
+            self.stage_dir = self.create_stage_dir(input_file)
+        try:
+            if self.lean is True:
+                output_dir_list.append(self.step_lean_demultiplex(input_file=input_file))
+            else:
+                if self.index_file is False:
+                    output_dir_list.append(self.step_01_remove_barcodes(input_file=input_file))
+                    output_dir_list.append(self.step_02_split_libraries(input_dir=output_dir_list[-1]))
+                    self.remove_staged_dir(output_dir_list[-2])
+                else:
+                    output_dir_list.append(self.step_02_split_libraries(input_file=input_file))
+                output_dir_list.append(self.step_03_demultiplex(input_dir=output_dir_list[-1]))
+                self.remove_staged_dir(output_dir_list[-2])
+                if self.paired_ends is True:
+                    output_dir_list.append(self.step_04_make_paired_end_files(input_dir=output_dir_list[-1]))
+                    self.remove_staged_dir(output_dir_list[-2])
+            if self.stage_dir is not None:
+                output_dir_list[-1] = self.unstage_final_dir(output_dir_list[-1])
+        finally:
+            if self.stage_dir is not None:
+                shutil.rmtree(self.stage_dir, ignore_errors=True)
+                self.stage_dir = None
+
+        self.write_read_stores(output_dir_list[-1])
+        if self.append is True:
+            appender.append_run(
+                input_hash, os.path.basename(input_file), output_dir_list[-1], self.get_final_file_name(input_file),
+                index_every=self.index_every)
+            output_dir_list.append(appender.samples_dir)
+        for problem in reconcile(self.ledger.steps):
+            log.warning('read ledger: %s', problem)
+        written, read, final = self.io_audit.get_totals()
+        log.info('I/O audit: wrote %.1f MB and read %.1f MB for %.1f MB of final outputs',
+                 written / 2**20, read / 2**20, final / 2**20)
         return output_dir_list
 
 
-    def initialize_step(self):
-        function_name = sys._getframe(1).f_code.co_name
+    def write_read_stores(self, final_dir):
+        # after staging, so the stores are written once, where they are kept
+        write_read_stores(final_dir, self.output_format, encoding=self.read_store_encoding)
+
+
+    def initialize_step(self, step_name=None):
+        function_name = step_name or sys._getframe(1).f_code.co_name
         log = logging.getLogger(name=function_name)
         log.setLevel(logging.INFO)
-        #Make step output_dir
-        output_dir = create_output_dir(output_dir_name=function_name, parent_dir=self.work_dir)
+        #Make step output_dir, on scratch for the demultiplexing steps when staging
+        parent_dir = self.work_dir
+        if self.stage_dir is not None and function_name != 'step_00_detect_barcodes':
+            parent_dir = self.stage_dir
+        output_dir = create_output_dir(output_dir_name=function_name, parent_dir=parent_dir)
         #Make specific file output_dir
         name, ext = os.path.splitext(self.input_file)
         fileout_dir = create_output_dir(output_dir_name=os.path.basename(name), parent_dir=output_dir)
+        self.progress.start_step(function_name)
+        self.running_step_dir = fileout_dir if len(os.listdir(fileout_dir)) == 0 else None
+        # steps that will be skipped keep the profile of the run that wrote them
+        if self.profile is True and self.running_step_dir is not None:
+            self.profiler = SamplingProfiler(interval=self.profile_interval).start()
         return log, fileout_dir
 
 
+    def get_final_step_name(self):
+        return 'step_04_make_paired_end_files' if self.paired_ends is True else 'step_03_demultiplex'
+
+
+    def get_final_dir(self):
+        name, ext = os.path.splitext(self.input_file)
+        return os.path.join(self.work_dir, self.get_final_step_name(), os.path.basename(name))
+
+
+    def get_staged_bytes_estimate(self, input_file):
+        # two step directories are on scratch at a time, each about the size of the uncompressed
+        # input (4x for .gz), plus seqs.fna next to seqs.fastq in step 02
+        input_fp_list = [input_file]
+        if self.paired_ends is True:
+            if self.paired_ends_dir is True:
+                input_fp_list.append(get_associated_reverse_fastq_fp(forward_fp=input_file, reverse_input_dir=self.paired_ends_path))
+            else:
+                input_fp_list.append(self.paired_ends_path)
+        uncompressed_bytes = sum(
+            os.path.getsize(fp) * (4 if fp.endswith('.gz') else 1)
+            for fp
+            in input_fp_list
+        )
+        return int(2.5 * uncompressed_bytes)
+
+
+    def create_stage_dir(self, input_file):
+        log = logging.getLogger(name='run')
+        needed = self.get_staged_bytes_estimate(input_file)
+        free = shutil.disk_usage(self.scratch_dir).free
+        if free < needed:
+            log.warning('only %.1f GB free in scratch directory "%s" but %.1f GB needed, staging in "%s" instead',
+                        free / 2**30, self.scratch_dir, needed / 2**30, self.work_dir)
+            return None
+        name, ext = os.path.splitext(os.path.basename(self.input_file))
+        stage_dir = tempfile.mkdtemp(prefix='{}_'.format(name), dir=self.scratch_dir)
+        log.info('staging intermediate steps in "%s" (%.1f GB needed, %.1f GB free)',
+                 stage_dir, needed / 2**30, free / 2**30)
+        return stage_dir
+
+
+    def remove_staged_dir(self, output_dir):
+        # an intermediate step directory on scratch is not needed once the next step is done
+        if self.stage_dir is not None and output_dir.startswith(self.stage_dir + os.sep):
+            shutil.rmtree(output_dir)
+
+
+    def unstage_final_dir(self, staged_dir):
+        log = logging.getLogger(name='run')
+        final_dir = self.get_final_dir()
+        os.makedirs(final_dir, exist_ok=True)
+        file_names = sorted(os.listdir(staged_dir))
+        log.info('moving %d files from "%s" to "%s"', len(file_names), staged_dir, final_dir)
+        for file_name in file_names:
+            move_file(os.path.join(staged_dir, file_name), os.path.join(final_dir, file_name))
+        return final_dir
+
+
     def complete_step(self, log, output_dir):
+        self.running_step_dir = None
+        self.record_command_metrics(log)
+        self.progress.finish_step()
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler.write(output_dir)
+            log.info('profile of %d samples written to "%s"', self.profiler.sample_count, output_dir)
+            self.profiler = None
         return
         """
         output_dir_list = sorted(os.listdir(output_dir))
@@ -199,6 +485,114 @@ class Pipeline:
                             )
         """
 
+    def record_command_metrics(self, log):
+        # CPU, memory and I/O of the external commands the step ran, in WORK_DIR/metrics/INPUT.json
+        metrics_list = pop_command_metrics()
+        if len(metrics_list) == 0:
+            return
+        for metrics in metrics_list:
+            log.info('resources: %s', format_command_metrics(metrics))
+        step_metrics = {}
+        if os.path.exists(self.metrics_fp):
+            with open(self.metrics_fp, 'rt') as metrics_file:
+                step_metrics = json.load(metrics_file)
+        step_metrics.setdefault(log.name, []).extend(metrics_list)
+        os.makedirs(os.path.dirname(self.metrics_fp), exist_ok=True)
+        tmp_fp = self.metrics_fp + '.tmp'
+        with open(tmp_fp, 'wt') as metrics_file:
+            json.dump(step_metrics, metrics_file, indent=2, sort_keys=True)
+        os.replace(tmp_fp, self.metrics_fp)
+
+
+    def step_00_detect_barcodes(self, input_file):
+        log, output_dir = self.initialize_step()
+        layout_fp = os.path.join(output_dir, 'barcode_layout.json')
+        if os.path.exists(layout_fp):
+            log.info('using barcode layout from "%s"', layout_fp)
+            with open(layout_fp, 'rt') as layout_file:
+                layout = json.load(layout_file)
+        else:
+            barcode_fp = self.index_file_path if self.index_file is True else input_file
+            log.info('Detecting barcode orientation and offset in "%s"', barcode_fp)
+            layout = detect_barcode_layout(barcode_fp, self.mapping_file, self.barcode_length)
+            del layout['match_rates']
+            with open(layout_fp, 'wt') as layout_file:
+                json.dump(layout, layout_file, indent=2)
+        log.info('barcodes are %s at offset %d in %.1f%% of %d reads',
+                 'reverse complemented' if layout['rev_comp_barcode'] else 'forward',
+                 layout['barcode_offset'], 100 * layout['match_rate'], layout['sampled_reads'])
+        self.rev_comp_barcode = layout['rev_comp_barcode']
+        self.barcode_offset = layout['barcode_offset']
+        self.complete_step(log, output_dir)
+        return output_dir
+
+
+    def get_reverse_fastq_fp(self, forward_fp):
+        if self.paired_ends_dir is True:
+            return get_associated_reverse_fastq_fp(forward_fp=forward_fp, reverse_input_dir=self.paired_ends_path)
+        else:
+            return self.paired_ends_path
+
+
+    def get_input_fp_list(self, input_file):
+        # the files that make up one input, for telling inputs apart by content
+        input_fp_list = [input_file]
+        if self.paired_ends is True:
+            input_fp_list.append(self.get_reverse_fastq_fp(input_file))
+        if self.index_file is True:
+            input_fp_list.append(self.index_file_path)
+        if self.index2_file_path != '':
+            input_fp_list.append(self.index2_file_path)
+        return input_fp_list
+
+
+    def get_final_file_name(self, input_file):
+        # the prefix steps 01 to 03 give the final per-sample files
+        input_basename = os.path.basename(input_file)
+        if self.paired_ends is True:
+            tmp = re.split('_([0R])1', input_basename)
+            if self.index_file is True:
+                return tmp[0]
+            return tmp[0] + re.split('.fastq', tmp[2])[0]
+        elif self.index_file is True:
+            return re.split('.fastq', input_basename)[0]
+        else:
+            return re.split('.fastq', input_basename)[0] + '_reads'
+
+
+    def step_lean_demultiplex(self, input_file):
+        # steps 01 to 04 in one pass, writing only what the last step would write
+        final_step_name = self.get_final_step_name()
+        log, output_dir = self.initialize_step(step_name=final_step_name)
+        if len(os.listdir(output_dir)) > 0:
+            log.info('output directory "%s" is not empty, this step will be skipped', output_dir)
+        else:
+            read_fp_list = [input_file]
+            if self.paired_ends is True:
+                read_fp_list.append(self.get_reverse_fastq_fp(input_file))
+            index_fp = self.index_file_path if self.index_file is True else None
+            index2_fp = self.index2_file_path if self.index2_file_path != '' else None
+            file_name = self.get_final_file_name(input_file)
+            log.info('Demultiplexing "%s" straight to per-sample files', '", "'.join(read_fp_list))
+            self.progress.set_inputs(read_fp_list)
+            self.backend.demultiplex_to_samples(
+                read_fp_list, output_dir, file_name,
+                index_fp=index_fp, index2_fp=index2_fp,
+                barcode_offset=self.barcode_offset, rev_comp_barcode=self.rev_comp_barcode)
+            registry = OutputRegistry(output_dir)
+            registry.add_new_files()
+            registry.save()
+            reads_in, assigned, unassigned, filtered = parse_split_library_log(
+                os.path.join(output_dir, file_name + '_split_library_log.txt'))
+            self.ledger.record('step_02_split_libraries', reads_in, assigned, unassigned, filtered)
+            self.ledger.record(final_step_name, sum(assigned.values()), assigned)
+            self.io_audit.record(
+                final_step_name, registry.get_paths(),
+                read_fp_list + [fp for fp in (index_fp, index2_fp) if fp is not None], final=True)
+        self.complete_step(log, output_dir)
+        return output_dir
+
+
     def step_01_remove_barcodes(self, input_file):
         log, output_dir = self.initialize_step()
         if len(os.listdir(output_dir)) > 0:
@@ -212,42 +606,34 @@ class Pipeline:
                     paired_end_file = self.paired_ends_path
                 log.info('removing barcodes from forward reads "%s"', input_file)
                 log.info('removing barcodes from reverse reads "%s"', paired_end_file)
-                run_cmd([
-                        #'python', '/miniconda/bin/extract_barcodes.py',
-                        'extract_barcodes.py',
-                        '-f', input_file,
-                        '-r', paired_end_file,
-                        '-c', 'barcode_paired_end',
-                        '-m', str(self.mapping_file),
-                        '-l', str(self.barcode_length),
-                        '-L', str(self.barcode_length),
-                        '-o', str(output_dir)
-                    ],
-                    log_file=os.path.join(output_dir, 'log')
-                )
+                self.progress.set_inputs([input_file, paired_end_file])
+                read_count = self.backend.extract_barcodes(
+                    input_file, paired_end_file, output_dir, barcode_offset=self.barcode_offset)
+                if read_count is not None:
+                    self.ledger.record('step_01_remove_barcodes', 2 * read_count, {'R1': read_count, 'R2': read_count})
                 forward_fastq_basename = os.path.basename(input_file)
                 tmp = re.split('_([0R])1', forward_fastq_basename)
                 file_name = tmp[0] + re.split('.fastq', tmp[2])[0]
-                rename_files_in_dir(output_dir, file_name)
+                registry = OutputRegistry(output_dir)
+                registry.rename_with_prefix(file_name, registry.add_new_files())
+                registry.save()
+                self.io_audit.record('step_01_remove_barcodes', registry.get_paths(), [input_file, paired_end_file])
                 #os.rename(os.path.join(output_dir, 'reads1.fastq'), os.path.join(output_dir, file_name + '_debarcoded_R1.fastq'))
                 #os.rename(os.path.join(output_dir, 'reads2.fastq'), os.path.join(output_dir, file_name + '_debarcoded_R2.fastq'))
                 #os.rename(os.path.join(output_dir, 'barcodes.fastq'), os.path.join(output_dir, file_name + '_barcodes.fastq'))
             else:
                 log.info('removing barcodes from "%s"', input_file)
-                run_cmd([
-                    #'python', '/miniconda/bin/extract_barcodes.py',
-                    'extract_barcodes.py',
-                    '-f', input_file,
-                    '-c', 'barcode_single_end',
-                    '-m', str(self.mapping_file),
-                    '-l', str(self.barcode_length),
-                    '-o', str(output_dir)
-                   ],
-                    log_file=os.path.join(output_dir, 'log')
-                )
+                self.progress.set_inputs([input_file])
+                read_count = self.backend.extract_barcodes(
+                    input_file, None, output_dir, barcode_offset=self.barcode_offset)
+                if read_count is not None:
+                    self.ledger.record('step_01_remove_barcodes', read_count, {'reads': read_count})
                 file_basename = os.path.basename(input_file)
                 file_name = re.split('.fastq', file_basename)[0]
-                rename_files_in_dir(output_dir, file_name)
+                registry = OutputRegistry(output_dir)
+                registry.rename_with_prefix(file_name, registry.add_new_files())
+                registry.save()
+                self.io_audit.record('step_01_remove_barcodes', registry.get_paths(), [input_file])
                 #os.rename(os.path.join(output_dir, 'reads.fastq'),
                 #          os.path.join(output_dir, file_name + '_debarcoded.fastq'))
                 #os.rename(os.path.join(output_dir, 'barcodes.fastq'),
@@ -262,9 +648,19 @@ class Pipeline:
             log.info('output directory "%s" is not empty, this step will be skipped', output_dir)
         else:
             log.info('Splitting library based on barcodes')
+            # step 01 already moved the barcode to the start of the barcode reads
+            barcode_offset = self.barcode_offset if input_file != '' else 0
+            index2_fp = self.index2_file_path if input_file != '' and self.index2_file_path != '' else None
+            index_caches = None
+            if input_file != '' and self.index_cache is True and self.backend.name == 'native':
+                # every input file of the run shares the decoded index files
+                index_caches = {self.index_file_path: get_index_cache(
+                    self.index_file_path, self.work_dir, self.barcode_length, barcode_offset)}
+                if index2_fp is not None:
+                    index_caches[index2_fp] = get_index_cache(index2_fp, self.work_dir, self.index2_length)
             if self.paired_ends is True:
                 #Check if index file is added (which skips step 01)
-                if input_file is not '':
+                if input_file != '':
                     forward_fastq_fp = input_file
                     barcodes_fp = self.index_file_path
                     if self.paired_ends_dir is True:
@@ -272,77 +668,65 @@ class Pipeline:
                     else:
                         reverse_fastq_fp = self.paired_ends_path
                 else:
-                    forward_fastq_fp = get_forward_fastq_file(input_dir=input_dir) 
+                    forward_fastq_fp = get_single_path(OutputRegistry.load(input_dir), '*_R1.fastq*')
                     barcodes_fp = get_associated_barcodes_fp(forward_fastq_fp)
                     reverse_fastq_fp = get_associated_reverse_fastq_fp(forward_fp=forward_fastq_fp, reverse_input_dir=input_dir)
                 log.info('Splitting libraries of "%s" and "%s" with "%s"', forward_fastq_fp, reverse_fastq_fp, barcodes_fp)
-                #TODO Make argument for -q and --max_barcode_errors and rev_comp (1-step vs 2-step PCR?)?
-                run_cmd([
-                        #'python', '/miniconda/bin/split_libraries_fastq.py',
-                        'split_libraries_fastq.py',
-                        '-o', str(output_dir),
-                        '-b', str(barcodes_fp) + ',' + str(barcodes_fp),
-                        '-i', str(forward_fastq_fp) + ',' + str(reverse_fastq_fp),
-                        '-m', str(self.mapping_file),
-                        '--barcode_type', str(self.barcode_length),
-                        '-q', '0',
-                        '--max_barcode_errors', str(self.max_barcode_errors),
-                        '--rev_comp_barcode',
-                        '--phred_offset=33',
-                        '--store_demultiplexed_fastq'
-                    ],
-                    log_file=os.path.join(output_dir, 'log')
-                ) 
+                self.progress.set_inputs([forward_fastq_fp, reverse_fastq_fp])
+                self.backend.split_libraries(
+                    [forward_fastq_fp, reverse_fastq_fp], [barcodes_fp, barcodes_fp], output_dir,
+                    barcode_offset=barcode_offset, rev_comp_barcode=self.rev_comp_barcode,
+                    index2_fp_list=None if index2_fp is None else [index2_fp, index2_fp],
+                    index_caches=index_caches)
+                read_fp_list = [forward_fastq_fp, reverse_fastq_fp, barcodes_fp, barcodes_fp]
                 forward_fastq_basename = os.path.basename(forward_fastq_fp)
                 file_name = re.split('_([0R])1', forward_fastq_basename)[0]
-                os.remove(os.path.join(output_dir, 'seqs.fna'))
-                rename_files_in_dir(output_dir, file_name)
-                    #os.rename(os.path.join(output_dir, 'seqs.fastq'),
-                    #          os.path.join(output_dir, file_name + '_seqs.fastq'))
-                    #os.rename(os.path.join(output_dir, 'histograms.txt'),
-                    #          os.path.join(output_dir, file_name + '_histograms.txt'))
-                    #os.rename(os.path.join(output_dir, 'split_library_log.txt'),
-                    #          os.path.join(output_dir, file_name + '_split_library_log.txt'))
-                    #os.remove(os.path.join(output_dir, 'seqs.fna'))
             else:
-                if input_file is not '':
+                if input_file != '':
                     in_file = input_file
                     barcodes_fp = self.index_file_path
                 else: 
-                    input_file_glob = os.path.join(input_dir, '*reads*.fastq*')
-                    for in_file in glob.glob(input_file_glob):
-                        print(in_file)
-                    in_file = glob.glob(input_file_glob)[0]
+                    in_file = get_single_path(OutputRegistry.load(input_dir), '*reads*.fastq*')
                     barcodes_fp = get_associated_barcodes_unpaired_fp(in_file)
                 log.info('Splitting libraries of "%s" with "%s"', in_file, barcodes_fp)
-                # TODO Make argument for -q and --max_barcode_errors and rev_comp (1-step vs 2-step PCR?)?
-                run_cmd([
-                    #'python', '/miniconda/bin/split_libraries_fastq.py',
-                    'split_libraries_fastq.py',
-                    '-o', str(output_dir),
-                    '-b', str(barcodes_fp),
-                    '-i', str(in_file),
-                    '-m', str(self.mapping_file),
-                    '--barcode_type', str(self.barcode_length),
-                    '-q', '0',
-                    '--max_barcode_errors', str(self.max_barcode_errors), 
-                    '--rev_comp_barcode',
-                    '--phred_offset=33',
-                    '--store_demultiplexed_fastq'
-                    ],
-                    log_file=os.path.join(output_dir, 'log')
-                )
+                self.progress.set_inputs([in_file])
+                self.backend.split_libraries(
+                    [in_file], [barcodes_fp], output_dir,
+                    barcode_offset=barcode_offset, rev_comp_barcode=self.rev_comp_barcode,
+                    index2_fp_list=None if index2_fp is None else [index2_fp],
+                    index_caches=index_caches)
+                read_fp_list = [in_file, barcodes_fp]
                 file_basename = os.path.basename(in_file)
                 file_name = re.split('.fastq', file_basename)[0]
-                os.remove(os.path.join(output_dir, 'seqs.fna'))
-                rename_files_in_dir(output_dir, file_name)
-                    #os.rename(os.path.join(output_dir, 'seqs.fastq'),
-                    #          os.path.join(output_dir, file_name + '_seqs.fastq'))
-                    #os.rename(os.path.join(output_dir, 'histograms.txt'),
-                    #          os.path.join(output_dir, file_name + '_histograms.txt'))
-                    #os.rename(os.path.join(output_dir, 'split_library_log.txt'),
-                    #          os.path.join(output_dir, file_name + '_split_library_log.txt'))
-                    #os.remove(os.path.join(output_dir, 'seqs.fna'))
+            if index2_fp is not None:
+                read_fp_list += [index2_fp] * (len(read_fp_list) // 2)
+            if index_caches is not None:
+                # the index files were read from their caches
+                read_fp_list = [
+                    index_caches[read_fp].cache_fp if read_fp in index_caches else read_fp
+                    for read_fp
+                    in read_fp_list]
+            for cache in (index_caches or {}).values():
+                cache.close()
+            reads_in, assigned, unassigned, filtered = parse_split_library_log(
+                os.path.join(output_dir, 'split_library_log.txt'))
+            self.ledger.record('step_02_split_libraries', reads_in, assigned, unassigned, filtered)
+            registry = OutputRegistry(output_dir)
+            registry.add_new_files()
+            # only QIIME writes seqs.fna
+            removed = {}
+            if 'seqs.fna' in registry.name_set:
+                removed['seqs.fna'] = os.path.getsize(os.path.join(output_dir, 'seqs.fna'))
+                registry.remove('seqs.fna')
+            registry.rename_with_prefix(file_name, list(registry.names))
+            registry.save()
+            self.io_audit.record('step_02_split_libraries', registry.get_paths(), read_fp_list, removed=removed)
+                #os.rename(os.path.join(output_dir, 'seqs.fastq'),
+                #          os.path.join(output_dir, file_name + '_seqs.fastq'))
+                #os.rename(os.path.join(output_dir, 'histograms.txt'),
+                #          os.path.join(output_dir, file_name + '_histograms.txt'))
+                #os.rename(os.path.join(output_dir, 'split_library_log.txt'),
+                #          os.path.join(output_dir, file_name + '_split_library_log.txt'))
         self.complete_step(log, output_dir)
         return output_dir
 
@@ -353,25 +737,44 @@ class Pipeline:
         else:
             log.info('Splitting seqs files based on sampleID')
 
-            input_files_glob = os.path.join(input_dir, '*_seqs.fastq')
-            log.info('input file glob: "%s"', input_files_glob)
-            for split_fastq_fp in glob.glob(input_files_glob):
+            split_fastq_fp_list = OutputRegistry.load(input_dir).get_paths('*_seqs.fastq')
+            self.progress.set_inputs(split_fastq_fp_list)
+            registry = OutputRegistry(output_dir)
+            assigned = {}
+            for split_fastq_fp in split_fastq_fp_list:
                 log.info('Splitting seq file "%s"', split_fastq_fp)
                 split_fastq_basename = os.path.basename(split_fastq_fp)
                 file_name = re.split('_seqs', split_fastq_basename)[0]
-                run_cmd([
-                        #'python', '/miniconda/bin/split_sequence_file_on_sample_ids.py',
-                        'split_sequence_file_on_sample_ids.py',
-                        '-i', split_fastq_fp,
-                        '-o', str(output_dir),
-                        '--file_type', 'fastq'
-                    ],
-                    log_file=os.path.join(output_dir, 'log')
-                )
-                rename_files_in_dir(output_dir, file_name)
+                sample_counts = self.backend.split_sequence_file_on_sample_ids(
+                    split_fastq_fp, output_dir, dereplicate_minuniquesize=self.dereplicate_minuniquesize)
+                # only the native backend counts reads as it splits them
+                if sample_counts is None:
+                    assigned = None
+                elif assigned is not None:
+                    for sample_id, count in sample_counts.items():
+                        assigned[sample_id] = assigned.get(sample_id, 0) + count
+                # rename only the files written for this seqs file
+                sample_file_names = None if sample_counts is None else self.backend.get_sample_file_names(
+                    sample_counts, dereplicate_minuniquesize=self.dereplicate_minuniquesize)
+                if sample_file_names is None:
+                    new_file_names = registry.add_new_files()
+                else:
+                    new_file_names = registry.add_files(sample_file_names)
+                sample_file_names = registry.rename_with_prefix(file_name, new_file_names)
+                if sample_counts is None and self.index_every > 0 and self.paired_ends is False:
+                    # QIIME writes no record indexes, the final per-sample files get them here
+                    for sample_file_name in sample_file_names:
+                        if sample_file_name.endswith('.fastq'):
+                            build_index(os.path.join(output_dir, sample_file_name), every=self.index_every)
+                            registry.add_files([get_index_fp(sample_file_name)])
                 #for sample_file in glob.glob(os.path.join(output_dir, '*.fastq')):
                 #    sample_file_basename = os.path.basename(sample_file)
                 #    os.rename(sample_file, os.path.join(output_dir, file_name + '_' + sample_file_basename))
+            registry.save()
+            if assigned is not None:
+                self.ledger.record('step_03_demultiplex', sum(assigned.values()), assigned)
+            self.io_audit.record(
+                'step_03_demultiplex', registry.get_paths(), split_fastq_fp_list, final=not self.paired_ends)
 
         self.complete_step(log, output_dir)
         return output_dir
@@ -383,36 +786,52 @@ class Pipeline:
             log.info('output directory "%s" is not empty, this step will be skipped', output_dir)
         else:
             log.info('Splitting sample files back into paired end files')
-            input_files_glob = os.path.join(input_dir, '*.fastq')
-            for input_file in glob.glob(input_files_glob):
+            registry = OutputRegistry(output_dir)
+            writer = BufferedSampleWriter(memory_budget=self.write_buffer_size, index_every=self.index_every)
+            reads_in = 0
+            assigned = {}
+            unassigned = 0
+            input_fp_list = OutputRegistry.load(input_dir).get_paths('*.fastq')
+            self.progress.set_inputs(input_fp_list)
+            for input_file in input_fp_list:
                 log.info('Making paired end files with "%s"', input_file)
                 input_file_basename = os.path.basename(input_file)
                 input_file_no_fastq = input_file_basename.split('.fastq')[0]
-                out1 = open(os.path.join(output_dir, input_file_no_fastq + '_R1.fastq'), 'w')
-                out2 = open(os.path.join(output_dir, input_file_no_fastq + '_R2.fastq'), 'w')
+                out1 = os.path.join(output_dir, input_file_no_fastq + '_R1.fastq')
+                out2 = os.path.join(output_dir, input_file_no_fastq + '_R2.fastq')
+                writer.write(out1, '')
+                writer.write(out2, '')
+                for out in (out1, out2):
+                    registry.add_files([os.path.basename(out)])
+                    if self.index_every > 0:
+                        registry.add_files([os.path.basename(get_index_fp(out))])
                 with open(input_file, 'r') as f:
-                    count = 0
-                    write_file = 1
-                    for l in f:
-                        if count % 4 == 0:
-                            write_file = l.split()[2].split(':')[0]
-                            write_line = l.split()[1:]
-                            write_line = ' '.join(write_line)
-                            write_id = l.split()[0].split('_')[:-1]
-                            write_id = '_'.join(write_id)
-                            if write_file == '1':
-                                out1.write('{} {}\n'.format(write_id, write_line))
-                            elif write_file == '2':
-                                out2.write('{} {}\n'.format(write_id, write_line))
-                            else:
-                                log.info('Bad number for paired end files "%s" in "%s', write_file, l)
-                        elif write_file == '1':
-                            out1.write(l)
+                    for header, seq, plus, qual in iter_fastq_records(f):
+                        reads_in += 1
+                        if reads_in & 0xffff == 0:
+                            report_reads(reads_in)
+                        write_file = header.split()[2].split(':')[0]
+                        write_line = header.split()[1:]
+                        write_line = ' '.join(write_line)
+                        write_id = header.split()[0].split('_')[:-1]
+                        write_id = '_'.join(write_id)
+                        record = '{} {}\n{}\n{}\n{}\n'.format(write_id, write_line, seq, plus, qual)
+                        if write_file == '1':
+                            writer.write(out1, record)
                         elif write_file == '2':
-                            out2.write(l)
-                        count += 1
-                out1.close()
-                out2.close()
+                            writer.write(out2, record)
+                        else:
+                            log.info('Bad number for paired end files "%s" in "%s', write_file, header)
+                            unassigned += 1
+                            continue
+                        # keyed by sample like step 03, without the FASTQ '@'
+                        sample_id = write_id[1:]
+                        assigned[sample_id] = assigned.get(sample_id, 0) + 1
+            writer.close()
+            writer.log_counters(log)
+            registry.save()
+            self.ledger.record('step_04_make_paired_end_files', reads_in, assigned, unassigned)
+            self.io_audit.record('step_04_make_paired_end_files', registry.get_paths(), input_fp_list, final=True)
 
         self.complete_step(log, output_dir)
         return output_dir
@@ -684,10 +1103,7 @@ class Pipeline:
 
             log.info('combined file: "%s"', output_file_name)
             output_fp = os.path.join(output_dir, output_file_name)
-            with gzip.open(output_fp, 'wt') as output_file:
-                for input_fp in input_fp_list:
-                    with gzip.open(input_fp, 'rt') as input_file:
-                        shutil.copyfileobj(fsrc=input_file, fdst=output_file)
+            concatenate_files(input_fp_list, output_fp)
 
         self.complete_step(log, output_dir)
         return output_dir
@@ -710,24 +1126,9 @@ class Pipeline:
                         pattern='\.fastq\.gz$',
                         repl='.derepmin{}.fasta'.format(self.vsearch_derep_minuniquesize)))
 
-                uc_fp = os.path.join(
-                    output_dir,
-                    re.sub(
-                        string=os.path.basename(input_fp),
-                        pattern='\.fastq\.gz$',
-                        repl='.derepmin{}.txt'.format(self.vsearch_derep_minuniquesize)))
-
-                run_cmd([
-                        self.vsearch_executable_fp,
-                        '-derep_fulllength', input_fp,
-                        '-output', output_fp,
-                        '-uc', uc_fp,
-                        '-sizeout',
-                        '-minuniquesize', str(self.vsearch_derep_minuniquesize),
-                        '-threads', str(self.core_count)
-                    ],
-                    log_file = os.path.join(output_dir, 'log')
-                )
+                dereplicate_file(
+                    input_fp, output_fp,
+                    minuniquesize=self.vsearch_derep_minuniquesize)
 
             es(glob.glob(os.path.join(output_dir, '*.fasta')))
 
@@ -894,24 +1295,5 @@ class Pipeline:
 
 '''
 
-def get_combined_file_name(input_fp_list):
-    if len(input_fp_list) == 0:
-        raise PipelineException('get_combined_file_name called with empty input')
-
-    def sorted_unique_elements(elements):
-        return sorted(set(elements))
-
-    return '_'.join(  # 'Mock_Run3_Run4_V4.fastq.gz'
-        itertools.chain.from_iterable(  # ['Mock', 'Run3', 'Run4', 'V4.fastq.gz']
-            map(  # [{'Mock'}, {'Run3', 'Run4'}, {'V4.fastq.gz'}]
-                sorted_unique_elements,
-                zip(  # [('Mock', 'Mock'), ('Run4', 'Run3'), ('V4.fastq.gz', 'V4.fastq.gz')]
-                    *[  # [('Mock', 'Run3', 'V4.fastq.gz'), ('Mock', 'Run4', 'V4.fastq.gz')]
-                        os.path.basename(fp).split('_')  # ['Mock', 'Run3', 'V4.fastq.gz']
-                        for fp  # '/some/data/Mock_Run3_V4.fastq.gz'
-                        in input_fp_list  # ['/input/data/Mock_Run3_V4.fastq.gz', '/input_data/Mock_Run4_V4.fastq.gz']
-                    ]))))
-
-
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -1,11 +1,16 @@
+import errno
 import glob
 import gzip
+import itertools
 import logging
 from operator import attrgetter
 import os
 import re
 import shutil
+import signal
 import subprocess
+import threading
+import time
 import traceback
 
 
@@ -13,6 +18,15 @@ class PipelineException(BaseException):
     pass
 
 
+class CommandKilledException(PipelineException):
+    # a command was killed with SIGKILL, most likely by the OOM killer
+    pass
+
+
+# pipeline.py exits with this when a command it ran was killed, as a shell reports SIGKILL
+killed_exit_code = 128 + signal.SIGKILL
+
+
 def get_sorted_file_list(dir_path):
     return tuple(
         sorted(
@@ -90,21 +104,153 @@ def get_associated_barcodes_unpaired_fp(forward_fp):
     return barcodes_fastq_fp
 
 
+def get_renamed_basename(basename, file_name):
+    # None for files that keep their name
+    if 'reads1' in basename:
+        old_basename = 'R1.fastq'
+    elif 'reads2' in basename:
+        old_basename = 'R2.fastq'
+    elif basename == 'log':
+        return None
+    else:
+        old_basename = basename
+    return '{}_{}'.format(file_name, old_basename)
+
+
 def rename_files_in_dir(output_dir, file_name):
     input_glob = os.path.join(output_dir, '*')
     for input_file in glob.glob(input_glob):
-        if 'reads1' in input_file:
-            old_basename = 'R1.fastq'
-        elif 'reads2' in input_file:
-            old_basename = 'R2.fastq'
-        elif os.path.basename(input_file) == 'log':
+        new_basename = get_renamed_basename(os.path.basename(input_file), file_name)
+        if new_basename is not None:
+            os.rename(input_file, os.path.join(output_dir, new_basename))
+
+
+def require_executable(executable):
+    # QIIME is only ever used through its scripts, so there is no need to pay for
+    # importing it (and NumPy and matplotlib with it); check that the script is on the PATH
+    if shutil.which(executable) is None:
+        raise PipelineException('"{}" was not found on the PATH'.format(executable))
+
+
+# resource use of every command run_cmd ran since the last pop_command_metrics()
+command_metrics = []
+# the commands run_cmd is waiting for, followed by progress.ProgressReporter
+running_command_pids = set()
+running_command_pids_lock = threading.Lock()
+
+
+def get_process_tree(pid):
+    """pid and the pids of all of its descendants."""
+    pids = [pid]
+    for parent in pids:
+        # pids grows as the children of each process are found
+        try:
+            for task in os.listdir('/proc/{}/task'.format(parent)):
+                with open('/proc/{}/task/{}/children'.format(parent, task), 'rt') as children_file:
+                    pids.extend(int(child) for child in children_file.read().split())
+        except (OSError, ValueError):
             continue
-        else:
-            old_basename = os.path.basename(input_file)
-        os.rename(input_file, os.path.join(output_dir, '{}_{}'.format(file_name, old_basename)))
+    return pids
+
+
+def read_proc_sample(pid):
+    """Current RSS and I/O counters of a running process from /proc, None once it is gone."""
+    sample = {}
+    try:
+        with open('/proc/{}/status'.format(pid), 'rt') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    sample['rss_kb'] = int(line.split()[1])
+        # /proc/PID/io is only readable for our own processes
+        with open('/proc/{}/io'.format(pid), 'rt') as io_file:
+            for line in io_file:
+                name, value = line.split(':')
+                if name in ('rchar', 'wchar', 'read_bytes', 'write_bytes'):
+                    sample[name] = int(value)
+    except (OSError, ValueError):
+        return sample or None
+    return sample
 
 
-def run_cmd(cmd_line_list, log_file, **kwargs):
+def wait_and_measure(process, sample_interval=1.0, start=None, sample_tree=False):
+    """
+    Wait for a Popen process, sampling /proc/PID every sample_interval seconds, and return
+    its resource use with the CPU times and max RSS from os.wait4. start is the time.time()
+    from before the process was started, for the wall time.
+
+    The max RSS of os.wait4 is that of the largest single process (the process or one of its
+    children), not of the process and its children running at the same time. With sample_tree
+    the RSS of the whole process tree is also summed at every sample, as sampled_tree_max_rss_kb.
+    """
+    samples = []
+    stop = threading.Event()
+
+    def sample_process():
+        while True:
+            sample = read_proc_sample(process.pid)
+            if sample is not None:
+                if sample_tree:
+                    sample['tree_rss_kb'] = sum(
+                        (read_proc_sample(pid) or {}).get('rss_kb', 0) for pid in get_process_tree(process.pid))
+                samples.append(sample)
+            if stop.wait(sample_interval):
+                return
+
+    start = start or time.time()
+    sampler = threading.Thread(target=sample_process, daemon=True)
+    sampler.start()
+    _, status, rusage = os.wait4(process.pid, 0)
+    seconds = time.time() - start
+    stop.set()
+    sampler.join()
+    # os.wait4 reaped the process, so Popen must not wait for it again
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    last_io = next((sample for sample in reversed(samples) if 'rchar' in sample), {})
+    metrics = {
+        'exit_code': process.returncode,
+        'seconds': round(seconds, 3),
+        'user_seconds': round(rusage.ru_utime, 3),
+        'sys_seconds': round(rusage.ru_stime, 3),
+        'cpu_utilization': round((rusage.ru_utime + rusage.ru_stime) / seconds, 3) if seconds > 0 else 0.0,
+        'max_rss_kb': rusage.ru_maxrss,
+        'sampled_max_rss_kb': max((sample.get('rss_kb', 0) for sample in samples), default=0),
+        'samples': len(samples),
+        'block_read_bytes': rusage.ru_inblock * 512,
+        'block_write_bytes': rusage.ru_oublock * 512,
+    }
+    if sample_tree:
+        metrics['sampled_tree_max_rss_kb'] = max((sample.get('tree_rss_kb', 0) for sample in samples), default=0)
+    # the I/O counters as of the last sample, so commands shorter than one interval report little
+    for name in ('rchar', 'wchar', 'read_bytes', 'write_bytes'):
+        metrics[name] = last_io.get(name, 0)
+    return metrics
+
+
+def format_command_metrics(metrics):
+    return '{}: {:.1f} s, user {:.1f} s, sys {:.1f} s ({:.0%} CPU), max RSS {:.1f} MB, read {:.1f} MB, wrote {:.1f} MB'.format(
+        metrics['command'], metrics['seconds'], metrics['user_seconds'], metrics['sys_seconds'],
+        metrics['cpu_utilization'], metrics['max_rss_kb'] / 2**10,
+        max(metrics['rchar'], metrics['block_read_bytes']) / 2**20,
+        max(metrics['wchar'], metrics['block_write_bytes']) / 2**20)
+
+
+def check_cmd(cmd_line_list, log_file, **kwargs):
+    """run_cmd, raising when the command does not exit with 0 so the step fails instead of going on."""
+    exit_code = run_cmd(cmd_line_list, log_file, **kwargs)
+    if exit_code == -signal.SIGKILL:
+        raise CommandKilledException('"{}" was killed, see "{}"'.format(cmd_line_list[0], log_file))
+    elif exit_code != 0:
+        raise PipelineException('"{}" failed with exit code {}, see "{}"'.format(cmd_line_list[0], exit_code, log_file))
+
+
+def pop_command_metrics():
+    metrics_list = list(command_metrics)
+    del command_metrics[:]
+    return metrics_list
+
+
+def run_cmd(cmd_line_list, log_file, sample_interval=1.0, **kwargs):
     log = logging.getLogger(name=__name__)
     try:
         with open(log_file, 'a') as log_file:
@@ -116,11 +262,24 @@ def run_cmd(cmd_line_list, log_file, **kwargs):
             cmd_line_str = ' '.join((str(x) for x in cmd_line_list))
             #log.info('executing "%s"', cmd_line_str)
             log_file.write('executing "{}"'.format(cmd_line_str))
-            output = subprocess.call(
+            log_file.flush()
+            start = time.time()
+            process = subprocess.Popen(
                 cmd_line_list,
                 stdout=log_file,
                 stderr=subprocess.STDOUT,
                 **kwargs)
+            with running_command_pids_lock:
+                running_command_pids.add(process.pid)
+            try:
+                metrics = wait_and_measure(process, sample_interval=sample_interval, start=start)
+            finally:
+                with running_command_pids_lock:
+                    running_command_pids.discard(process.pid)
+            metrics['command'] = os.path.basename(str(cmd_line_list[0]))
+            output = metrics['exit_code']
+            log_file.write('\nresources: {}\n'.format(format_command_metrics(metrics)))
+            command_metrics.append(metrics)
             log.info(output)
         return output
     except subprocess.CalledProcessError as c:
@@ -135,3 +294,164 @@ def run_cmd(cmd_line_list, log_file, **kwargs):
         print(e)
         traceback.print_exc()
         raise e
+
+
+def open_fastq(fastq_fp, mode='rt'):
+    if fastq_fp.endswith('.gz'):
+        return gzip.open(fastq_fp, mode)
+    else:
+        return open(fastq_fp, mode)
+
+
+def iter_fastq_records(fastq_file):
+    # yields (header, sequence, plus, quality) tuples with line endings removed
+    lines = iter(fastq_file)
+    for header in lines:
+        try:
+            seq = next(lines)
+            plus = next(lines)
+            qual = next(lines)
+        except StopIteration:
+            raise PipelineException('truncated FASTQ record "{}"'.format(header.rstrip()))
+        yield header.rstrip('\r\n'), seq.rstrip('\r\n'), plus.rstrip('\r\n'), qual.rstrip('\r\n')
+
+
+def get_read_id(header):
+    # '@M00123:1:000:1:1101:15589:1331 1:N:0:1' and '@M00123:...:1331/1' -> 'M00123:...:1331'
+    read_id = header.split(None, 1)[0].lstrip('@>')
+    if read_id.endswith('/1') or read_id.endswith('/2'):
+        read_id = read_id[:-2]
+    return read_id
+
+
+_complement = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+
+def reverse_complement(seq):
+    return seq.translate(_complement)[::-1]
+
+
+def read_mapping_file(mapping_fp):
+    # returns a list of dicts, one per sample, keyed by the QIIME mapping file header
+    with open(mapping_fp, 'rt') as mapping_file:
+        header = None
+        rows = []
+        for line in mapping_file:
+            line = line.rstrip('\r\n')
+            if line.strip() == '':
+                continue
+            elif header is None and line.startswith('#SampleID'):
+                header = line[1:].split('\t')
+            elif line.startswith('#'):
+                continue
+            elif header is None:
+                raise PipelineException('mapping file "{}" has no "#SampleID" header'.format(mapping_fp))
+            else:
+                rows.append(dict(zip(header, line.split('\t'))))
+    return rows
+
+
+def get_mapping_barcodes(mapping_fp):
+    return {
+        row['BarcodeSequence'].upper(): row['SampleID']
+        for row
+        in read_mapping_file(mapping_fp)
+    }
+
+
+def get_mapping_index_pairs(mapping_fp, index2_column='Index2Sequence'):
+    # dual index mapping files have the i5 index in index2_column next to BarcodeSequence (i7)
+    index_pairs = {}
+    for row in read_mapping_file(mapping_fp):
+        if index2_column not in row:
+            raise PipelineException('mapping file "{}" has no "{}" column for dual indexes'.format(mapping_fp, index2_column))
+        index_pair = (row['BarcodeSequence'].upper(), row[index2_column].upper())
+        if index_pair in index_pairs:
+            raise PipelineException('samples "{}" and "{}" have the same index pair {}+{}'.format(
+                index_pairs[index_pair], row['SampleID'], *index_pair))
+        index_pairs[index_pair] = row['SampleID']
+    return index_pairs
+
+
+def get_combined_file_name(input_fp_list):
+    if len(input_fp_list) == 0:
+        raise PipelineException('get_combined_file_name called with empty input')
+
+    def sorted_unique_elements(elements):
+        return sorted(set(elements))
+
+    return '_'.join(  # 'Mock_Run3_Run4_V4.fastq.gz'
+        itertools.chain.from_iterable(  # ['Mock', 'Run3', 'Run4', 'V4.fastq.gz']
+            map(  # [{'Mock'}, {'Run3', 'Run4'}, {'V4.fastq.gz'}]
+                sorted_unique_elements,
+                zip(  # [('Mock', 'Mock'), ('Run4', 'Run3'), ('V4.fastq.gz', 'V4.fastq.gz')]
+                    *[  # [('Mock', 'Run3', 'V4.fastq.gz'), ('Mock', 'Run4', 'V4.fastq.gz')]
+                        os.path.basename(fp).split('_')  # ['Mock', 'Run3', 'V4.fastq.gz']
+                        for fp  # '/some/data/Mock_Run3_V4.fastq.gz'
+                        in input_fp_list  # ['/input/data/Mock_Run3_V4.fastq.gz', '/input_data/Mock_Run4_V4.fastq.gz']
+                    ]))))
+
+
+def copy_file_bytes(input_file, output_file):
+    # copy in the kernel where possible: copy_file_range (Linux, Python 3.8+), then sendfile
+    count = os.fstat(input_file.fileno()).st_size - input_file.tell()
+    input_fd = input_file.fileno()
+    output_fd = output_file.fileno()
+    for copy in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+        if copy is None:
+            continue
+        try:
+            while count > 0:
+                if copy is os.sendfile:
+                    copied = copy(output_fd, input_fd, None, count)
+                else:
+                    copied = copy(input_fd, output_fd, count)
+                if copied == 0:
+                    break
+                count -= copied
+            return
+        except OSError:
+            # e.g. not supported between these filesystems; fall through with what is left
+            continue
+    shutil.copyfileobj(fsrc=input_file, fdst=output_file, length=2**20)
+
+
+def move_file(input_fp, output_fp):
+    # a rename on the same filesystem, otherwise one large sequential copy
+    try:
+        os.rename(input_fp, output_fp)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        with open(input_fp, 'rb') as input_file, open(output_fp, 'wb') as output_file:
+            copy_file_bytes(input_file, output_file)
+        os.remove(input_fp)
+
+
+def concatenate_files(input_fp_list, output_fp):
+    """
+    Concatenate files into output_fp without decompressing them. Concatenated gzip members
+    are a valid gzip file, so .gz inputs are copied byte for byte; an uncompressed input
+    is compressed into a new member if output_fp ends in .gz.
+    """
+    compress_output = output_fp.endswith('.gz')
+    with open(output_fp, 'wb') as output_file:
+        for input_fp in input_fp_list:
+            if compress_output and not input_fp.endswith('.gz'):
+                output_file.flush()
+                with open(input_fp, 'rb') as input_file, gzip.GzipFile(fileobj=output_file, mode='wb') as member:
+                    shutil.copyfileobj(fsrc=input_file, fdst=member, length=2**20)
+            elif input_fp.endswith('.gz') and not compress_output:
+                raise PipelineException('cannot concatenate compressed "{}" into uncompressed "{}"'.format(input_fp, output_fp))
+            else:
+                output_file.flush()
+                with open(input_fp, 'rb') as input_file:
+                    copy_file_bytes(input_file, output_file)
+                # the kernel copies moved the file offset behind the Python file object's back
+                output_file.seek(0, os.SEEK_END)
+    return output_fp
+
+
+def combine_runs(input_fp_list, output_dir):
+    output_fp = os.path.join(output_dir, get_combined_file_name(input_fp_list=input_fp_list))
+    return concatenate_files(sorted(input_fp_list), output_fp)
@@ -0,0 +1,259 @@
+"""
+Pre-flight planner: read a small sample of reads from the input, paired and index files,
+measure the per-read processing cost and the barcode match rate against the mapping file,
+then estimate runtime, peak disk usage in the work directory and the best worker count.
+"""
+import argparse
+import gzip
+import io
+import json
+import logging
+import math
+import os
+import random
+import time
+
+from pipeline_util import *
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-i', '--input-file', required=True,
+                            help='path to the input file or the directory containing the input files')
+    arg_parser.add_argument('-w', '--work-dir', default='',
+                            help='if given, the plan is also written to WORK_DIR/plan.json')
+    arg_parser.add_argument('-b', '--barcode-length', required=True, type=int)
+    arg_parser.add_argument('-m', '--mapping-file', required=True)
+    arg_parser.add_argument('-p', '--paired-ends', default='')
+    arg_parser.add_argument('-d', '--index-file', default='')
+    arg_parser.add_argument('--plan-sample-size', default=2000, type=int,
+                            help='number of reads to time and match against the mapping file')
+    arg_parser.add_argument('--plan-cores', default=0, type=int,
+                            help='cores available on the node (default: detect)')
+    args = arg_parser.parse_args()
+
+    print_plan(make_plan(**args.__dict__))
+
+
+def get_available_cores():
+    if 'SLURM_CPUS_ON_NODE' in os.environ:
+        return int(os.environ['SLURM_CPUS_ON_NODE'])
+    return os.cpu_count() or 1
+
+
+def get_input_fp_list(input_path):
+    if os.path.isdir(input_path):
+        return [entry.path for entry in get_sorted_file_list(input_path)]
+    else:
+        return [input_path]
+
+
+def get_stream_fp_list(input_fp, paired_ends, index_file):
+    # the same file association rules Pipeline uses in step_01 and step_02
+    stream_fp_list = [input_fp]
+    if paired_ends != '':
+        if os.path.isdir(paired_ends):
+            stream_fp_list.append(get_associated_reverse_fastq_fp(forward_fp=input_fp, reverse_input_dir=paired_ends))
+        else:
+            stream_fp_list.append(paired_ends)
+    if index_file != '':
+        stream_fp_list.append(index_file)
+    return stream_fp_list
+
+
+def sample_aligned_records(stream_fp_list, sample_size, sample_window, rng):
+    """
+    Read the first sample_window records of every stream in lockstep and keep a random
+    sample_size of them so that the sampled forward, reverse and index records stay aligned.
+    Also returns the compressed and uncompressed bytes consumed per stream.
+    """
+    raw_files = [open(fp, 'rb') for fp in stream_fp_list]
+    try:
+        text_files = [
+            io.TextIOWrapper(gzip.GzipFile(fileobj=raw_file), encoding='ascii') if fp.endswith('.gz')
+            else io.TextIOWrapper(raw_file, encoding='ascii')
+            for fp, raw_file
+            in zip(stream_fp_list, raw_files)
+        ]
+        window = []
+        uncompressed_bytes = [0] * len(stream_fp_list)
+        read_start = time.perf_counter()
+        for records in zip(*[iter_fastq_records(f) for f in text_files]):
+            for n, record in enumerate(records):
+                uncompressed_bytes[n] += sum(len(line) + 1 for line in record)
+            window.append(records)
+            if len(window) == sample_window:
+                break
+        read_seconds = time.perf_counter() - read_start
+        raw_bytes = [raw_file.tell() for raw_file in raw_files]
+    finally:
+        for raw_file in raw_files:
+            raw_file.close()
+
+    sample = rng.sample(window, min(sample_size, len(window)))
+    return sample, len(window), raw_bytes, uncompressed_bytes, read_seconds
+
+
+def process_sample(sample, barcode_length, barcodes, index_stream):
+    # one pass of the per-read work every demultiplexing step does: parse the barcode,
+    # reverse complement it, look up the sample and format the QIIME style output record
+    output = []
+    matched = 0
+    matched_forward = 0
+    start = time.perf_counter()
+    for records in sample:
+        header, seq, _, qual = records[0]
+        barcode = records[index_stream][1][:barcode_length]
+        sample_id = barcodes.get(reverse_complement(barcode))
+        if sample_id is not None:
+            matched += 1
+            output.append('@{}_{} {} orig_bc={} new_bc={} bc_diffs=0\n{}\n+\n{}\n'.format(
+                sample_id, matched, header[1:], barcode, barcode, seq, qual))
+        elif barcode in barcodes:
+            matched_forward += 1
+    seconds = time.perf_counter() - start
+    return seconds, matched, matched_forward
+
+
+def get_step_disk_estimates(read_stream_bytes, n_reads, match_rate, barcode_length, index_mode):
+    # returns (step name, bytes written, bytes removed at the end of the step) in pipeline order
+    qiime_header_bytes = 40 + 2 * barcode_length
+    steps = []
+    if not index_mode:
+        barcode_record_bytes = 2 * (2 * barcode_length * len(read_stream_bytes)) + 40
+        steps.append(('step_01_remove_barcodes', sum(read_stream_bytes) + n_reads * barcode_record_bytes, 0))
+    seqs_fastq_bytes = match_rate * (sum(read_stream_bytes) + n_reads * len(read_stream_bytes) * qiime_header_bytes)
+    # seqs.fna holds the header and sequence of every record and is removed at the end of step_02
+    seqs_fna_bytes = seqs_fastq_bytes / 2
+    steps.append(('step_02_split_libraries', seqs_fastq_bytes + seqs_fna_bytes, seqs_fna_bytes))
+    steps.append(('step_03_demultiplex', seqs_fastq_bytes, 0))
+    if len(read_stream_bytes) > 1:
+        steps.append(('step_04_make_paired_end_files', seqs_fastq_bytes, 0))
+    return steps
+
+
+def plan_input_file(input_fp, mapping_file, barcode_length, paired_ends, index_file, sample_size, sample_window, rng):
+    log = logging.getLogger(name=__name__)
+    stream_fp_list = get_stream_fp_list(input_fp, paired_ends, index_file)
+    log.info('sampling reads from %s', ', '.join(stream_fp_list))
+    sample, window_size, raw_bytes, uncompressed_bytes, read_seconds = sample_aligned_records(
+        stream_fp_list, sample_size, sample_window, rng)
+    if len(sample) == 0:
+        raise PipelineException('found no reads in "{}"'.format(input_fp))
+
+    index_mode = index_file != ''
+    barcodes = get_mapping_barcodes(mapping_file)
+    index_stream = len(stream_fp_list) - 1 if index_mode else 0
+    seconds, matched, matched_forward = process_sample(sample, barcode_length, barcodes, index_stream)
+
+    file_sizes = [os.path.getsize(fp) for fp in stream_fp_list]
+    n_reads = int(file_sizes[0] / (raw_bytes[0] / window_size))
+    n_read_streams = len(stream_fp_list) - (1 if index_mode else 0)
+    read_stream_bytes = [
+        n_reads * uncompressed_bytes[n] / window_size
+        for n
+        in range(n_read_streams)
+    ]
+    match_rate = matched / len(sample)
+    steps = get_step_disk_estimates(read_stream_bytes, n_reads, match_rate, barcode_length, index_mode)
+
+    # every step makes one full pass over the reads; reading and writing the step files
+    # is charged at the read rate measured while sampling
+    input_bytes_per_second = sum(uncompressed_bytes) / read_seconds if read_seconds > 0 else float('inf')
+    cpu_seconds = len(steps) * n_reads * seconds / len(sample)
+    io_bytes = sum(uncompressed_bytes) / window_size * n_reads + 2 * sum(written for _, written, _ in steps)
+    io_seconds = io_bytes / input_bytes_per_second
+
+    peak_bytes = 0
+    current_bytes = 0
+    for _, written, removed in steps:
+        current_bytes += written
+        peak_bytes = max(peak_bytes, current_bytes)
+        current_bytes -= removed
+
+    return {
+        'input_file': input_fp,
+        'streams': stream_fp_list,
+        'sampled_reads': len(sample),
+        'estimated_reads': n_reads,
+        'match_rate': match_rate,
+        'forward_orientation_match_rate': matched_forward / len(sample),
+        'seconds_per_read': seconds / len(sample),
+        'estimated_seconds': cpu_seconds + io_seconds,
+        'step_bytes': {name: int(written) for name, written, _ in steps},
+        'peak_bytes': int(peak_bytes),
+        'final_bytes': int(current_bytes),
+    }
+
+
+def get_makespan(job_seconds, workers):
+    # longest processing time first, the same order a scheduler would use
+    worker_seconds = [0.0] * workers
+    for seconds in sorted(job_seconds, reverse=True):
+        worker_seconds[worker_seconds.index(min(worker_seconds))] += seconds
+    return max(worker_seconds)
+
+
+def choose_worker_count(job_seconds, cores):
+    max_workers = max(1, min(cores, len(job_seconds)))
+    makespans = {w: get_makespan(job_seconds, w) for w in range(1, max_workers + 1)}
+    best = min(makespans.values())
+    # fewest workers that come within 5% of the best makespan
+    for workers in sorted(makespans):
+        if makespans[workers] <= best * 1.05:
+            return workers, makespans[workers]
+
+
+def format_slurm_time(seconds):
+    seconds = int(math.ceil(seconds))
+    return '{:02d}:{:02d}:{:02d}'.format(seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+
+def make_plan(input_file, mapping_file, barcode_length, paired_ends='', index_file='', work_dir='',
+              plan_sample_size=2000, plan_cores=0, sample_window=50000, safety_factor=2.0, seed=1, **kwargs):
+    rng = random.Random(seed)
+    file_plans = [
+        plan_input_file(input_fp, mapping_file, barcode_length, paired_ends, index_file,
+                        plan_sample_size, sample_window, rng)
+        for input_fp
+        in get_input_fp_list(input_file)
+    ]
+    cores = plan_cores or get_available_cores()
+    workers, makespan = choose_worker_count([p['estimated_seconds'] for p in file_plans], cores)
+    plan = {
+        'files': file_plans,
+        'cores': cores,
+        'workers': workers,
+        'estimated_seconds': makespan,
+        'peak_bytes': sum(p['peak_bytes'] for p in file_plans),
+        'slurm_n': workers,
+        'slurm_t': format_slurm_time(max(makespan * safety_factor, 600)),
+    }
+    if work_dir != '':
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+        with open(os.path.join(work_dir, 'plan.json'), 'wt') as plan_file:
+            json.dump(plan, plan_file, indent=2)
+    return plan
+
+
+def print_plan(plan):
+    for file_plan in plan['files']:
+        print('{}'.format(file_plan['input_file']))
+        print('  estimated reads               : {:,}'.format(file_plan['estimated_reads']))
+        print('  barcode match rate            : {:.1%} ({:.1%} in forward orientation)'.format(
+            file_plan['match_rate'], file_plan['forward_orientation_match_rate']))
+        print('  seconds per read              : {:.2e}'.format(file_plan['seconds_per_read']))
+        print('  estimated runtime             : {}'.format(format_slurm_time(file_plan['estimated_seconds'])))
+        for step_name, step_bytes in sorted(file_plan['step_bytes'].items()):
+            print('  {:<30}: {:,.0f} MB'.format(step_name, step_bytes / 2**20))
+        print('  peak disk usage               : {:,.0f} MB'.format(file_plan['peak_bytes'] / 2**20))
+    print('workers (cores {})    : {}'.format(plan['cores'], plan['workers']))
+    print('estimated runtime     : {}'.format(format_slurm_time(plan['estimated_seconds'])))
+    print('peak disk usage       : {:,.0f} MB'.format(plan['peak_bytes'] / 2**20))
+    print('suggested SLURM flags : -n {} -t {}'.format(plan['slurm_n'], plan['slurm_t']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+Sampling profiler for the pure-Python loops of the pipeline (step 04, fasta_qual_to_fastq and
+the native backend). A thread looks at the stack of the profiled thread every few milliseconds
+with sys._current_frames(), so the profiled code runs unchanged, and nothing runs at all when
+profiling is off. Three files are written:
+
+    PREFIX_functions.txt   samples per function, in the function itself (self) and below it (total)
+    PREFIX_lines.txt       samples per source line
+    PREFIX.collapsed       one line per distinct stack with its samples, for flamegraph.pl
+
+pipeline.py --profile writes them to each step directory. Any script can be profiled with
+
+    python profiler.py -o OUTPUT_DIR [--interval 0.005] SCRIPT.py [SCRIPT ARGS ...]
+"""
+import argparse
+import linecache
+import os
+import runpy
+import sys
+import threading
+import time
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-o', '--output-dir', required=True)
+    arg_parser.add_argument('--interval', default=0.005, type=float,
+                            help='seconds between samples')
+    arg_parser.add_argument('script')
+    arg_parser.add_argument('script_args', nargs=argparse.REMAINDER)
+    args = arg_parser.parse_args()
+
+    sys.argv = [args.script] + args.script_args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(args.script)))
+    exit_code = 0
+    with SamplingProfiler(interval=args.interval) as profiler:
+        try:
+            runpy.run_path(args.script, run_name='__main__')
+        except SystemExit as e:
+            exit_code = e.code
+    os.makedirs(args.output_dir, exist_ok=True)
+    for fp in profiler.write(args.output_dir, prefix=os.path.splitext(os.path.basename(args.script))[0]):
+        print(fp, file=sys.stderr)
+    return exit_code
+
+
+def get_frame_name(code):
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005, thread_id=None):
+        """thread_id: the thread to sample, by default the one that starts the profiler"""
+        self.interval = interval
+        self.thread_id = thread_id
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.stacks = {}
+        self.lines = {}
+        self.sample_count = 0
+        self.seconds = 0.0
+
+    def start(self):
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self.sample_periodically, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.seconds = time.time() - self.start_time
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def sample_periodically(self):
+        # counts are kept by code object, names are only made when the profile is written
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            line_key = (frame.f_code, frame.f_lineno)
+            self.lines[line_key] = self.lines.get(line_key, 0) + 1
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack = tuple(reversed(stack))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.sample_count += 1
+            del frame
+
+    def get_function_counts(self):
+        """{code: [self samples, total samples]}"""
+        counts = {}
+        for stack, samples in self.stacks.items():
+            counts.setdefault(stack[-1], [0, 0])[0] += samples
+            # a recursive function counts once per sample
+            for code in set(stack):
+                counts.setdefault(code, [0, 0])[1] += samples
+        return counts
+
+    def write(self, output_dir, prefix='profile'):
+        """Write the three profile files to output_dir, returns their paths."""
+        total = max(self.sample_count, 1)
+        header = '{} samples every {:.1f} ms over {:.1f} s\n'.format(self.sample_count, 1000 * self.interval, self.seconds)
+
+        functions_fp = os.path.join(output_dir, prefix + '_functions.txt')
+        with open(functions_fp, 'wt') as functions_file:
+            functions_file.write(header)
+            functions_file.write('{:>7} {:>7} {:>8} {:>8}  {}\n'.format('self%', 'total%', 'self', 'total', 'function'))
+            for code, (self_samples, total_samples) in sorted(
+                    self.get_function_counts().items(), key=lambda c: (-c[1][0], -c[1][1])):
+                functions_file.write('{:>7.1%} {:>7.1%} {:>8} {:>8}  {}\n'.format(
+                    self_samples / total, total_samples / total, self_samples, total_samples,
+                    '{} ({}:{})'.format(code.co_name, code.co_filename, code.co_firstlineno)))
+
+        lines_fp = os.path.join(output_dir, prefix + '_lines.txt')
+        with open(lines_fp, 'wt') as lines_file:
+            lines_file.write(header)
+            for (code, lineno), samples in sorted(self.lines.items(), key=lambda l: -l[1]):
+                lines_file.write('{:>7.1%} {:>8}  {}:{} {}  {}\n'.format(
+                    samples / total, samples, code.co_filename, lineno, code.co_name,
+                    linecache.getline(code.co_filename, lineno).strip()))
+
+        collapsed_fp = os.path.join(output_dir, prefix + '.collapsed')
+        with open(collapsed_fp, 'wt') as collapsed_file:
+            for stack, samples in sorted(self.stacks.items(), key=lambda s: -s[1]):
+                collapsed_file.write('{} {}\n'.format(';'.join(get_frame_name(code) for code in stack), samples))
+        return [functions_fp, lines_fp, collapsed_fp]
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,282 @@
+"""
+Live progress of pipeline runs. While a step runs, WORK_DIR/progress/INPUT_NAME.json is
+rewritten (atomically) every few seconds with the bytes of each input file consumed so far,
+reads per second and an ETA. The byte offsets come from /proc/PID/fdinfo of the pipeline
+process and of the commands run_cmd is waiting for (and their children), so the QIIME scripts
+are followed as they read; native steps also report the reads they have processed.
+
+    python progress.py WORK_DIR [--stall-minutes 10]
+
+prints every run in WORK_DIR (and in the task work directories of launcher.py) with its step,
+progress and ETA, and marks runs that have not consumed input for --stall-minutes as stalled.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+from pipeline_util import *
+
+
+progress_dir_name = 'progress'
+# the reporter of the step running in this process, for report_reads
+current_reporter = None
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('work_dir')
+    arg_parser.add_argument('--stall-minutes', default=10.0, type=float,
+                            help='mark running runs that consumed no input for this long as stalled')
+    args = arg_parser.parse_args()
+
+    status_fp_list = []
+    for work_dir in [args.work_dir] + get_task_work_dirs(args.work_dir):
+        progress_dir = os.path.join(work_dir, progress_dir_name)
+        if os.path.isdir(progress_dir):
+            status_fp_list.extend(
+                os.path.join(progress_dir, name) for name in sorted(os.listdir(progress_dir)) if name.endswith('.json'))
+    now = time.time()
+    for status_fp in status_fp_list:
+        with open(status_fp, 'rt') as status_file:
+            status = json.load(status_file)
+        state = status['state']
+        if state == 'running' and now - status['last_progress_at'] > 60 * args.stall_minutes:
+            state = 'STALLED'
+        print('{:<24} {:<8} {}:{:<8} {}'.format(
+            status['input_name'], state, status['host'], status['pid'], format_status(status)))
+    return 0
+
+
+def get_task_work_dirs(work_dir):
+    task_dir = os.path.join(work_dir, 'launcher', 'work')
+    if not os.path.isdir(task_dir):
+        return []
+    return [os.path.join(task_dir, name) for name in sorted(os.listdir(task_dir))]
+
+
+def format_seconds(seconds):
+    return 'unknown' if seconds is None else str(datetime.timedelta(seconds=int(seconds)))
+
+
+def format_status(status):
+    if status['step'] is None:
+        return 'finished {} steps in {}'.format(
+            len(status['steps']), format_seconds(sum(step['seconds'] for step in status['steps'])))
+    line = '{} {:.1%} of {:.1f} MB, {:.1f} MB/s'.format(
+        status['step'], status['fraction'], status['total_bytes'] / 2**20, status['bytes_per_second'] / 2**20)
+    if status['reads_per_second'] is not None:
+        line += ', {:,.0f} reads/s{}'.format(status['reads_per_second'], ' (estimated)' if status['reads_estimated'] else '')
+    return line + ', ETA {}'.format(format_seconds(status['eta_seconds']))
+
+
+def report_reads(reads):
+    """Called by native loops now and then with the reads processed so far in the current step."""
+    if current_reporter is not None:
+        current_reporter.reads = reads
+
+
+def read_file_offsets(pid):
+    """{path: offset} of the regular files a process has open for reading, from /proc/PID/fd and fdinfo."""
+    offsets = {}
+    fd_dir = '/proc/{}/fd'.format(pid)
+    try:
+        fds = os.listdir(fd_dir)
+    except OSError:
+        return offsets
+    for fd in fds:
+        try:
+            path = os.readlink(os.path.join(fd_dir, fd))
+            if not path.startswith('/'):
+                # pipes, sockets and the like
+                continue
+            position = flags = None
+            with open('/proc/{}/fdinfo/{}'.format(pid, fd), 'rt') as fdinfo_file:
+                for line in fdinfo_file:
+                    if line.startswith('pos:'):
+                        position = int(line.split()[1])
+                    elif line.startswith('flags:'):
+                        flags = int(line.split()[1], 8)
+        except (OSError, ValueError):
+            # closed while we looked
+            continue
+        if position is not None and flags is not None and flags & os.O_ACCMODE == os.O_RDONLY:
+            offsets[path] = max(offsets.get(path, 0), position)
+    return offsets
+
+
+def get_record_bytes(fastq_fp, sample_bytes=2**16):
+    """Mean bytes per record at the start of an uncompressed FASTQ file, None for gzipped files."""
+    if fastq_fp.endswith('.gz'):
+        return None
+    with open(fastq_fp, 'rb') as fastq_file:
+        lines = fastq_file.read(sample_bytes).splitlines(keepends=True)
+    record_count = len(lines) // 4
+    if record_count == 0:
+        return None
+    return sum(len(line) for line in lines[:4 * record_count]) / record_count
+
+
+class ProgressReporter:
+    def __init__(self, work_dir, input_name, interval=10.0, to_stderr=False):
+        self.input_name = input_name
+        self.status_fp = os.path.join(work_dir, progress_dir_name, input_name + '.json')
+        self.interval = interval
+        self.to_stderr = to_stderr
+        self.lock = threading.Lock()
+        # the main and the reporter thread both write the status file through the same tmp file
+        self.write_lock = threading.Lock()
+        self.stop = threading.Event()
+        self.thread = None
+        self.steps = []
+        self.state = 'running'
+        self.step = None
+        self.step_start = None
+        self.inputs = {}
+        self.explicit_inputs = False
+        self.record_bytes = None
+        self.reads = None
+        self.consumed = 0
+        self.last_progress_at = time.time()
+
+    def start_step(self, step_name):
+        global current_reporter
+        with self.lock:
+            self.step = step_name
+            self.step_start = time.time()
+            self.inputs = {}
+            self.explicit_inputs = False
+            self.record_bytes = None
+            self.reads = None
+            self.consumed = 0
+            self.last_progress_at = self.step_start
+        current_reporter = self
+        self.write()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.sample_periodically, daemon=True)
+            self.thread.start()
+
+    def set_inputs(self, input_fp_list):
+        """The files the step reads; without them the step's progress is the files it is seen reading."""
+        with self.lock:
+            self.explicit_inputs = True
+            for input_fp in input_fp_list:
+                self.inputs[os.path.realpath(input_fp)] = {'consumed': 0, 'size': os.path.getsize(input_fp)}
+            # a step can have no input at all, e.g. step 04 when no read had a known barcode
+            if len(input_fp_list) > 0:
+                self.record_bytes = get_record_bytes(input_fp_list[0])
+
+    def finish_step(self):
+        global current_reporter
+        with self.lock:
+            if self.step is not None:
+                self.steps.append({'step': self.step, 'seconds': round(time.time() - self.step_start, 3)})
+            self.step = None
+        current_reporter = None
+        self.write()
+
+    def close(self, state='done'):
+        global current_reporter
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            self.state = state
+            if state != 'done' and self.step is not None:
+                self.steps.append({'step': self.step, 'seconds': round(time.time() - self.step_start, 3), 'state': state})
+            self.step = None
+        current_reporter = None
+        self.write()
+
+    def sample_periodically(self):
+        while not self.stop.wait(self.interval):
+            if self.step is not None:
+                try:
+                    self.sample()
+                except (OSError, RuntimeError):
+                    # e.g. a full disk; the next sample tries again rather than ending the thread
+                    logging.getLogger(name='progress').exception('failed to sample progress')
+
+    def sample(self):
+        offsets = {}
+        # run_cmd adds and discards pids on the main thread
+        with running_command_pids_lock:
+            command_pids = sorted(running_command_pids)
+        for pid in [os.getpid()] + command_pids:
+            for tree_pid in get_process_tree(pid):
+                for path, position in read_file_offsets(tree_pid).items():
+                    offsets[path] = max(offsets.get(path, 0), position)
+        with self.lock:
+            for path, position in offsets.items():
+                if path not in self.inputs:
+                    if self.explicit_inputs or path.startswith(('/proc/', '/sys/', '/dev/')) or not os.path.isfile(path):
+                        continue
+                    self.inputs[path] = {'consumed': 0, 'size': os.path.getsize(path)}
+                # files are read once per step, a closed file keeps its last offset
+                self.inputs[path]['consumed'] = max(self.inputs[path]['consumed'], min(position, self.inputs[path]['size']))
+            consumed = sum(i['consumed'] for i in self.inputs.values())
+            if consumed > self.consumed:
+                self.consumed = consumed
+                self.last_progress_at = time.time()
+        status = self.write()
+        if self.to_stderr and status['step'] is not None:
+            logging.getLogger(name='progress').info('%s: %s', self.input_name, format_status(status))
+
+    def get_status(self):
+        now = time.time()
+        status = {
+            'input_name': self.input_name,
+            'state': self.state,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'updated_at': round(now, 3),
+            'last_progress_at': round(self.last_progress_at, 3),
+            'steps': list(self.steps),
+            'step': self.step,
+        }
+        if self.step is None:
+            return status
+        elapsed = max(now - self.step_start, 1e-6)
+        total = sum(i['size'] for i in self.inputs.values())
+        fraction = self.consumed / total if total > 0 else 0.0
+        reads = self.reads
+        reads_estimated = False
+        if reads is None and self.record_bytes is not None:
+            # bytes of the first input over its mean record size, for steps run by external commands
+            first_input = next(iter(self.inputs.values()))
+            reads = int(first_input['consumed'] / self.record_bytes)
+            reads_estimated = True
+        status.update({
+            'step_started_at': round(self.step_start, 3),
+            'inputs': dict(self.inputs),
+            'consumed_bytes': self.consumed,
+            'total_bytes': total,
+            'fraction': round(fraction, 4),
+            'bytes_per_second': round(self.consumed / elapsed, 1),
+            'reads': reads,
+            'reads_estimated': reads_estimated,
+            'reads_per_second': None if reads is None else round(reads / elapsed, 1),
+            'eta_seconds': round(elapsed * (1 - fraction) / fraction, 1) if fraction > 0 else None,
+        })
+        return status
+
+    def write(self):
+        with self.write_lock:
+            with self.lock:
+                status = self.get_status()
+            os.makedirs(os.path.dirname(self.status_fp), exist_ok=True)
+            tmp_fp = '{}.{}.tmp'.format(self.status_fp, os.getpid())
+            with open(tmp_fp, 'wt') as status_file:
+                json.dump(status, status_file, indent=2, sort_keys=True)
+            os.replace(tmp_fp, self.status_fp)
+        return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,331 @@
+"""
+Columnar per-sample read store (SAMPLE.rds), an alternative to per-sample FASTQ for loading
+reads into Python without parsing text. A store is one file with a small header followed by
+64-byte aligned columns:
+
+    seq          bases of all reads back to back, one uint8 per base or 2-bit packed (ACGT = 0-3,
+                 4 bases per byte, first base in the high bits)
+    qual         quality characters of all reads back to back (phred + 33), uint8
+    offsets      uint64 start of every read in seq and qual, record_count + 1 entries
+    ids          FASTQ headers without the @, back to back
+    id_offsets   uint64 start of every header in ids, record_count + 1 entries
+    n_positions  uint64 positions in seq of the N bases of a 2-bit store, which hold A
+
+ReadStore memory-maps a store. Its columns come back as NumPy arrays that are views of the
+mapping (NumPy is only imported when a column is asked for), and single records can be read
+without NumPy. The + lines of the FASTQ records are not kept.
+
+    python read_store.py from-fastq SAMPLE.fastq [...] [--encoding 2bit]
+    python read_store.py to-fastq SAMPLE.rds [-o SAMPLE.fastq]
+    python read_store.py info SAMPLE.rds
+"""
+import argparse
+import array
+import logging
+import mmap
+import os
+import struct
+import sys
+
+from pipeline_util import *
+from output_registry import OutputRegistry
+from record_index import get_index_fp
+
+
+store_magic = b'RDS1'
+store_version = 1
+encodings = ('uint8', '2bit')
+column_names = ('seq', 'qual', 'offsets', 'ids', 'id_offsets', 'n_positions')
+# magic, version, encoding, record count, base count, then (offset, length) of every column
+store_header = struct.Struct('<4sHHQQ' + 'QQ' * len(column_names))
+column_alignment = 64
+flush_bytes = 4 * 2**20
+
+# every 4-base string to its packed byte, and back
+pack_table = {}
+unpack_table = []
+for packed_byte in range(256):
+    quad = ''.join('ACGT'[(packed_byte >> shift) & 3] for shift in (6, 4, 2, 0))
+    pack_table[quad] = packed_byte
+    unpack_table.append(quad)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    subparsers = arg_parser.add_subparsers(dest='command')
+    from_fastq_parser = subparsers.add_parser('from-fastq')
+    from_fastq_parser.add_argument('fastq_files', nargs='+')
+    from_fastq_parser.add_argument('--encoding', default='uint8', choices=encodings)
+    to_fastq_parser = subparsers.add_parser('to-fastq')
+    to_fastq_parser.add_argument('store_file')
+    to_fastq_parser.add_argument('-o', '--output-file', default='')
+    info_parser = subparsers.add_parser('info')
+    info_parser.add_argument('store_files', nargs='+')
+    args = arg_parser.parse_args()
+
+    if args.command == 'from-fastq':
+        for fastq_fp in args.fastq_files:
+            store_fp = get_store_fp(fastq_fp)
+            record_count = fastq_to_store(fastq_fp, store_fp, encoding=args.encoding)
+            print('{}\t{} records'.format(store_fp, record_count))
+    elif args.command == 'to-fastq':
+        output_fp = args.output_file or os.path.splitext(args.store_file)[0] + '.fastq'
+        with ReadStore(args.store_file) as store:
+            store.to_fastq(output_fp)
+    elif args.command == 'info':
+        for store_fp in args.store_files:
+            with ReadStore(store_fp) as store:
+                print('{}\t{} records\t{} bases\t{}'.format(store_fp, len(store), store.base_count, store.encoding))
+    else:
+        arg_parser.print_help()
+        return 1
+    return 0
+
+
+def get_store_fp(fastq_fp):
+    name = os.path.basename(fastq_fp)
+    for ext in ('.fastq.gz', '.fastq'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    return os.path.join(os.path.dirname(fastq_fp), name + '.rds')
+
+
+def write_read_stores(final_dir, output_format, encoding='uint8'):
+    """Write a store for every registered FASTQ file of final_dir, and drop the FASTQ files for output_format 'read-store'."""
+    if output_format == 'fastq':
+        return
+    log = logging.getLogger(name=__name__)
+    registry = OutputRegistry.load(final_dir)
+    for fastq_fp in registry.get_paths('*.fastq'):
+        store_fp = get_store_fp(fastq_fp)
+        if not os.path.exists(store_fp):
+            record_count = fastq_to_store(fastq_fp, store_fp, encoding=encoding)
+            log.info('wrote %d reads of "%s" to "%s"', record_count, fastq_fp, store_fp)
+        registry.add_files([os.path.basename(store_fp)])
+        if output_format == 'read-store':
+            registry.remove(os.path.basename(fastq_fp))
+            if os.path.basename(get_index_fp(fastq_fp)) in registry.name_set:
+                registry.remove(os.path.basename(get_index_fp(fastq_fp)))
+    registry.save()
+
+
+class ReadStoreWriter:
+    """Writes a store from records added in order. Columns are spilled to temporary files so memory stays small."""
+    def __init__(self, store_fp, encoding='uint8'):
+        if encoding not in encodings:
+            raise PipelineException('unknown read store encoding "{}"'.format(encoding))
+        self.store_fp = store_fp
+        self.encoding = encoding
+        self.column_fps = {name: '{}.{}.tmp'.format(store_fp, name) for name in column_names}
+        self.column_files = {name: open(fp, 'wb') for name, fp in self.column_fps.items()}
+        self.buffers = {name: [] for name in ('seq', 'qual', 'ids')}
+        self.buffered_bytes = 0
+        self.offsets = array.array('Q', [0])
+        self.id_offsets = array.array('Q', [0])
+        self.n_positions = array.array('Q')
+        self.record_count = 0
+        self.base_count = 0
+        self.id_byte_count = 0
+        # bases of the 2-bit column not packed yet, fewer than 4
+        self.carry = ''
+
+    def add(self, header, seq, qual):
+        if len(seq) != len(qual):
+            raise PipelineException('read "{}" has {} bases but {} quality scores'.format(header, len(seq), len(qual)))
+        read_id = header[1:] if header.startswith('@') else header
+        if self.encoding == '2bit':
+            self.buffers['seq'].append(self.pack(seq))
+        else:
+            self.buffers['seq'].append(seq.encode('ascii'))
+        self.buffers['qual'].append(qual.encode('ascii'))
+        self.buffers['ids'].append(read_id.encode('ascii'))
+        self.record_count += 1
+        self.base_count += len(seq)
+        self.id_byte_count += len(read_id)
+        self.offsets.append(self.base_count)
+        self.id_offsets.append(self.id_byte_count)
+        self.buffered_bytes += 2 * len(seq) + len(read_id)
+        if self.buffered_bytes >= flush_bytes:
+            self.flush()
+
+    def pack(self, seq):
+        seq = seq.upper()
+        if 'N' in seq:
+            start = self.base_count
+            self.n_positions.extend(start + i for i, base in enumerate(seq) if base == 'N')
+            seq = seq.replace('N', 'A')
+        seq = self.carry + seq
+        packed_length = len(seq) - len(seq) % 4
+        try:
+            packed = bytes([pack_table[seq[i:i + 4]] for i in range(0, packed_length, 4)])
+        except KeyError as e:
+            raise PipelineException('only A, C, G, T and N can be stored 2-bit, found {}'.format(e))
+        self.carry = seq[packed_length:]
+        return packed
+
+    def flush(self):
+        for name, buffer in self.buffers.items():
+            self.column_files[name].write(b''.join(buffer))
+            del buffer[:]
+        for name, values in (('offsets', self.offsets), ('id_offsets', self.id_offsets), ('n_positions', self.n_positions)):
+            values.tofile(self.column_files[name])
+            del values[:]
+        self.buffered_bytes = 0
+
+    def close(self):
+        if self.encoding == '2bit' and self.carry != '':
+            self.buffers['seq'].append(bytes([pack_table[self.carry.ljust(4, 'A')]]))
+            self.carry = ''
+        self.flush()
+        for column_file in self.column_files.values():
+            column_file.close()
+
+        columns = []
+        position = store_header.size
+        for name in column_names:
+            position += -position % column_alignment
+            length = os.path.getsize(self.column_fps[name])
+            columns.extend((position, length))
+            position += length
+        tmp_fp = self.store_fp + '.tmp'
+        with open(tmp_fp, 'wb') as store_file:
+            store_file.write(store_header.pack(
+                store_magic, store_version, encodings.index(self.encoding), self.record_count, self.base_count,
+                *columns))
+            for name, column_offset in zip(column_names, columns[::2]):
+                store_file.write(b'\0' * (column_offset - store_file.tell()))
+                store_file.flush()
+                with open(self.column_fps[name], 'rb') as column_file:
+                    copy_file_bytes(column_file, store_file)
+                # the copy went around the file object's buffer
+                store_file.seek(0, os.SEEK_END)
+                os.remove(self.column_fps[name])
+        os.replace(tmp_fp, self.store_fp)
+        return self.record_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for name, column_file in self.column_files.items():
+                column_file.close()
+                if os.path.exists(self.column_fps[name]):
+                    os.remove(self.column_fps[name])
+
+
+def fastq_to_store(fastq_fp, store_fp, encoding='uint8'):
+    with open_fastq(fastq_fp) as fastq_file, ReadStoreWriter(store_fp, encoding=encoding) as writer:
+        for header, seq, _, qual in iter_fastq_records(fastq_file):
+            writer.add(header, seq, qual)
+    return writer.record_count
+
+
+class ReadStore:
+    def __init__(self, store_fp):
+        self.store_fp = store_fp
+        with open(store_fp, 'rb') as store_file:
+            self.mmap = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mmap) < store_header.size:
+            self.close()
+            raise PipelineException('"{}" is not a read store'.format(store_fp))
+        values = store_header.unpack_from(self.mmap)
+        magic, version, encoding, self.record_count, self.base_count = values[:5]
+        if magic != store_magic or version != store_version:
+            self.close()
+            raise PipelineException('"{}" is not a version {} read store'.format(store_fp, store_version))
+        self.encoding = encodings[encoding]
+        self.columns = {
+            name: (values[5 + 2 * i], values[6 + 2 * i])
+            for i, name
+            in enumerate(column_names)
+        }
+        self.view = memoryview(self.mmap)
+        self.offsets = self.get_memoryview('offsets').cast('Q')
+        self.id_offsets = self.get_memoryview('id_offsets').cast('Q')
+        self.n_position_set = None
+
+    def get_memoryview(self, name):
+        offset, length = self.columns[name]
+        return self.view[offset:offset + length]
+
+    def __len__(self):
+        return self.record_count
+
+    def get_column(self, name):
+        """A NumPy view of a column: uint8 for seq, qual and ids, uint64 for the others."""
+        import numpy
+        offset, length = self.columns[name]
+        dtype = numpy.uint64 if name in ('offsets', 'id_offsets', 'n_positions') else numpy.uint8
+        return numpy.frombuffer(self.mmap, dtype=dtype, count=length // numpy.dtype(dtype).itemsize, offset=offset)
+
+    def get_sequences(self):
+        """All bases as one uint8 array of ASCII codes, a view for uint8 stores and decoded for 2-bit ones."""
+        if self.encoding == 'uint8':
+            return self.get_column('seq')
+        import numpy
+        packed = self.get_column('seq')
+        codes = numpy.stack([(packed >> shift) & 3 for shift in (6, 4, 2, 0)], axis=1).reshape(-1)[:self.base_count]
+        bases = numpy.frombuffer(b'ACGT', dtype=numpy.uint8)[codes]
+        bases[self.get_column('n_positions')] = ord('N')
+        return bases
+
+    def get_record(self, record_number):
+        """(header, seq, qual) of one read, without NumPy."""
+        start, end = self.offsets[record_number], self.offsets[record_number + 1]
+        id_start, id_end = self.id_offsets[record_number], self.id_offsets[record_number + 1]
+        ids = self.get_memoryview('ids')
+        qual = self.get_memoryview('qual')
+        return (
+            '@' + bytes(ids[id_start:id_end]).decode('ascii'),
+            self.get_seq(start, end),
+            bytes(qual[start:end]).decode('ascii'),
+        )
+
+    def get_seq(self, start, end):
+        packed = self.get_memoryview('seq')
+        if self.encoding == 'uint8':
+            return bytes(packed[start:end]).decode('ascii')
+        seq = ''.join(unpack_table[packed_byte] for packed_byte in packed[start // 4:(end + 3) // 4])
+        seq = seq[start % 4:start % 4 + end - start]
+        if self.n_position_set is None:
+            self.n_position_set = frozenset(self.get_memoryview('n_positions').cast('Q'))
+        if len(self.n_position_set) > 0:
+            seq = ''.join('N' if start + i in self.n_position_set else base for i, base in enumerate(seq))
+        return seq
+
+    def iter_records(self):
+        for record_number in range(self.record_count):
+            yield self.get_record(record_number)
+
+    def to_fastq(self, fastq_fp):
+        with open(fastq_fp, 'wt') as fastq_file:
+            for header, seq, qual in self.iter_records():
+                fastq_file.write('{}\n{}\n+\n{}\n'.format(header, seq, qual))
+        return self.record_count
+
+    def close(self):
+        if self.mmap is None:
+            return
+        for view in ('offsets', 'id_offsets', 'view'):
+            if hasattr(self, view):
+                getattr(self, view).release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            # NumPy arrays still view the mapping, it goes away with them
+            pass
+        self.mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+Read-ahead for FASTQ files that are read in lockstep (forward, reverse and index reads).
+
+Every file is read and decompressed on its own background thread into a bounded queue of
+record batches, so a stall in one file overlaps with work on the others. Records are
+handed out as aligned tuples and their read IDs are checked against each other.
+"""
+import queue
+import threading
+
+from pipeline_util import *
+
+
+_end_of_file = object()
+
+
+class SynchronizedReader:
+    def __init__(self, fp_list, batch_size=4096, queue_depth=8, check_read_ids=True):
+        self.fp_list = list(fp_list)
+        self.batch_size = batch_size
+        self.check_read_ids = check_read_ids
+        self.queues = [queue.Queue(maxsize=queue_depth) for _ in self.fp_list]
+        self.stop = threading.Event()
+        self.threads = [
+            threading.Thread(target=self.read_ahead, args=(fp, q), daemon=True)
+            for fp, q
+            in zip(self.fp_list, self.queues)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, q, item):
+        # give up when the consumer has stopped reading
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read_ahead(self, fp, q):
+        try:
+            with open_fastq(fp) as fastq_file:
+                batch = []
+                for record in iter_fastq_records(fastq_file):
+                    batch.append(record)
+                    if len(batch) == self.batch_size:
+                        if not self.put(q, batch):
+                            return
+                        batch = []
+                if batch and not self.put(q, batch):
+                    return
+            self.put(q, _end_of_file)
+        except BaseException as e:
+            self.put(q, e)
+
+    def get_batch(self, n):
+        batch = self.queues[n].get()
+        if isinstance(batch, BaseException):
+            raise batch
+        return batch
+
+    def iter_batches(self):
+        # aligned batches: the n-th record of every batch in a tuple comes from the same read
+        pending = [[] for _ in self.fp_list]
+        finished = [False] * len(self.fp_list)
+        while True:
+            for n in range(len(self.fp_list)):
+                if len(pending[n]) < self.batch_size and not finished[n]:
+                    batch = self.get_batch(n)
+                    if batch is _end_of_file:
+                        finished[n] = True
+                    else:
+                        pending[n].extend(batch)
+            size = min(len(p) for p in pending)
+            if size == 0:
+                if any(len(p) > 0 for p in pending):
+                    raise PipelineException('files have different numbers of records: {}'.format(', '.join(self.fp_list)))
+                return
+            aligned = [p[:size] for p in pending]
+            pending = [p[size:] for p in pending]
+            if self.check_read_ids:
+                self.check_batch(aligned)
+            yield aligned
+
+    def check_batch(self, aligned):
+        for records in zip(*aligned):
+            read_id = get_read_id(records[0][0])
+            for record in records[1:]:
+                if get_read_id(record[0]) != read_id:
+                    raise PipelineException('read IDs do not match: "{}" and "{}"'.format(records[0][0], record[0]))
+
+    def __iter__(self):
+        try:
+            for aligned in self.iter_batches():
+                yield from zip(*aligned)
+        finally:
+            self.close()
+
+    def close(self):
+        self.stop.set()
+        for thread in self.threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
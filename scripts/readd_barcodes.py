@@ -1,18 +1,16 @@
-with open('./Undetermined_S0_L001_R1_001.fastq', 'r') as f1, \
-        open('./Undetermined_S0_L001_R2_001.fastq', 'r') as f2, \
-        open('./Undetermined_S0_L001_R2_001.fastq', 'r') as b:
+from readahead import SynchronizedReader
+
+with open('./Undetermined_S0_L001_R1_001_rebarcoded.fastq', 'w') as out1, \
+        open('./Undetermined_S0_L001_R2_001_rebarcoded.fastq', 'w') as out2:
     count = 0
-    out1 = open('./Undetermined_S0_L001_R1_001_rebarcoded.fastq', 'w')
-    out2 = open('./Undetermined_S0_L001_R2_001_rebarcoded.fastq', 'w')
-    for x, y, z in zip(f1, f2, b):
-        if count % 2 == 1:
-            out1.write(z.strip() + x.strip() + '\n')
-            out2.write(z.strip() + y.strip() + '\n')
-        else:
-            out1.write(x)
-            out2.write(y)
+    reader = SynchronizedReader([
+        './Undetermined_S0_L001_R1_001.fastq',
+        './Undetermined_S0_L001_R2_001.fastq',
+        './Undetermined_S0_L001_R2_001.fastq'])
+    for x, y, z in reader:
+        out1.write('{}\n{}\n{}\n{}\n'.format(x[0], z[1] + x[1], x[2], z[3] + x[3]))
+        out2.write('{}\n{}\n{}\n{}\n'.format(y[0], z[1] + y[1], y[2], z[3] + y[3]))
         count += 1
-        if count == 10000000:
+        if count == 2500000:
             break
-    out1.close()
-    out2.close()
\ No newline at end of file
+    reader.close()
@@ -0,0 +1,153 @@
+"""
+Sidecar record offset index for per-sample FASTQ files (SAMPLE.fastq -> SAMPLE.fastq.idx).
+
+The index holds the total record and byte counts and the byte offset of every K-th record,
+so counting records, reading the first N records, reading records from the middle of a file,
+random subsampling and splitting a file into chunks are seeks instead of scans.
+
+    python record_index.py build FILE [FILE ...]
+    python record_index.py count FILE
+    python record_index.py head FILE N
+    python record_index.py sample FILE N
+"""
+import argparse
+import array
+import os
+import random
+import struct
+import sys
+
+from pipeline_util import *
+
+
+index_magic = b'FQIX'
+index_header = struct.Struct('<4sIQQ')  # magic, records per offset, record count, byte count
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('command', choices=('build', 'count', 'head', 'sample'))
+    arg_parser.add_argument('fastq_files', nargs='+')
+    arg_parser.add_argument('-n', '--records', default=10000, type=int)
+    arg_parser.add_argument('--every', default=1024, type=int)
+    arg_parser.add_argument('--seed', default=1, type=int)
+    args = arg_parser.parse_args()
+
+    for fastq_fp in args.fastq_files:
+        if args.command == 'build':
+            build_index(fastq_fp, every=args.every)
+        elif args.command == 'count':
+            print('{}\t{}'.format(fastq_fp, count_records(fastq_fp)))
+        elif args.command == 'head':
+            sys.stdout.writelines(read_records(fastq_fp, 0, args.records))
+        elif args.command == 'sample':
+            sys.stdout.writelines(subsample(fastq_fp, args.records, seed=args.seed))
+
+
+def get_index_fp(fastq_fp):
+    return fastq_fp + '.idx'
+
+
+class RecordIndexBuilder:
+    """Collects the offsets of a file as its records are written, in order."""
+    def __init__(self, every=1024):
+        self.every = every
+        self.record_count = 0
+        self.byte_count = 0
+        self.offsets = array.array('Q')
+
+    def add(self, record_bytes):
+        if self.record_count % self.every == 0:
+            self.offsets.append(self.byte_count)
+        self.record_count += 1
+        self.byte_count += record_bytes
+
+    def write(self, index_fp):
+        with open(index_fp, 'wb') as index_file:
+            index_file.write(index_header.pack(index_magic, self.every, self.record_count, self.byte_count))
+            self.offsets.tofile(index_file)
+
+
+def read_index(fastq_fp):
+    with open(get_index_fp(fastq_fp), 'rb') as index_file:
+        magic, every, record_count, byte_count = index_header.unpack(index_file.read(index_header.size))
+        if magic != index_magic:
+            raise PipelineException('"{}" is not a record index'.format(get_index_fp(fastq_fp)))
+        offsets = array.array('Q')
+        offsets.frombytes(index_file.read())
+    if os.path.getsize(fastq_fp) != byte_count:
+        raise PipelineException('record index for "{}" is out of date'.format(fastq_fp))
+    return {'every': every, 'record_count': record_count, 'byte_count': byte_count, 'offsets': offsets}
+
+
+def build_index(fastq_fp, every=1024):
+    # for files written without an index, e.g. by QIIME
+    builder = RecordIndexBuilder(every=every)
+    with open(fastq_fp, 'rb') as fastq_file:
+        while True:
+            record = [fastq_file.readline() for _ in range(4)]
+            if record[0] == b'':
+                break
+            builder.add(sum(len(line) for line in record))
+    builder.write(get_index_fp(fastq_fp))
+    return builder.record_count
+
+
+def count_records(fastq_fp):
+    return read_index(fastq_fp)['record_count']
+
+
+def seek_record(fastq_file, index, record_number):
+    # seek to the nearest indexed record then skip fewer than `every` records
+    fastq_file.seek(index['offsets'][record_number // index['every']])
+    for _ in range(4 * (record_number % index['every'])):
+        fastq_file.readline()
+
+
+def read_records(fastq_fp, start, count):
+    index = read_index(fastq_fp)
+    records = []
+    with open(fastq_fp, 'rt') as fastq_file:
+        if start < index['record_count']:
+            seek_record(fastq_file, index, start)
+            for _ in range(min(count, index['record_count'] - start)):
+                records.append(''.join(fastq_file.readline() for _ in range(4)))
+    return records
+
+
+def subsample(fastq_fp, count, seed=1):
+    index = read_index(fastq_fp)
+    record_numbers = sorted(random.Random(seed).sample(range(index['record_count']), min(count, index['record_count'])))
+    records = []
+    with open(fastq_fp, 'rt') as fastq_file:
+        position = None
+        for record_number in record_numbers:
+            # read forward when the next record is in the same block, seek otherwise
+            if position is None or record_number // index['every'] != position // index['every'] or record_number < position:
+                seek_record(fastq_file, index, record_number)
+            else:
+                for _ in range(4 * (record_number - position)):
+                    fastq_file.readline()
+            records.append(''.join(fastq_file.readline() for _ in range(4)))
+            position = record_number + 1
+    return records
+
+
+def get_chunks(fastq_fp, chunk_count):
+    """Split a file into about chunk_count (start byte, end byte, record count) ranges on record boundaries."""
+    index = read_index(fastq_fp)
+    if index['record_count'] == 0:
+        return []
+    block_count = len(index['offsets'])
+    boundaries = sorted({block_count * n // chunk_count for n in range(chunk_count)})
+    chunks = []
+    for start_block, end_block in zip(boundaries, boundaries[1:] + [block_count]):
+        start = index['offsets'][start_block]
+        end = index['offsets'][end_block] if end_block < block_count else index['byte_count']
+        record_end = min(end_block * index['every'], index['record_count'])
+        chunks.append((start, end, record_end - start_block * index['every']))
+    return chunks
+
+
+if __name__ == '__main__':
+    main()
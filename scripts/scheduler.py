@@ -0,0 +1,229 @@
+"""
+Run the pipeline on every file of an input directory at once, as many at a time as the
+node's cores and memory allow. QIIME's split_libraries_fastq.py and
+split_sequence_file_on_sample_ids.py can use a lot of memory on large lanes, so each job's
+peak RSS is estimated from its input size and the peaks of earlier jobs (kept in
+WORK_DIR/metrics/memory_history.json), and a job is only started while the estimates of the
+running jobs fit in the memory budget. The largest files are started first, and smaller
+files fill in while a large one waits for memory. A job's peak is the sampled sum of
+pipeline.py and the QIIME script it runs, or os.wait4's peak of the largest of them if higher.
+
+    python scheduler.py -i INPUT_DIR -w WORK_DIR [--memory-gb 32] [--workers 16] -- -m MAPPING -b 12 ...
+
+Everything after -- is passed to pipeline.py for every file. Each job's output goes to
+WORK_DIR/scheduler_logs/INPUT_NAME.log.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from pipeline_util import *
+from plan import get_available_cores, get_input_fp_list, get_stream_fp_list
+import pipeline
+
+
+history_file_name = 'memory_history.json'
+max_history = 100
+# peak RSS = base bytes + bytes per uncompressed input byte, until jobs have been measured
+default_memory_models = {
+    'qiime': (2**30, 1.0),
+    'native': (2**28, 0.05),
+}
+safety_factor = 1.25
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-i', '--input-dir', required=True,
+                            help='directory of input files (or a single file)')
+    arg_parser.add_argument('-w', '--work-dir', required=True)
+    arg_parser.add_argument('--memory-gb', default=0.0, type=float,
+                            help='memory for all jobs together (default: SLURM_MEM_PER_NODE or the available memory)')
+    arg_parser.add_argument('--workers', default=0, type=int,
+                            help='most jobs at a time (default: the cores on the node)')
+    arg_parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='print the jobs in start order with their memory estimates and exit')
+    arg_parser.add_argument('pipeline_args', nargs=argparse.REMAINDER)
+    args = arg_parser.parse_args()
+
+    pipeline_args = args.pipeline_args[1:] if args.pipeline_args[:1] == ['--'] else args.pipeline_args
+    os.makedirs(args.work_dir, exist_ok=True)
+    scheduler = AdmissionScheduler(
+        args.work_dir,
+        memory_budget=get_memory_budget(args.memory_gb),
+        workers=args.workers or get_available_cores())
+    jobs = scheduler.make_jobs(get_input_fp_list(args.input_dir), pipeline_args)
+    if args.dry_run:
+        print('memory budget {:.1f} GB, {} workers'.format(scheduler.memory_budget / 2**30, scheduler.workers))
+        for job in jobs:
+            print('{:>8.2f} GB  {}'.format(job.estimate / 2**30, job.input_fp))
+        return 0
+    failed = scheduler.run(jobs)
+    return 1 if len(failed) > 0 else 0
+
+
+def get_memory_budget(memory_gb=0.0, headroom=0.9):
+    if memory_gb > 0:
+        return int(memory_gb * 2**30)
+    if 'SLURM_MEM_PER_NODE' in os.environ:
+        return int(int(os.environ['SLURM_MEM_PER_NODE']) * 2**20 * headroom)
+    with open('/proc/meminfo', 'rt') as meminfo_file:
+        for line in meminfo_file:
+            if line.startswith('MemAvailable:'):
+                return int(int(line.split()[1]) * 2**10 * headroom)
+    raise PipelineException('cannot tell how much memory the node has, use --memory-gb')
+
+
+def get_input_bytes(stream_fp_list):
+    # gzipped FASTQ is about a quarter of its uncompressed size
+    return sum(
+        os.path.getsize(stream_fp) * (4 if stream_fp.endswith('.gz') else 1)
+        for stream_fp
+        in stream_fp_list
+    )
+
+
+class PipelineJob:
+    def __init__(self, input_fp, argv, backend, input_bytes, estimate):
+        self.input_fp = input_fp
+        self.argv = argv
+        self.backend = backend
+        self.input_bytes = input_bytes
+        self.estimate = estimate
+        self.attempts = 0
+
+
+class AdmissionScheduler:
+    def __init__(self, work_dir, memory_budget, workers):
+        self.work_dir = work_dir
+        self.memory_budget = memory_budget
+        self.workers = workers
+        self.history_fp = os.path.join(work_dir, 'metrics', history_file_name)
+        self.history = {}
+        if os.path.exists(self.history_fp):
+            with open(self.history_fp, 'rt') as history_file:
+                self.history = json.load(history_file)
+        self.log_dir = os.path.join(work_dir, 'scheduler_logs')
+
+    def estimate_peak_bytes(self, backend, input_bytes, base_bytes=0):
+        default_base, per_byte = default_memory_models[backend]
+        base = default_base + base_bytes
+        observed = self.history.get(backend, [])
+        if len(observed) > 0:
+            # slope between the smallest and largest inputs measured (the default slope until
+            # there are two sizes), raised until the line is above every measured peak
+            smallest = min(observed)
+            largest = max(observed)
+            if largest[0] > smallest[0]:
+                per_byte = max(0, (largest[1] - smallest[1]) / (largest[0] - smallest[0]))
+            base = max(peak - per_byte * size for size, peak in observed)
+        return int(safety_factor * (base + per_byte * input_bytes))
+
+    def make_jobs(self, input_fp_list, pipeline_args):
+        jobs = []
+        for input_fp in input_fp_list:
+            argv = ['-i', input_fp, '-w', self.work_dir] + list(pipeline_args)
+            args = pipeline.get_args(argv)
+            input_bytes = get_input_bytes(get_stream_fp_list(input_fp, args.paired_ends, args.index_file))
+            # the native backend buffers up to --write-buffer-mb of per-sample output
+            base_bytes = int(args.write_buffer_mb * 2**20) if args.backend == 'native' else 0
+            jobs.append(PipelineJob(
+                input_fp, argv, args.backend, input_bytes,
+                self.estimate_peak_bytes(args.backend, input_bytes, base_bytes)))
+        # largest first, the longest jobs should not be the last ones started
+        return sorted(jobs, key=lambda job: job.input_bytes, reverse=True)
+
+    def run(self, jobs):
+        """Run the jobs and return the ones that failed."""
+        log = logging.getLogger(name=__name__)
+        os.makedirs(self.log_dir, exist_ok=True)
+        pending = list(jobs)
+        running = {}
+        failed = []
+        finished = queue.Queue()
+        reserved = 0
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < self.workers:
+                job = next((job for job in pending if reserved + job.estimate <= self.memory_budget), None)
+                if job is None:
+                    if len(running) > 0:
+                        break
+                    # nothing else is running, so it gets the whole node
+                    job = pending[0]
+                    log.warning('"%s" is estimated to need %.1f GB, more than the %.1f GB budget',
+                                job.input_fp, job.estimate / 2**30, self.memory_budget / 2**30)
+                pending.remove(job)
+                running[job.input_fp] = job
+                reserved += job.estimate
+                log.info('starting "%s" (estimated %.1f GB, %.1f of %.1f GB reserved, %d running)',
+                         job.input_fp, job.estimate / 2**30, reserved / 2**30, self.memory_budget / 2**30, len(running))
+                threading.Thread(target=self.run_job, args=(job, finished), daemon=True).start()
+
+            job, metrics = finished.get()
+            del running[job.input_fp]
+            reserved -= job.estimate
+            if metrics['exit_code'] == 0:
+                log.info('finished "%s" in %.0f s, peak RSS %.2f GB (estimated %.2f GB)',
+                         job.input_fp, metrics['seconds'], metrics['peak_rss_kb'] / 2**20, job.estimate / 2**30)
+                self.add_to_history(job, metrics['peak_rss_kb'] * 2**10)
+            elif metrics['exit_code'] in (-signal.SIGKILL, killed_exit_code) and job.attempts == 1:
+                # pipeline.py or a QIIME script it ran was killed, most likely by the OOM killer;
+                # try again with the node to itself, the peak of a killed attempt is not kept
+                log.warning('"%s" was killed at %.1f GB, running it again alone',
+                            job.input_fp, metrics['peak_rss_kb'] / 2**20)
+                job.estimate = self.memory_budget
+                pending.insert(0, job)
+            else:
+                log.error('"%s" failed with exit code %d, see "%s"%s',
+                          job.input_fp, metrics['exit_code'], self.get_log_fp(job),
+                          ': ' + metrics['error'] if 'error' in metrics else '')
+                failed.append(job)
+        return failed
+
+    def get_log_fp(self, job):
+        return os.path.join(self.log_dir, os.path.basename(job.input_fp) + '.log')
+
+    def run_job(self, job, finished):
+        job.attempts += 1
+        start = time.time()
+        try:
+            with open(self.get_log_fp(job), 'a') as log_file:
+                process = subprocess.Popen(
+                    [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline.py')] + job.argv,
+                    stdout=log_file,
+                    stderr=subprocess.STDOUT)
+                # pipeline.py and the QIIME script it is running use memory at the same time
+                metrics = wait_and_measure(process, start=start, sample_tree=True)
+            metrics['peak_rss_kb'] = max(metrics['max_rss_kb'], metrics['sampled_tree_max_rss_kb'])
+        except Exception as e:
+            # run() waits for every job it started, so a job that could not run is reported as failed
+            metrics = {
+                'exit_code': 1,
+                'seconds': round(time.time() - start, 3),
+                'max_rss_kb': 0,
+                'peak_rss_kb': 0,
+                'error': '{}: {}'.format(type(e).__name__, e),
+            }
+        finished.put((job, metrics))
+
+    def add_to_history(self, job, peak_bytes):
+        observed = self.history.setdefault(job.backend, [])
+        observed.append([job.input_bytes, peak_bytes])
+        del observed[:-max_history]
+        os.makedirs(os.path.dirname(self.history_fp), exist_ok=True)
+        tmp_fp = self.history_fp + '.tmp'
+        with open(tmp_fp, 'wt') as history_file:
+            json.dump(self.history, history_file, indent=2)
+        os.replace(tmp_fp, self.history_fp)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
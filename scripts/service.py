@@ -0,0 +1,355 @@
+"""
+Local demultiplexing service for many small runs. The service starts its worker processes
+once, with the pipeline modules imported and the mapping file lookup tables built on first
+use (or up front with --preload-mapping), and runs pipeline jobs on them. Jobs take the same
+arguments as pipeline.py and are accepted on a Unix socket and/or from a spool directory.
+
+    python service.py serve --socket /tmp/demultiplex.sock [--spool-dir DIR] [--workers N]
+    python service.py submit --socket /tmp/demultiplex.sock -- -i READS -w WORK_DIR -m MAPPING -b 12 ...
+
+Over the socket a job is one JSON line {"args": [...], "cwd": "..."} and the reply is a stream
+of JSON lines: accepted, started, one per log record, then done (with output directories,
+seconds, peak worker RSS and the read ledger) or failed.
+
+In the spool directory a job is a JSON file dropped in SPOOL/incoming/. It is moved to
+running/ and then done/ or failed/, and its events are appended to SPOOL/status/JOB.jsonl.
+
+A worker that dies while running a job (killed, out of memory) fails that job and is replaced.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import resource
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+from pipeline_util import *
+import demux
+import pipeline
+
+
+final_events = ('done', 'failed')
+job_id_length = 12
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser()
+    subparsers = arg_parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.add_argument('--socket', default='')
+    serve_parser.add_argument('--spool-dir', default='')
+    serve_parser.add_argument('--workers', default=max(1, (os.cpu_count() or 2) // 2), type=int)
+    serve_parser.add_argument('--preload-mapping', default=[], action='append',
+                              help='build the lookup tables for this mapping file before starting the workers')
+    serve_parser.add_argument('--preload-max-barcode-errors', default=0, type=int)
+    submit_parser = subparsers.add_parser('submit')
+    submit_parser.add_argument('--socket', required=True)
+    submit_parser.add_argument('pipeline_args', nargs=argparse.REMAINDER)
+    args = arg_parser.parse_args()
+
+    if args.command == 'serve':
+        if args.socket == '' and args.spool_dir == '':
+            arg_parser.error('serve needs --socket and/or --spool-dir')
+        for mapping_file in args.preload_mapping:
+            demux.get_mapping_tables(mapping_file, args.preload_max_barcode_errors)
+        service = DemultiplexService(worker_count=args.workers)
+        # after the workers are forked, so they keep the default SIGTERM handling
+        signal.signal(signal.SIGTERM, stop_service)
+        try:
+            if args.spool_dir != '':
+                threading.Thread(target=service.watch_spool_dir, args=(args.spool_dir,), daemon=True).start()
+            if args.socket != '':
+                service.serve_socket(args.socket)
+            else:
+                while True:
+                    time.sleep(60)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.close()
+        return 0
+    elif args.command == 'submit':
+        pipeline_args = args.pipeline_args[1:] if args.pipeline_args[:1] == ['--'] else args.pipeline_args
+        final_event = submit(args.socket, pipeline_args, on_event=print_event)
+        return 0 if final_event['event'] == 'done' else 1
+    else:
+        arg_parser.print_help()
+        return 1
+
+
+def stop_service(signal_number, frame):
+    raise KeyboardInterrupt()
+
+
+class JobLogHandler(logging.Handler):
+    """Sends the log records of the job a worker is running to the service as events."""
+    def __init__(self, events):
+        super().__init__()
+        self.events = events
+        self.job_id = None
+
+    def emit(self, record):
+        if self.job_id is not None:
+            self.events.send((self.job_id, {
+                'event': 'log',
+                'logger': record.name,
+                'level': record.levelname,
+                'message': record.getMessage(),
+            }))
+
+
+def run_job(argv):
+    args = pipeline.get_args(argv)
+    if args.plan:
+        raise PipelineException('--plan is not supported by the service, run pipeline.py --plan')
+    job_pipeline = pipeline.Pipeline(**args.__dict__)
+    output_dir_list = job_pipeline.run(input_file=args.input_file)
+    return output_dir_list, job_pipeline.ledger.steps
+
+
+def worker_loop(task_queue, events, job_slot):
+    """
+    events: the worker's own pipe to the service; a send is complete when it returns, so nothing
+            is lost and no lock shared with other workers is held when a worker is killed
+    job_slot: shared memory with the id of the job being run, for the service to fail it if the worker dies
+    """
+    handler = JobLogHandler(events)
+    root_log = logging.getLogger()
+    root_log.handlers = [handler]
+    root_log.setLevel(logging.INFO)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        job_id, argv, cwd = task
+        job_slot.value = job_id.encode('ascii')
+        handler.job_id = job_id
+        events.send((job_id, {'event': 'started', 'pid': os.getpid()}))
+        start = time.time()
+        try:
+            os.chdir(cwd)
+            output_dir_list, ledger = run_job(argv)
+            event = {
+                'event': 'done',
+                'output_dirs': output_dir_list,
+                'seconds': round(time.time() - start, 3),
+                'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'ledger': ledger,
+            }
+        except KeyboardInterrupt:
+            raise
+        except SystemExit:
+            # argparse exits on bad arguments after printing the usage to the worker's stderr
+            event = {'event': 'failed', 'message': 'invalid pipeline arguments: {}'.format(' '.join(argv))}
+        except BaseException as e:
+            event = {'event': 'failed', 'message': '{}: {}'.format(type(e).__name__, e), 'traceback': traceback.format_exc()}
+        handler.job_id = None
+        event['seconds'] = round(time.time() - start, 3)
+        events.send((job_id, event))
+        job_slot.value = b''
+
+
+class DemultiplexService:
+    def __init__(self, worker_count=1):
+        # fork so the workers start with everything the service has imported and built
+        self.context = multiprocessing.get_context('fork')
+        self.task_queue = self.context.Queue()
+        self.listeners = {}
+        self.lock = threading.Lock()
+        self.closing = False
+        # [(process, events, job_slot)], None for workers that exited after close()
+        self.workers = [self.start_worker() for _ in range(worker_count)]
+        self.dispatcher = threading.Thread(target=self.dispatch_events, daemon=True)
+        self.dispatcher.start()
+        logging.getLogger(name=__name__).info('started %d workers', worker_count)
+
+    def start_worker(self):
+        events, worker_events = self.context.Pipe(duplex=False)
+        job_slot = self.context.Array('c', job_id_length, lock=False)
+        worker = self.context.Process(
+            target=worker_loop, args=(self.task_queue, worker_events, job_slot), daemon=True)
+        worker.start()
+        # only the worker writes to its pipe, so its end is closed here and reading gives EOF when it dies
+        worker_events.close()
+        return worker, events, job_slot
+
+    def submit(self, argv, cwd, on_event):
+        """Queue a job, on_event(event) is called from the dispatcher thread for each of its events."""
+        job_id = uuid.uuid4().hex[:12]
+        with self.lock:
+            self.listeners[job_id] = on_event
+        on_event({'event': 'accepted', 'job_id': job_id})
+        self.task_queue.put((job_id, list(argv), cwd))
+        return job_id
+
+    def dispatch_events(self, poll_seconds=1.0):
+        """Pass the events of every worker on to the listeners of their jobs and replace workers that die."""
+        log = logging.getLogger(name=__name__)
+        while True:
+            waiting = {}
+            for i, worker in enumerate(self.workers):
+                if worker is not None:
+                    waiting[worker[0].sentinel] = i
+                    waiting[worker[1]] = i
+            if len(waiting) == 0:
+                return
+            ready = multiprocessing.connection.wait(list(waiting), timeout=poll_seconds)
+            for i in sorted(set(waiting[r] for r in ready)):
+                worker, events, job_slot = self.workers[i]
+                try:
+                    while events.poll():
+                        job_id, event = events.recv()
+                        self.send_event(job_id, event)
+                except (EOFError, OSError):
+                    pass
+                if worker.is_alive():
+                    continue
+                # the events the worker sent before it exited have been passed on
+                events.close()
+                if self.closing:
+                    self.workers[i] = None
+                    continue
+                job_id = job_slot.value.decode('ascii')
+                log.warning('worker %d died with exit code %s%s', worker.pid, worker.exitcode,
+                            ' while running job {}'.format(job_id) if job_id else '')
+                if job_id:
+                    # ignored if the worker sent the job's final event just before it died
+                    self.send_event(job_id, {
+                        'event': 'failed',
+                        'message': 'worker {} died with exit code {}'.format(worker.pid, worker.exitcode),
+                    })
+                self.workers[i] = self.start_worker()
+
+    def send_event(self, job_id, event):
+        event['job_id'] = job_id
+        with self.lock:
+            on_event = self.listeners.get(job_id)
+            if event['event'] in final_events:
+                self.listeners.pop(job_id, None)
+        if on_event is not None:
+            try:
+                on_event(event)
+            except OSError:
+                # the client went away, the job keeps running
+                with self.lock:
+                    self.listeners.pop(job_id, None)
+
+    def serve_socket(self, socket_fp):
+        service = self
+
+        class JobHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = json.loads(self.rfile.readline().decode('utf-8'))
+                events = queue.Queue()
+                service.submit(request['args'], request.get('cwd', os.getcwd()), events.put)
+                while True:
+                    event = events.get()
+                    self.wfile.write((json.dumps(event) + '\n').encode('utf-8'))
+                    self.wfile.flush()
+                    if event['event'] in final_events:
+                        return
+
+        if os.path.exists(socket_fp):
+            os.remove(socket_fp)
+        server = socketserver.ThreadingUnixStreamServer(socket_fp, JobHandler)
+        server.daemon_threads = True
+        logging.getLogger(name=__name__).info('listening on "%s"', socket_fp)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(socket_fp)
+
+    def watch_spool_dir(self, spool_dir, poll_seconds=0.5):
+        log = logging.getLogger(name=__name__)
+        spool_dirs = {name: os.path.join(spool_dir, name) for name in ('incoming', 'running', 'done', 'failed', 'status')}
+        for dir_path in spool_dirs.values():
+            os.makedirs(dir_path, exist_ok=True)
+        log.info('watching "%s"', spool_dirs['incoming'])
+        while True:
+            for job_file_name in sorted(os.listdir(spool_dirs['incoming'])):
+                # writers should create jobs under another name and rename them to *.json
+                if not job_file_name.endswith('.json'):
+                    continue
+                running_fp = os.path.join(spool_dirs['running'], job_file_name)
+                try:
+                    os.rename(os.path.join(spool_dirs['incoming'], job_file_name), running_fp)
+                except OSError:
+                    # taken by another service watching the same directory
+                    continue
+                status_fp = os.path.join(spool_dirs['status'], os.path.splitext(job_file_name)[0] + '.jsonl')
+                spool_job = SpoolJob(running_fp, status_fp, spool_dirs)
+                try:
+                    with open(running_fp, 'rt') as job_file:
+                        request = json.load(job_file)
+                    if not isinstance(request.get('args'), list):
+                        raise ValueError('the job has no "args" list')
+                    self.submit(request['args'], request.get('cwd', spool_dir), spool_job.on_event)
+                except Exception as e:
+                    # a bad job file fails alone, the watcher goes on with the next one
+                    log.warning('job "%s" failed: %s', job_file_name, e)
+                    spool_job.on_event({'event': 'failed', 'message': 'invalid job file: {}: {}'.format(type(e).__name__, e)})
+            time.sleep(poll_seconds)
+
+    def close(self):
+        self.closing = True
+        workers = [worker[0] for worker in list(self.workers) if worker is not None]
+        for _ in workers:
+            self.task_queue.put(None)
+        for worker in workers:
+            worker.join(timeout=10)
+        self.dispatcher.join(timeout=10)
+
+
+class SpoolJob:
+    def __init__(self, running_fp, status_fp, spool_dirs):
+        self.running_fp = running_fp
+        self.status_fp = status_fp
+        self.spool_dirs = spool_dirs
+
+    def on_event(self, event):
+        with open(self.status_fp, 'at') as status_file:
+            status_file.write(json.dumps(event) + '\n')
+        if event['event'] in final_events:
+            os.rename(self.running_fp, os.path.join(self.spool_dirs[event['event']], os.path.basename(self.running_fp)))
+
+
+def submit(socket_fp, argv, on_event=None):
+    """Run a job on the service listening on socket_fp and return its final event."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_fp)
+        client.sendall((json.dumps({'args': list(argv), 'cwd': os.getcwd()}) + '\n').encode('utf-8'))
+        with client.makefile('rb') as replies:
+            for line in replies:
+                event = json.loads(line.decode('utf-8'))
+                if on_event is not None:
+                    on_event(event)
+                if event['event'] in final_events:
+                    return event
+    raise PipelineException('service on "{}" closed the connection before the job finished'.format(socket_fp))
+
+
+def print_event(event):
+    if event['event'] == 'log':
+        print('{}:{}:{}'.format(event['level'], event['logger'], event['message']), file=sys.stderr)
+    elif event['event'] == 'done':
+        print('done in {:.2f} s: {}'.format(event['seconds'], ', '.join(event['output_dirs'])))
+    elif event['event'] == 'failed':
+        print('failed: {}'.format(event['message']))
+    else:
+        print('{} {}'.format(event['event'], event['job_id']), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
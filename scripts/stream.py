@@ -0,0 +1,129 @@
+"""
+In-process demultiplexing for Python callers: reads go in as FASTQ paths or iterables of
+(header, seq, plus, qual) records and come out as (sample_id, batch) groups, without the step
+directories of the pipeline.
+
+    from stream import SampleBatchStream
+
+    stream = SampleBatchStream('mapping.txt', 12, 'R1.fastq.gz', reverse='R2.fastq.gz', index='I1.fastq.gz')
+    for sample_id, batch in stream:
+        ...  # batch is a list of records, or of (forward, reverse) record pairs with reverse
+    print(stream.counts)
+
+Barcodes are matched as the native split_libraries does. Without index reads the barcode is
+taken from the start of the forward reads and removed from both reads, as in step 01. A batch
+is yielded when a sample has batch_size reads, and the largest buffered samples are yielded
+early when more than max_buffered_reads are held, so memory stays bounded whatever the number
+of samples.
+"""
+import itertools
+
+from pipeline_util import *
+from demux import BarcodeMatcher
+from readahead import SynchronizedReader
+
+
+_missing = object()
+
+
+def iter_source_records(source):
+    if isinstance(source, str):
+        with open_fastq(source) as fastq_file:
+            yield from iter_fastq_records(fastq_file)
+    else:
+        yield from source
+
+
+def iter_aligned_records(sources):
+    """Tuples of the n-th record of every source, with their read IDs checked."""
+    if all(isinstance(source, str) for source in sources):
+        yield from SynchronizedReader(sources)
+        return
+    for records in itertools.zip_longest(*[iter_source_records(source) for source in sources], fillvalue=_missing):
+        if any(record is _missing for record in records):
+            raise PipelineException('read sources have different numbers of records')
+        read_id = get_read_id(records[0][0])
+        for record in records[1:]:
+            if get_read_id(record[0]) != read_id:
+                raise PipelineException('read IDs do not match: "{}" and "{}"'.format(records[0][0], record[0]))
+        yield records
+
+
+class SampleBatchStream:
+    def __init__(self, mapping_file, barcode_length, forward, reverse=None, index=None, index2=None,
+                 max_barcode_errors=0, barcode_offset=0, rev_comp_barcode=True, index2_length=None,
+                 rev_comp_index2=False, batch_size=1024, max_buffered_reads=2**18, include_unassigned=False):
+        self.mapping_file = mapping_file
+        self.barcode_length = barcode_length
+        self.forward = forward
+        self.reverse = reverse
+        self.index = index
+        self.index2 = index2
+        self.max_barcode_errors = max_barcode_errors
+        self.barcode_offset = barcode_offset
+        self.rev_comp_barcode = rev_comp_barcode
+        self.index2_length = index2_length or barcode_length
+        self.rev_comp_index2 = rev_comp_index2
+        self.batch_size = batch_size
+        self.max_buffered_reads = max_buffered_reads
+        self.include_unassigned = include_unassigned
+        self.counts = {'input': 0, 'unassigned': 0, 'index_hopped': 0, 'samples': {}}
+        if index2 is not None and index is None:
+            raise PipelineException('i5 reads (index2) need the i7 reads (index)')
+
+    def __iter__(self):
+        matcher = BarcodeMatcher(
+            self.mapping_file, self.max_barcode_errors, rev_comp_barcode=self.rev_comp_barcode,
+            dual_index=self.index2 is not None, rev_comp_index2=self.rev_comp_index2)
+        sources = [source for source in (self.forward, self.reverse, self.index, self.index2) if source is not None]
+        paired = self.reverse is not None
+        # without index reads the barcode is cut from the forward read
+        trim = 0 if self.index is not None else self.barcode_offset + self.barcode_length
+        barcode_source = 2 if paired else 1
+        barcode_start = self.barcode_offset
+        barcode_end = self.barcode_offset + self.barcode_length
+        buffers = {}
+        buffered_reads = 0
+
+        for records in iter_aligned_records(sources):
+            self.counts['input'] += 1
+            if self.index is None:
+                barcode = records[0][1][barcode_start:barcode_end]
+            else:
+                barcode = records[barcode_source][1][barcode_start:barcode_end]
+            index2 = None if self.index2 is None else records[-1][1][:self.index2_length]
+            match = matcher.match(barcode, index2)
+            sample_id = None if match is None else match[0]
+            if sample_id is None:
+                # counted apart from unknown barcodes, as in split_library_log.txt
+                index_hopped = matcher.get_index_hopped_count()
+                if index_hopped > self.counts['index_hopped']:
+                    self.counts['index_hopped'] = index_hopped
+                else:
+                    self.counts['unassigned'] += 1
+                if not self.include_unassigned:
+                    continue
+
+            if trim > 0:
+                reads = [(header, seq[trim:], plus, qual[trim:]) for header, seq, plus, qual in records[:1 + paired]]
+            else:
+                reads = records[:1 + paired]
+            buffer = buffers.setdefault(sample_id, [])
+            buffer.append(tuple(reads) if paired else reads[0])
+            buffered_reads += 1
+            if sample_id is not None:
+                self.counts['samples'][sample_id] = self.counts['samples'].get(sample_id, 0) + 1
+
+            if len(buffer) >= self.batch_size:
+                buffered_reads -= len(buffer)
+                yield sample_id, buffers.pop(sample_id)
+            elif buffered_reads >= self.max_buffered_reads:
+                # hand out the largest buffers until half of the reads are gone
+                for largest_id in sorted(buffers, key=lambda s: len(buffers[s]), reverse=True):
+                    if buffered_reads <= self.max_buffered_reads // 2:
+                        break
+                    buffered_reads -= len(buffers[largest_id])
+                    yield largest_id, buffers.pop(largest_id)
+
+        for sample_id in list(buffers):
+            yield sample_id, buffers.pop(sample_id)
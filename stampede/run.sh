@@ -146,17 +146,42 @@ fi
 echo "I will process NUM_INPUT \"$NUM_INPUT\" files"
 cat -n "$INPUT_FILES"
 
-#
-# Here is how to use LAUNCHER for parallelization
-#
-while read -r FILE; do
-    if [[ $PAIRED_DIR = "" ]]; then
-        singularity run "$IMG" -i '$FILE' -w '$WORK_DIR' -m '$MAPPING_FILE' -b '$BARCODE_LENGTH'
-    else
-        echo "$IMG"
-        singularity run "$IMG" -i "$FILE" -w "$WORK_DIR" -m "$MAPPING_FILE" -b "$BARCODE_LENGTH" -p "$PAIRED_DIR"
+PAIRED_ARGS=()
+if [[ $PAIRED_DIR != "" ]]; then
+    PAIRED_ARGS=(-p "$PAIRED_DIR")
+fi
+
+if [[ "${SLURM_NNODES:-1}" -gt 1 ]]; then
+    #
+    # Several nodes: one LAUNCHER task per file (or shard of a large file),
+    # then merge the task outputs into WORK_DIR
+    #
+    module load launcher
+    LAUNCHER_SCRIPT=/app/demultiplex_app/scripts/launcher.py
+    # tasks left by a job that did not finish are picked up where they stopped
+    if [[ ! -f "$WORK_DIR/launcher/tasks.json" ]]; then
+        singularity exec "$IMG" /miniconda/bin/python "$LAUNCHER_SCRIPT" prepare \
+            -i "$INPUT_DIR" -w "$WORK_DIR" ${PAIRED_ARGS[@]+"${PAIRED_ARGS[@]}"} --task-prefix "singularity exec $IMG" \
+            -- -m "$MAPPING_FILE" -b "$BARCODE_LENGTH"
     fi
-done < "$INPUT_FILES"
+
+    export LAUNCHER_PLUGIN_DIR="$TACC_LAUNCHER_DIR/plugins"
+    export LAUNCHER_WORKDIR="$PWD"
+    export LAUNCHER_RMI="SLURM"
+    export LAUNCHER_SCHED="interleaved"
+    export LAUNCHER_JOB_FILE="$WORK_DIR/launcher/tasks.txt"
+    echo "Starting Launcher"
+    "$TACC_LAUNCHER_DIR/paramrun"
+    echo "Ended LAUNCHER"
+
+    singularity exec "$IMG" /miniconda/bin/python "$LAUNCHER_SCRIPT" collect "$WORK_DIR"
+else
+    #
+    # One node: run the files at once, as many at a time as the node's cores and memory allow
+    #
+    singularity exec "$IMG" /miniconda/bin/python /app/demultiplex_app/scripts/scheduler.py \
+        -i "$INPUT_DIR" -w "$WORK_DIR" -- -m "$MAPPING_FILE" -b "$BARCODE_LENGTH" ${PAIRED_ARGS[@]+"${PAIRED_ARGS[@]}"}
+fi
 
 echo "Done."
 
@@ -0,0 +1,99 @@
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+
+scripts_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+sys.path.insert(0, scripts_dir)
+
+barcodes = {
+    'Sample1': 'ACGTACGTACGT',
+    'Sample2': 'TTTTGGGGCCCC',
+    'Sample3': 'AAAACCCCGGGG',
+}
+
+
+dual_index_pairs = {
+    'Sample1': ('ACGTACGT', 'TTGGCCAA'),
+    'Sample2': ('TTTTGGGG', 'CCAATTGG'),
+}
+
+
+def reverse_complement(seq):
+    return seq[::-1].translate(str.maketrans('ACGT', 'TGCA'))
+
+
+def run_script(script_name, *args, **kwargs):
+    return subprocess.run(
+        [sys.executable, os.path.join(scripts_dir, script_name)] + [str(arg) for arg in args],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, **kwargs)
+
+
+def read_fastq(fastq_fp):
+    with open(fastq_fp, 'rt') as fastq_file:
+        lines = fastq_file.read().splitlines()
+    return [tuple(lines[i:i + 4]) for i in range(0, len(lines), 4)]
+
+
+@pytest.fixture
+def index_run(tmp_path):
+    """Mapping file and R1, R2 and I1 files of an index run, 1 read in 10 with an unknown index."""
+    def make_run(read_count=3000, seed=1):
+        rng = random.Random(seed)
+        run_dir = tmp_path / 'run'
+        run_dir.mkdir()
+        mapping_fp = run_dir / 'map.txt'
+        with open(mapping_fp, 'wt') as mapping_file:
+            mapping_file.write('#SampleID\tBarcodeSequence\tLinkerPrimerSequence\tDescription\n')
+            for sample_id, barcode in sorted(barcodes.items()):
+                mapping_file.write('{}\t{}\tAAA\tx\n'.format(sample_id, barcode))
+        fps = {name: run_dir / 'run1_{}.fastq'.format(name) for name in ('R1', 'R2', 'I1')}
+        files = {name: open(fp, 'wt') for name, fp in fps.items()}
+        for i in range(read_count):
+            if i % 10 == 9:
+                index = ''.join(rng.choice('ACGT') for _ in range(12))
+            else:
+                index = reverse_complement(rng.choice(sorted(barcodes.values())))
+            read_id = 'M001:1:FC:1:1101:{}:{}'.format(i // 1000, i)
+            for name, number, seq in (
+                    ('R1', 1, ''.join(rng.choice('ACGT') for _ in range(100))),
+                    ('R2', 2, ''.join(rng.choice('ACGT') for _ in range(100))),
+                    ('I1', 1, index)):
+                files[name].write('@{} {}:N:0:1\n{}\n+\n{}\n'.format(read_id, number, seq, 'I' * len(seq)))
+        for f in files.values():
+            f.close()
+        return mapping_fp, fps
+    return make_run
+
+
+def write_dual_index_run(run_dir, read_count=400, seed=0):
+    """Mapping file and R1, I1 and I2 files of a dual indexed run, 1 read in 4 with an unknown i7."""
+    rng = random.Random(seed)
+    mapping_fp = run_dir / 'map.txt'
+    with open(mapping_fp, 'wt') as mapping_file:
+        mapping_file.write('#SampleID\tBarcodeSequence\tIndex2Sequence\tLinkerPrimerSequence\tDescription\n')
+        for sample_id, (i7, i5) in sorted(dual_index_pairs.items()):
+            mapping_file.write('{}\t{}\t{}\tAAA\tx\n'.format(sample_id, i7, i5))
+    fps = {name: run_dir / 'run1_{}.fastq'.format(name) for name in ('R1', 'I1', 'I2')}
+    files = {name: open(fp, 'wt') for name, fp in fps.items()}
+    i7_list = sorted(i7 for i7, _ in dual_index_pairs.values())
+    i5_list = sorted(i5 for _, i5 in dual_index_pairs.values())
+    for i in range(read_count):
+        kind = i % 4
+        if kind == 3:
+            # an unknown i7
+            i7, i5 = 'GAGAGAGA', rng.choice(i5_list)
+        else:
+            # known pairs and, at random, hopped ones
+            i7, i5 = rng.choice(i7_list), rng.choice(i5_list)
+        for name, seq in (
+                ('R1', ''.join(rng.choice('ACGT') for _ in range(50))),
+                ('I1', reverse_complement(i7)),
+                ('I2', i5)):
+            files[name].write('@M001:{} 1:N:0:1\n{}\n+\n{}\n'.format(i, seq, 'I' * len(seq)))
+    for f in files.values():
+        f.close()
+    return mapping_fp, fps
@@ -0,0 +1,124 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from append_runs import SampleAppender, append_fastq
+from conftest import read_fastq, run_script
+from record_index import build_index, get_index_fp, read_records
+
+
+def write_records(fastq_fp, first, count, index_every=0):
+    with open(fastq_fp, 'wt') as fastq_file:
+        for n in range(first, first + count):
+            seq = 'ACGT' * (n % 5 + 1)
+            fastq_file.write('@read{}\n{}\n+\n{}\n'.format(n, seq, 'I' * len(seq)))
+    if index_every > 0:
+        build_index(fastq_fp, every=index_every)
+
+
+def read_bytes(fp):
+    with open(fp, 'rb') as f:
+        return f.read()
+
+
+def assert_index_is_current(fastq_fp, every):
+    # the index extended in place is the one built from the whole file
+    expected_fp = fastq_fp + '.expected'
+    shutil.copyfile(fastq_fp, expected_fp)
+    build_index(expected_fp, every=every)
+    assert read_bytes(get_index_fp(fastq_fp)) == read_bytes(get_index_fp(expected_fp))
+
+
+@pytest.mark.parametrize('existing_records', [8, 5])
+def test_append_extends_the_index(tmp_path, existing_records):
+    # 8 records: the input's own index is shifted, 5: the appended records are indexed again
+    output_fp = str(tmp_path / 'Sample1.fastq')
+    input_fp = str(tmp_path / 'run2_Sample1.fastq')
+    write_records(output_fp, 0, existing_records, index_every=4)
+    write_records(input_fp, existing_records, 7, index_every=4)
+    assert append_fastq(input_fp, output_fp, index_every=4) == 7
+    assert [record.split('\n')[0] for record in read_records(output_fp, 0, 100)] == [
+        '@read{}'.format(n) for n in range(existing_records + 7)]
+    assert_index_is_current(output_fp, 4)
+
+
+def test_new_file_without_index(tmp_path):
+    output_fp = str(tmp_path / 'Sample1.fastq')
+    input_fp = str(tmp_path / 'run1_Sample1.fastq')
+    write_records(input_fp, 0, 3)
+    assert append_fastq(input_fp, output_fp) == 3
+    assert not os.path.exists(get_index_fp(output_fp))
+    assert read_bytes(output_fp) == read_bytes(input_fp)
+
+
+def make_project(tmp_path):
+    """A project with one run appended: Sample1 with 8 records, indexed every 4."""
+    final_dir = tmp_path / 'final'
+    final_dir.mkdir()
+    write_records(str(final_dir / 'run1_Sample1.fastq'), 0, 8, index_every=4)
+    appender = SampleAppender(str(tmp_path / 'work'))
+    appender.append_run('hash1', 'run1', str(final_dir), 'run1', index_every=4)
+    return appender
+
+
+def test_interrupted_append_is_rolled_back(tmp_path):
+    appender = make_project(tmp_path)
+    sample_fp = os.path.join(appender.samples_dir, 'Sample1.fastq')
+    committed = read_bytes(sample_fp)
+    committed_index = read_bytes(get_index_fp(sample_fp))
+
+    # an append killed after its records and index were written but before runs.json was saved
+    input_fp = str(tmp_path / 'run2_Sample1.fastq')
+    write_records(input_fp, 8, 6, index_every=4)
+    append_fastq(input_fp, sample_fp, index_every=4)
+    # and a new sample file it had started
+    write_records(os.path.join(appender.samples_dir, 'Sample2.fastq'), 0, 2, index_every=4)
+
+    appender.roll_back(appender.load_state())
+    assert read_bytes(sample_fp) == committed
+    assert read_bytes(get_index_fp(sample_fp)) == committed_index
+    assert sorted(os.listdir(appender.samples_dir)) == ['.lock', 'Sample1.fastq', 'Sample1.fastq.idx', 'runs.json']
+
+
+def test_append_killed_before_the_index_header_is_rewritten(tmp_path):
+    appender = make_project(tmp_path)
+    sample_fp = os.path.join(appender.samples_dir, 'Sample1.fastq')
+    committed = read_bytes(sample_fp)
+    committed_index = read_bytes(get_index_fp(sample_fp))
+    with open(sample_fp, 'ab') as sample_file:
+        sample_file.write(b'@read8\nACGT\n+\nIIII\n@rea')
+
+    appender.roll_back(appender.load_state())
+    assert read_bytes(sample_fp) == committed
+    assert read_bytes(get_index_fp(sample_fp)) == committed_index
+
+    # the next append goes on from the committed records
+    final_dir = tmp_path / 'final2'
+    final_dir.mkdir()
+    write_records(str(final_dir / 'run2_Sample1.fastq'), 8, 5, index_every=4)
+    run = appender.append_run('hash2', 'run2', str(final_dir), 'run2', index_every=4)
+    assert run['samples'] == {'Sample1': 5}
+    assert [header for header, _, _, _ in read_fastq(sample_fp)] == ['@read{}'.format(n) for n in range(13)]
+    assert_index_is_current(sample_fp, 4)
+    with open(appender.runs_fp, 'rt') as runs_file:
+        assert json.load(runs_file)['samples'] == {'Sample1': 13}
+
+
+def test_pipeline_appends_each_input_once(index_run, tmp_path):
+    mapping_fp, fps = index_run(read_count=300)
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    for _ in range(2):
+        result = run_script(
+            'pipeline.py', '-i', fps['R1'], '-d', fps['I1'], '-m', mapping_fp, '-b', 12, '-w', work_dir,
+            '--backend', 'native', '--append')
+        assert result.returncode == 0, result.stderr
+    assert 'nothing to do' in result.stderr
+    state = SampleAppender(str(work_dir)).load_state()
+    assert len(state['runs']) == 1
+    # 1 read in 10 has an unknown index
+    assert sum(state['samples'].values()) == 270
+    for sample_name, count in state['samples'].items():
+        assert len(read_fastq(work_dir / 'samples' / (sample_name + '.fastq'))) == count
@@ -0,0 +1,49 @@
+import pytest
+
+from backends import get_backend
+from compare_backends import compare_read_ids, get_per_sample_read_ids
+from conftest import barcodes, read_fastq, reverse_complement, run_script
+from pipeline_util import PipelineException, get_read_id
+
+
+def get_expected_read_ids(index_fp):
+    sample_ids = {reverse_complement(barcode): sample_id for sample_id, barcode in barcodes.items()}
+    expected = {}
+    for header, seq, _, _ in read_fastq(index_fp):
+        if seq in sample_ids:
+            expected.setdefault('run1_R1_{}.fastq'.format(sample_ids[seq]), set()).add(get_read_id(header))
+    return expected
+
+
+def test_native_backend_assigns_reads_by_their_index(index_run, tmp_path):
+    mapping_fp, fps = index_run(read_count=500)
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    result = run_script(
+        'pipeline.py', '-i', fps['R1'], '-d', fps['I1'], '-m', mapping_fp, '-b', 12, '-w', work_dir,
+        '--backend', 'native')
+    assert result.returncode == 0, result.stderr
+    read_ids = get_per_sample_read_ids(str(work_dir / 'step_03_demultiplex' / 'run1_R1'))
+    assert compare_read_ids(get_expected_read_ids(fps['I1']), read_ids) == {}
+
+
+def test_compare_read_ids():
+    reference = {'A.fastq': {'r1', 'r2'}, 'B.fastq': {'r3'}}
+    other = {'A.fastq': {'r1', 'r2'}, 'B.fastq': {'r3', 'r4'}, 'C.fastq': {'r5'}}
+    differences = compare_read_ids(reference, other)
+    assert sorted(differences) == ['B.fastq', 'C.fastq']
+    assert differences['B.fastq']['only_in_other'] == 1
+    assert differences['C.fastq']['reference_count'] == 0
+
+
+def test_unknown_backend():
+    with pytest.raises(PipelineException, match='unknown backend'):
+        get_backend('vsearch', mapping_file='map.txt', barcode_length=12, max_barcode_errors=1.5)
+
+
+def test_qiime_backend_rejects_native_only_options(tmp_path):
+    backend = get_backend('qiime', mapping_file='map.txt', barcode_length=12, max_barcode_errors=1.5)
+    with pytest.raises(PipelineException, match='native backend'):
+        backend.split_libraries(['R1.fastq'], ['I1.fastq'], str(tmp_path), barcode_offset=2)
+    with pytest.raises(PipelineException, match='native backend'):
+        backend.split_sequence_file_on_sample_ids('seqs.fastq', str(tmp_path), dereplicate_minuniquesize=2)
@@ -0,0 +1,38 @@
+import random
+
+from buffered_writer import BufferedSampleWriter
+from record_index import read_records
+
+
+def test_buffers_stay_within_the_budget(tmp_path):
+    rng = random.Random(0)
+    memory_budget = 2**14
+    expected = {}
+    peak_buffered_bytes = 0
+    with BufferedSampleWriter(memory_budget=memory_budget, index_every=4) as writer:
+        for n in range(2000):
+            output_fp = str(tmp_path / 'Sample{}.fastq'.format(rng.randrange(20)))
+            seq = ''.join(rng.choice('ACGT') for _ in range(rng.randint(20, 60)))
+            record = '@read{}\n{}\n+\n{}\n'.format(n, seq, 'I' * len(seq))
+            writer.write(output_fp, record)
+            expected.setdefault(output_fp, []).append(record)
+            peak_buffered_bytes = max(peak_buffered_bytes, writer.buffered_bytes)
+    counters = writer.get_counters()
+
+    assert peak_buffered_bytes < memory_budget
+    assert counters['budget_flushes'] > 0
+    assert counters['files'] == len(expected)
+    assert counters['flushed_bytes'] == sum(len(record) for records in expected.values() for record in records)
+    for output_fp, records in expected.items():
+        with open(output_fp, 'rt') as output_file:
+            assert output_file.read() == ''.join(records)
+        # the index written along with the file points at the same records
+        assert read_records(output_fp, 5, 3) == records[5:8]
+
+
+def test_a_file_with_no_records_is_still_created(tmp_path):
+    output_fp = str(tmp_path / 'Sample1.fastq')
+    with BufferedSampleWriter() as writer:
+        writer.write(output_fp, '')
+    with open(output_fp, 'rt') as output_file:
+        assert output_file.read() == ''
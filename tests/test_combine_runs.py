@@ -0,0 +1,50 @@
+import gzip
+
+import pytest
+
+from conftest import run_script
+from pipeline_util import PipelineException, concatenate_files
+
+
+def write_runs(tmp_path):
+    contents = [
+        '@r{0}\nACGT\n+\nIIII\n'.format(n) * 1000
+        for n
+        in range(3)
+    ]
+    fps = []
+    for n, content in enumerate(contents[:2], start=3):
+        fp = tmp_path / 'Mock_Run{}_V4.fastq.gz'.format(n)
+        with gzip.open(str(fp), 'wt') as run_file:
+            run_file.write(content)
+        fps.append(fp)
+    plain_fp = tmp_path / 'plain.fastq'
+    plain_fp.write_text(contents[2])
+    return fps, plain_fp, contents
+
+
+def test_gzip_members_are_copied_without_recompressing(tmp_path):
+    (run3_fp, run4_fp), plain_fp, contents = write_runs(tmp_path)
+    output_dir = tmp_path / 'combined'
+    output_dir.mkdir()
+    result = run_script('combine_runs.py', '-o', output_dir, run4_fp, run3_fp)
+    assert result.returncode == 0, result.stderr
+    combined_fp = output_dir / 'Mock_Run3_Run4_V4.fastq.gz'
+    # the inputs are combined in name order, byte for byte
+    assert combined_fp.read_bytes() == run3_fp.read_bytes() + run4_fp.read_bytes()
+    with gzip.open(str(combined_fp), 'rt') as combined_file:
+        assert combined_file.read() == contents[0] + contents[1]
+
+
+def test_uncompressed_input_becomes_a_new_member(tmp_path):
+    (run3_fp, _), plain_fp, contents = write_runs(tmp_path)
+    output_fp = str(tmp_path / 'combined.fastq.gz')
+    concatenate_files([str(run3_fp), str(plain_fp)], output_fp)
+    with gzip.open(output_fp, 'rt') as combined_file:
+        assert combined_file.read() == contents[0] + contents[2]
+
+
+def test_compressed_input_into_uncompressed_output(tmp_path):
+    (run3_fp, _), plain_fp, _ = write_runs(tmp_path)
+    with pytest.raises(PipelineException, match='cannot concatenate compressed'):
+        concatenate_files([str(plain_fp), str(run3_fp)], str(tmp_path / 'combined.fastq'))
@@ -0,0 +1,107 @@
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+misc_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'misc')
+spec = importlib.util.spec_from_file_location('copy_from_manifest', os.path.join(misc_dir, 'copy_from_manifest.py'))
+copy_from_manifest = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(copy_from_manifest)
+
+# stands in for files-upload: records the files of the temp tree it is given, or fails
+fake_upload = '''
+import json, os, sys
+src, dest, log_fp = sys.argv[1:4]
+if os.path.exists(log_fp + '.fail'):
+    sys.exit(1)
+uploaded = sorted(
+    os.path.relpath(os.path.join(root, name), src) for root, _, names in os.walk(src) for name in names)
+with open(log_fp, 'a') as log_file:
+    log_file.write(json.dumps({'dest': dest, 'files': uploaded}) + '\\n')
+'''
+
+
+@pytest.fixture
+def app(tmp_path):
+    work_dir = tmp_path / 'work'
+    in_dir = work_dir / 'apps' / 'demux-0.1'
+    (in_dir / 'bin').mkdir(parents=True)
+    (in_dir / 'app.json').write_text('{}')
+    (in_dir / 'bin' / 'run.sh').write_text('#!/bin/bash\n')
+    (in_dir / 'notes.txt').write_text('not listed')
+    (in_dir / 'MANIFEST').write_text('./app.json\n./bin/run.sh\n')
+    upload_fp = tmp_path / 'fake_upload.py'
+    upload_fp.write_text(fake_upload)
+    log_fp = tmp_path / 'uploads.jsonl'
+
+    def upload(*args):
+        result = subprocess.run(
+            [sys.executable, os.path.join(misc_dir, 'copy_from_manifest.py'), str(in_dir),
+             '--upload-cmd', '{} {} {{src}} {{dest}} {}'.format(sys.executable, upload_fp, log_fp)] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+            env=dict(os.environ, WORK=str(work_dir)))
+        uploads = []
+        if log_fp.exists():
+            uploads = [json.loads(line) for line in log_fp.read_text().splitlines()]
+            log_fp.unlink()
+        return result, uploads
+    upload.in_dir = in_dir
+    upload.log_fp = log_fp
+    return upload
+
+
+def test_only_changed_files_are_uploaded(app):
+    result, uploads = app()
+    assert result.returncode == 0, result.stdout
+    assert uploads == [{'dest': 'kyclark/applications/apps', 'files': ['app.json', 'bin/run.sh']}]
+    assert (app.in_dir / '.copy_from_manifest.json').exists()
+
+    result, uploads = app()
+    assert 'Nothing to upload' in result.stdout
+    assert uploads == []
+
+    (app.in_dir / 'app.json').write_text('{"name": "demux"}')
+    result, uploads = app('--dest', 'somewhere/else')
+    assert uploads == [{'dest': 'somewhere/else', 'files': ['app.json']}]
+
+
+def test_touched_files_are_skipped_with_hash(app):
+    app('--hash')
+    stat = os.stat(app.in_dir / 'bin' / 'run.sh')
+    os.utime(app.in_dir / 'bin' / 'run.sh', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    result, uploads = app('--hash')
+    assert 'Nothing to upload' in result.stdout
+    assert uploads == []
+
+
+def test_failed_upload_is_tried_again(app):
+    app.log_fp.with_name(app.log_fp.name + '.fail').write_text('')
+    result, uploads = app()
+    assert result.returncode == 1
+    assert 'state not saved' in result.stdout
+    assert not (app.in_dir / '.copy_from_manifest.json').exists()
+
+    app.log_fp.with_name(app.log_fp.name + '.fail').unlink()
+    result, uploads = app()
+    assert result.returncode == 0
+    assert uploads[0]['files'] == ['app.json', 'bin/run.sh']
+
+
+def test_stage_file_falls_back_to_copy(tmp_path, monkeypatch):
+    source_fp = tmp_path / 'source.txt'
+    source_fp.write_text('reads')
+    assert copy_from_manifest.stage_file(str(source_fp), str(tmp_path / 'staged' / 'linked.txt')) == 'hardlink'
+    assert os.path.samefile(source_fp, tmp_path / 'staged' / 'linked.txt')
+
+    def fail(*args):
+        raise OSError('not supported')
+    monkeypatch.setattr(copy_from_manifest.os, 'link', fail)
+    monkeypatch.setattr(copy_from_manifest.fcntl, 'ioctl', fail)
+    staged_fp = tmp_path / 'staged' / 'copied.txt'
+    assert copy_from_manifest.stage_file(str(source_fp), str(staged_fp)) == 'copy'
+    assert staged_fp.read_text() == 'reads'
+    assert not os.path.samefile(source_fp, staged_fp)
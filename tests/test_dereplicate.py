@@ -0,0 +1,47 @@
+import os
+import random
+
+from dereplicate import Dereplicator, SampleDereplicators
+
+
+def test_samples_share_one_memory_budget(tmp_path):
+    rng = random.Random(0)
+    sample_ids = ['Sample{}'.format(n) for n in range(200)]
+    memory_budget = 2**16
+    dereplicators = SampleDereplicators(memory_budget=memory_budget, spill_dir=str(tmp_path))
+    expected = {sample_id: Dereplicator() for sample_id in sample_ids}
+    peak_memory_used = 0
+    for _ in range(20000):
+        sample_id = rng.choice(sample_ids)
+        seq = ''.join(rng.choice('ACGT') for _ in range(6))
+        dereplicators.add(sample_id, seq)
+        expected[sample_id].add(seq)
+        peak_memory_used = max(peak_memory_used, sum(d.memory_used for _, d in dereplicators.items()))
+
+    assert dereplicators.budget_spill_count > 0
+    # one unique sequence over the budget at most
+    assert peak_memory_used <= memory_budget + 200
+    for sample_id, dereplicator in dereplicators.items():
+        assert list(dereplicator.get_sorted_uniques()) == list(expected[sample_id].get_sorted_uniques())
+
+
+def test_spilled_partitions_are_merged_in_abundance_order(tmp_path):
+    rng = random.Random(1)
+    seqs = [''.join(rng.choice('ACGTN') for _ in range(rng.randint(4, 8))) for _ in range(5000)]
+    in_memory = Dereplicator()
+    spilled = Dereplicator(memory_budget=2**12, spill_dir=str(tmp_path))
+    for seq in seqs:
+        in_memory.add(seq)
+        spilled.add(seq)
+    assert spilled.spill_count > 1
+
+    output_fp = str(tmp_path / 'uniques.fasta')
+    unique_count = spilled.write_fasta(output_fp, minuniquesize=2)
+    expected = list(in_memory.get_sorted_uniques(minuniquesize=2))
+    assert unique_count == len(expected)
+    with open(output_fp, 'rt') as output_file:
+        lines = output_file.read().splitlines()
+    assert lines[0::2] == ['>Uniq{};size={};'.format(n, count) for n, (_, count) in enumerate(expected, start=1)]
+    assert lines[1::2] == [seq for seq, _ in expected]
+    # the partition and sorted files are removed once they are merged
+    assert os.listdir(str(tmp_path)) == ['uniques.fasta']
@@ -0,0 +1,53 @@
+import json
+import random
+
+import pytest
+
+from conftest import barcodes, run_script
+from detect_barcodes import detect_barcode_layout
+from pipeline_util import PipelineException
+
+
+def write_barcoded_reads(fastq_fp, offset, read_count=500, seed=0):
+    # forward orientation barcodes after `offset` random bases
+    rng = random.Random(seed)
+    with open(fastq_fp, 'wt') as fastq_file:
+        for n in range(read_count):
+            seq = ''.join(rng.choice('ACGT') for _ in range(offset))
+            seq += rng.choice(sorted(barcodes.values()))
+            seq += ''.join(rng.choice('ACGT') for _ in range(80))
+            fastq_file.write('@read{}\n{}\n+\n{}\n'.format(n, seq, 'I' * len(seq)))
+
+
+def test_reverse_complemented_index_reads(index_run):
+    mapping_fp, fps = index_run(read_count=1000)
+    layout = detect_barcode_layout(str(fps['I1']), str(mapping_fp), 12)
+    assert (layout['rev_comp_barcode'], layout['barcode_offset']) == (True, 0)
+    # 1 read in 10 has an unknown index
+    assert layout['match_rate'] == pytest.approx(0.9, abs=0.01)
+    assert layout['sampled_reads'] == 1000
+
+
+def test_forward_barcodes_after_an_offset(index_run, tmp_path):
+    mapping_fp, _ = index_run(read_count=10)
+    fastq_fp = str(tmp_path / 'offset.fastq')
+    write_barcoded_reads(fastq_fp, offset=3)
+    layout = detect_barcode_layout(fastq_fp, str(mapping_fp), 12, sample_size=200)
+    assert (layout['rev_comp_barcode'], layout['barcode_offset'], layout['match_rate']) == (False, 3, 1.0)
+    assert layout['sampled_reads'] == 200
+    # a barcode past max_offset is not looked for
+    with pytest.raises(PipelineException, match='no mapping file barcode'):
+        detect_barcode_layout(fastq_fp, str(mapping_fp), 12, max_offset=2)
+
+
+def test_pipeline_keeps_the_detected_layout(index_run, tmp_path):
+    mapping_fp, fps = index_run(read_count=300)
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    result = run_script(
+        'pipeline.py', '-i', fps['R1'], '-d', fps['I1'], '-m', mapping_fp, '-b', 12, '-w', work_dir,
+        '--backend', 'native', '--detect-barcodes')
+    assert result.returncode == 0, result.stderr
+    with open(str(work_dir / 'step_00_detect_barcodes' / 'run1_R1' / 'barcode_layout.json'), 'rt') as layout_file:
+        layout = json.load(layout_file)
+    assert (layout['rev_comp_barcode'], layout['barcode_offset']) == (True, 0)
@@ -0,0 +1,58 @@
+import pytest
+
+from conftest import dual_index_pairs, reverse_complement, run_script, write_dual_index_run
+from demux import BarcodeMatcher
+from ledger import ReadLedger
+from pipeline_util import PipelineException, get_mapping_index_pairs
+
+
+def test_hopped_pairs_are_counted_apart(tmp_path):
+    mapping_fp, _ = write_dual_index_run(tmp_path, read_count=4)
+    matcher = BarcodeMatcher(str(mapping_fp), max_barcode_errors=1, dual_index=True)
+    (i7_1, i5_1), (i7_2, i5_2) = dual_index_pairs['Sample1'], dual_index_pairs['Sample2']
+    assert matcher.match(reverse_complement(i7_1), i5_1)[0] == 'Sample1'
+    # one substitution in each index is corrected
+    sample_id, _, corrected, diffs = matcher.match(reverse_complement('A' + i7_2[1:]), i5_2[:-1] + 'A')
+    assert (sample_id, corrected, diffs) == ('Sample2', i7_2 + i5_2, 2)
+    # both indexes are known but are not a pair in the mapping file
+    assert matcher.match(reverse_complement(i7_1), i5_2) is None
+    assert matcher.match(reverse_complement(i7_1), i5_2) is None
+    assert matcher.match(reverse_complement('GAGAGAGA'), i5_1) is None
+    assert matcher.hopped_counts == {(i7_1, i5_2): 2}
+
+
+def test_mapping_file_index_pairs(tmp_path):
+    mapping_fp = tmp_path / 'map.txt'
+    mapping_fp.write_text(
+        '#SampleID\tBarcodeSequence\tIndex2Sequence\tDescription\n'
+        'Sample1\tACGTACGT\tTTGGCCAA\tx\n'
+        'Sample2\tACGTACGT\tCCAATTGG\tx\n')
+    assert get_mapping_index_pairs(str(mapping_fp)) == {
+        ('ACGTACGT', 'TTGGCCAA'): 'Sample1', ('ACGTACGT', 'CCAATTGG'): 'Sample2'}
+    mapping_fp.write_text(
+        '#SampleID\tBarcodeSequence\tIndex2Sequence\tDescription\n'
+        'Sample1\tACGTACGT\tTTGGCCAA\tx\n'
+        'Sample2\tacgtacgt\tttggccaa\tx\n')
+    with pytest.raises(PipelineException, match='same index pair'):
+        get_mapping_index_pairs(str(mapping_fp))
+    mapping_fp.write_text('#SampleID\tBarcodeSequence\tDescription\nSample1\tACGTACGT\tx\n')
+    with pytest.raises(PipelineException, match='no "Index2Sequence" column'):
+        get_mapping_index_pairs(str(mapping_fp))
+
+
+def test_pipeline_reports_index_hopping(tmp_path):
+    mapping_fp, fps = write_dual_index_run(tmp_path)
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    result = run_script(
+        'pipeline.py', '-i', fps['R1'], '-d', fps['I1'], '--index2-file', fps['I2'], '-m', mapping_fp, '-b', 8,
+        '-w', work_dir, '--backend', 'native')
+    assert result.returncode == 0, result.stderr
+    with open(str(work_dir / 'step_02_split_libraries' / 'run1_R1' / 'run1_R1_index_hopping.txt'), 'rt') as report_file:
+        report = report_file.read().splitlines()
+    hopped_count = int(report[2].rsplit(': ', 1)[1])
+    assert hopped_count > 0
+    assert sum(int(line.split('\t')[2]) for line in report[6:]) == hopped_count
+    # hopped reads are unassigned in the ledger
+    split_libraries_counts = ReadLedger(str(work_dir), 'run1_R1').steps['step_02_split_libraries']
+    assert split_libraries_counts['unassigned'] == 100 + hopped_count
@@ -0,0 +1,36 @@
+import pytest
+
+from demux import split_libraries
+from index_cache import get_index_cache
+from pipeline_util import PipelineException
+
+
+def test_reads_past_the_end_of_the_cache(index_run, tmp_path):
+    mapping_fp, fps = index_run(read_count=300)
+    # an index file that lost its last 100 records
+    short_index_fp = tmp_path / 'run1_I1_short.fastq'
+    with open(fps['I1'], 'rt') as index_file, open(short_index_fp, 'wt') as short_index_file:
+        short_index_file.writelines(index_file.readlines()[:4 * 200])
+    cache = get_index_cache(str(short_index_fp), str(tmp_path / 'work'), 12)
+    output_dir = tmp_path / 'split'
+    output_dir.mkdir()
+    with pytest.raises(PipelineException, match='past the 200 records'):
+        split_libraries(
+            [str(fps['R1'])], [str(short_index_fp)], str(output_dir), str(mapping_fp), 12,
+            index_caches={str(short_index_fp): cache})
+    cache.close()
+
+
+def test_index_files_with_the_same_name_get_their_own_caches(tmp_path):
+    work_dir = str(tmp_path / 'work')
+    caches = []
+    for run_name, barcode in (('run1', 'ACGTACGTACGT'), ('run2', 'TTTTGGGGCCCC')):
+        run_dir = tmp_path / run_name
+        run_dir.mkdir()
+        index_fp = run_dir / 'Undetermined_I1.fastq'
+        index_fp.write_text('@read1 1:N:0:1\n{}\n+\n{}\n'.format(barcode, 'I' * len(barcode)))
+        caches.append(get_index_cache(str(index_fp), work_dir, 12))
+    assert caches[0].cache_fp != caches[1].cache_fp
+    assert [cache.get_barcode(0) for cache in caches] == ['ACGTACGTACGT', 'TTTTGGGGCCCC']
+    for cache in caches:
+        cache.close()
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from conftest import read_fastq, run_script
+from launcher import merge_counts
+
+
+def run_whole_and_sharded(tmp_path, fps, mapping_fp, input_args, extra_pipeline_args):
+    input_dir = tmp_path / 'input'
+    input_dir.mkdir()
+    os.symlink(str(fps['R1']), str(input_dir / 'run1_R1.fastq'))
+    pipeline_args = ['-m', mapping_fp, '-b', 12, '--backend', 'native'] + extra_pipeline_args
+
+    whole_dir = tmp_path / 'whole'
+    whole_dir.mkdir()
+    result = run_script('pipeline.py', '-i', fps['R1'], '-w', whole_dir, *(input_args + pipeline_args))
+    assert result.returncode == 0, result.stderr
+
+    sharded_dir = tmp_path / 'sharded'
+    result = run_script(
+        'launcher.py', 'local', '-i', input_dir, '-w', sharded_dir, '--shard-mb', 0.2, '--workers', 2,
+        *(input_args + ['--'] + pipeline_args))
+    assert result.returncode == 0, result.stderr
+    # the input is split into several shards
+    assert 'collected 1 tasks' not in result.stderr
+    return whole_dir, sharded_dir
+
+
+@pytest.mark.parametrize('lean_args', [[], ['--lean']])
+def test_sharded_single_end_run_matches_whole_run(index_run, tmp_path, lean_args):
+    mapping_fp, fps = index_run(read_count=3000)
+    whole_dir, sharded_dir = run_whole_and_sharded(tmp_path, fps, mapping_fp, ['-d', fps['I1']], lean_args)
+
+    whole_final_dir = whole_dir / 'step_03_demultiplex' / 'run1_R1'
+    sharded_final_dir = sharded_dir / 'step_03_demultiplex' / 'run1_R1'
+    sample_file_names = sorted(name for name in os.listdir(whole_final_dir) if name.endswith('.fastq'))
+    assert len(sample_file_names) == 3
+    for name in sample_file_names:
+        whole_records = read_fastq(whole_final_dir / name)
+        sharded_records = read_fastq(sharded_final_dir / name)
+        labels = [record[0].split()[0] for record in sharded_records]
+        assert len(set(labels)) == len(labels)
+        assert sharded_records == whole_records
+        with open(whole_final_dir / (name + '.idx'), 'rb') as whole_index, \
+                open(sharded_final_dir / (name + '.idx'), 'rb') as sharded_index:
+            assert sharded_index.read() == whole_index.read()
+
+
+def test_merge_counts_keeps_peaks():
+    shards = [
+        {'seconds': 2.0, 'rchar': 100, 'max_rss_kb': 500, 'peak_rss_kb': 700, 'exit_code': 0, 'command': 'demux'},
+        {'seconds': 3.0, 'rchar': 50, 'max_rss_kb': 900, 'peak_rss_kb': 600, 'exit_code': -9, 'command': 'demux'},
+        {'seconds': 1.0, 'rchar': 25, 'max_rss_kb': 100, 'peak_rss_kb': 100, 'exit_code': 1, 'command': 'demux'},
+    ]
+    total = {}
+    for shard in shards:
+        merge_counts(total, {'step_02_split_libraries': shard})
+    assert total == {'step_02_split_libraries': {
+        'seconds': 6.0, 'rchar': 175, 'max_rss_kb': 900, 'peak_rss_kb': 700, 'exit_code': -9, 'command': 'demux'}}
@@ -0,0 +1,52 @@
+import os
+
+from conftest import read_fastq, run_script
+from io_audit import IOAudit
+
+
+def run_pipeline(fps, mapping_fp, work_dir, *extra_args):
+    work_dir.mkdir()
+    return run_script(
+        'pipeline.py', '-i', fps['R1'], '-p', fps['R2'], '-d', fps['I1'], '-m', mapping_fp, '-b', 12,
+        '-w', work_dir, '--backend', 'native', *extra_args)
+
+
+def test_lean_run_writes_only_the_final_files(index_run, tmp_path):
+    mapping_fp, fps = index_run(read_count=500)
+    result = run_pipeline(fps, mapping_fp, tmp_path / 'steps')
+    assert result.returncode == 0, result.stderr
+    result = run_pipeline(fps, mapping_fp, tmp_path / 'lean', '--lean')
+    assert result.returncode == 0, result.stderr
+
+    lean_dirs = sorted(name for name in os.listdir(str(tmp_path / 'lean')) if name.startswith('step_'))
+    assert lean_dirs == ['step_04_make_paired_end_files']
+    steps_dir = tmp_path / 'steps' / 'step_04_make_paired_end_files' / 'run1_R1'
+    lean_dir = tmp_path / 'lean' / 'step_04_make_paired_end_files' / 'run1_R1'
+    fastq_names = sorted(name for name in os.listdir(str(steps_dir)) if name.endswith('.fastq'))
+    assert sorted(name for name in os.listdir(str(lean_dir)) if name.endswith('.fastq')) == fastq_names
+    for name in fastq_names:
+        assert read_fastq(lean_dir / name) == read_fastq(steps_dir / name)
+
+    # the lean run reads its inputs once and writes little besides the final files
+    steps_written, steps_read, _ = IOAudit(str(tmp_path / 'steps'), 'run1_R1').get_totals()
+    lean_written, lean_read, lean_final = IOAudit(str(tmp_path / 'lean'), 'run1_R1').get_totals()
+    assert lean_written < 1.1 * lean_final
+    assert lean_written < steps_written / 2
+    assert lean_read < steps_read / 2
+
+
+def test_io_audit_of_each_step(index_run, tmp_path):
+    mapping_fp, fps = index_run(read_count=300)
+    work_dir = tmp_path / 'work'
+    result = run_pipeline(fps, mapping_fp, work_dir)
+    assert result.returncode == 0, result.stderr
+    audit = IOAudit(str(work_dir), 'run1_R1')
+    assert sorted(audit.steps) == [
+        'step_02_split_libraries', 'step_03_demultiplex', 'step_04_make_paired_end_files']
+    assert [name for name, step in sorted(audit.steps.items()) if step['final']] == ['step_04_make_paired_end_files']
+    step_03_dir = work_dir / 'step_03_demultiplex' / 'run1_R1'
+    for name, size in audit.steps['step_03_demultiplex']['written'].items():
+        assert os.path.getsize(str(step_03_dir / name)) == size
+    result = run_script('io_audit.py', work_dir)
+    assert result.returncode == 0, result.stderr
+    assert 'written per final byte' in result.stdout
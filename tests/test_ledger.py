@@ -0,0 +1,32 @@
+import json
+
+from conftest import run_script
+from ledger import reconcile
+
+
+def test_reconcile_flags_sample_count_change():
+    steps = {
+        'step_03_demultiplex': {'in': 10, 'assigned': {'Sample1': 6, 'Sample2': 4}, 'unassigned': 0, 'filtered': {}},
+        'step_04_make_paired_end_files': {'in': 10, 'assigned': {'Sample1': 5, 'Sample2': 4}, 'unassigned': 1, 'filtered': {}},
+    }
+    problems = reconcile(steps)
+    assert problems == ['step_03_demultiplex -> step_04_make_paired_end_files: sample "Sample1" has 6 reads then 5']
+
+
+def test_paired_run_keys_step_04_by_sample(index_run, tmp_path):
+    mapping_fp, fps = index_run()
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    result = run_script(
+        'pipeline.py', '-i', fps['R1'], '-p', fps['R2'], '-d', fps['I1'], '-m', mapping_fp, '-b', 12,
+        '-w', work_dir, '--backend', 'native')
+    assert result.returncode == 0, result.stderr
+    assert 'read ledger' not in result.stderr
+
+    with open(work_dir / 'ledger' / 'run1_R1.json', 'rt') as ledger_file:
+        steps = json.load(ledger_file)
+    step_03 = steps['step_03_demultiplex']['assigned']
+    step_04 = steps['step_04_make_paired_end_files']['assigned']
+    assert sorted(step_04) == ['Sample1', 'Sample2', 'Sample3']
+    assert step_04 == step_03
+    assert reconcile(steps) == []
@@ -0,0 +1,34 @@
+import pytest
+
+from output_registry import OutputRegistry, get_single_path
+from pipeline_util import PipelineException
+
+
+def test_only_registered_files_are_renamed(tmp_path):
+    (tmp_path / 'earlier.fastq').write_text('')
+    registry = OutputRegistry(str(tmp_path))
+    registry.add_files(['earlier.fastq'])
+    for name in ('reads1.fastq', 'reads2.fastq', 'barcodes.fastq', 'log'):
+        (tmp_path / name).write_text('')
+    new_names = registry.add_new_files()
+    assert new_names == ['barcodes.fastq', 'log', 'reads1.fastq', 'reads2.fastq']
+    assert registry.rename_with_prefix('run1', new_names) == ['run1_barcodes.fastq', 'run1_R1.fastq', 'run1_R2.fastq']
+    registry.save()
+
+    # the log keeps its name and the file registered before is left alone
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        '.outputs', 'earlier.fastq', 'log', 'run1_R1.fastq', 'run1_R2.fastq', 'run1_barcodes.fastq']
+    loaded = OutputRegistry.load(str(tmp_path))
+    assert loaded.names == ['earlier.fastq', 'run1_barcodes.fastq', 'log', 'run1_R1.fastq', 'run1_R2.fastq']
+    assert get_single_path(loaded, '*_R1.fastq') == str(tmp_path / 'run1_R1.fastq')
+    with pytest.raises(PipelineException, match='found 2 files'):
+        get_single_path(loaded, 'run1_R?.fastq')
+
+
+def test_directory_without_a_manifest_is_listed_once(tmp_path):
+    for name in ('b.fastq', 'a.fastq'):
+        (tmp_path / name).write_text('')
+    (tmp_path / 'subdir').mkdir()
+    registry = OutputRegistry.load(str(tmp_path))
+    assert registry.names == ['a.fastq', 'b.fastq']
+    assert registry.get_paths('a*') == [str(tmp_path / 'a.fastq')]
@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+import time
+
+from pipeline_util import get_process_tree, pop_command_metrics, run_cmd, wait_and_measure
+
+
+# holds 64 MB, starts a copy of itself that holds another 64 MB and waits for it
+memory_holder = '''
+import subprocess, sys, time
+held = bytearray(64 * 2**20)
+if len(sys.argv) > 1:
+    subprocess.run([sys.executable, '-c', sys.argv[1]])
+else:
+    time.sleep(1.5)
+'''
+
+
+def test_sample_tree_sums_parent_and_child_rss():
+    start = time.time()
+    process = subprocess.Popen([sys.executable, '-c', memory_holder, memory_holder])
+    metrics = wait_and_measure(process, sample_interval=0.1, start=start, sample_tree=True)
+    assert metrics['exit_code'] == 0
+    # os.wait4 reports the larger of the two processes, the samples both at once
+    assert metrics['max_rss_kb'] < 100 * 2**10
+    assert metrics['sampled_tree_max_rss_kb'] > 128 * 2**10
+
+
+# burns CPU, writes 8 MB and stays alive long enough to be sampled after the write
+busy_writer = '''
+import sys, time
+sum(i * i for i in range(2 * 10**6))
+with open(sys.argv[1], 'wb') as output_file:
+    output_file.write(bytes(8 * 2**20))
+time.sleep(0.5)
+'''
+
+
+def test_run_cmd_records_command_metrics(tmp_path):
+    pop_command_metrics()
+    log_fp = str(tmp_path / 'log')
+    exit_code = run_cmd([sys.executable, '-c', busy_writer, str(tmp_path / 'out')], log_fp, sample_interval=0.1)
+    assert exit_code == 0
+    metrics, = pop_command_metrics()
+    assert pop_command_metrics() == []
+    assert metrics['command'] == os.path.basename(sys.executable)
+    assert metrics['exit_code'] == 0
+    assert metrics['user_seconds'] > 0
+    assert metrics['seconds'] >= 0.5
+    assert metrics['max_rss_kb'] > 0
+    assert metrics['wchar'] >= 8 * 2**20
+    with open(log_fp, 'rt') as log_file:
+        assert '\nresources: ' in log_file.read()
+
+
+def test_process_tree_includes_children():
+    process = subprocess.Popen([sys.executable, '-c', memory_holder, memory_holder])
+    try:
+        deadline = time.time() + 10
+        while len(get_process_tree(process.pid)) < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        assert len(get_process_tree(process.pid)) == 2
+        assert get_process_tree(process.pid)[0] == process.pid
+    finally:
+        process.wait()
@@ -0,0 +1,35 @@
+import json
+
+from plan import choose_worker_count, format_slurm_time, make_plan
+
+
+def test_plan_of_an_index_run(index_run, tmp_path):
+    mapping_fp, fps = index_run(read_count=3000)
+    work_dir = tmp_path / 'work'
+    plan = make_plan(
+        str(fps['R1']), str(mapping_fp), 12, paired_ends=str(fps['R2']), index_file=str(fps['I1']),
+        work_dir=str(work_dir), plan_sample_size=500, plan_cores=4)
+    file_plan, = plan['files']
+    # the sample window covers the whole file, 1 read in 10 has an unknown index
+    assert file_plan['estimated_reads'] == 3000
+    assert 0.8 < file_plan['match_rate'] < 1.0
+    assert file_plan['forward_orientation_match_rate'] == 0.0
+    # no step 01 with an index file, step 04 with paired ends
+    assert sorted(file_plan['step_bytes']) == [
+        'step_02_split_libraries', 'step_03_demultiplex', 'step_04_make_paired_end_files']
+    assert file_plan['peak_bytes'] >= max(file_plan['step_bytes'].values())
+    assert plan['workers'] == 1
+    with open(str(work_dir / 'plan.json'), 'rt') as plan_file:
+        assert json.load(plan_file) == json.loads(json.dumps(plan))
+
+
+def test_worker_count():
+    # fewest workers within 5% of the best makespan
+    assert choose_worker_count([10.0] * 4, 8) == (4, 10.0)
+    assert choose_worker_count([100.0, 1.0, 1.0], 8) == (1, 102.0)
+    assert choose_worker_count([10.0] * 8, 2) == (2, 40.0)
+
+
+def test_format_slurm_time():
+    assert format_slurm_time(3661) == '01:01:01'
+    assert format_slurm_time(0.2) == '00:00:01'
@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+
+from conftest import run_script
+from pipeline import Pipeline
+from pipeline_util import PipelineException
+from profiler import SamplingProfiler
+
+
+def busy_loop(iterations):
+    total = 0
+    for i in range(iterations):
+        total += i * i
+    return total
+
+
+def test_profile_files(tmp_path):
+    with SamplingProfiler(interval=0.001) as profiler:
+        while profiler.sample_count < 20:
+            busy_loop(10000)
+    functions_fp, lines_fp, collapsed_fp = profiler.write(str(tmp_path), prefix='busy')
+    with open(functions_fp, 'rt') as functions_file:
+        assert 'busy_loop' in functions_file.read()
+    with open(collapsed_fp, 'rt') as collapsed_file:
+        samples = sum(int(line.rsplit(' ', 1)[1]) for line in collapsed_file)
+    assert samples == profiler.sample_count
+    with open(lines_fp, 'rt') as lines_file:
+        assert lines_file.readline().startswith('{} samples'.format(profiler.sample_count))
+
+
+def test_failed_step_stops_the_profiler(index_run, tmp_path, monkeypatch):
+    mapping_fp, fps = index_run(read_count=100)
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    # no QIIME scripts on the PATH, step 02 fails after its profiler has started
+    monkeypatch.setenv('PATH', str(tmp_path))
+    pipeline = Pipeline(
+        input_file=str(fps['R1']), work_dir=str(work_dir), mapping_file=str(mapping_fp), barcode_length=12,
+        paired_ends='', index_file=str(fps['I1']), max_barcode_errors=1.5, profile=True)
+    threads = set(threading.enumerate())
+    with pytest.raises(PipelineException):
+        pipeline.run(input_file=str(fps['R1']))
+    assert pipeline.profiler is None
+    assert set(threading.enumerate()) <= threads
+
+
+def test_profile_is_written_to_the_step_directory(index_run, tmp_path):
+    mapping_fp, fps = index_run(read_count=100)
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    result = run_script(
+        'pipeline.py', '-i', fps['R1'], '-d', fps['I1'], '-m', mapping_fp, '-b', 12, '-w', work_dir,
+        '--backend', 'native', '--profile')
+    assert result.returncode == 0, result.stderr
+    step_dir = work_dir / 'step_03_demultiplex' / 'run1_R1'
+    assert sorted(p.name for p in step_dir.glob('profile*')) == [
+        'profile.collapsed', 'profile_functions.txt', 'profile_lines.txt']
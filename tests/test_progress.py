@@ -0,0 +1,39 @@
+import json
+import os
+import random
+
+from conftest import run_script
+from progress import ProgressReporter
+
+
+def test_step_without_inputs(tmp_path):
+    reporter = ProgressReporter(str(tmp_path), 'run1', interval=0.01)
+    reporter.start_step('step_04_make_paired_end_files')
+    reporter.set_inputs([])
+    reporter.sample()
+    reporter.finish_step()
+    reporter.close()
+    with open(os.path.join(str(tmp_path), 'progress', 'run1.json'), 'rt') as status_file:
+        status = json.load(status_file)
+    assert status['state'] == 'done'
+    assert status['steps'][0]['step'] == 'step_04_make_paired_end_files'
+
+
+def test_paired_run_with_no_known_barcodes(tmp_path):
+    rng = random.Random(0)
+    mapping_fp = tmp_path / 'map.txt'
+    mapping_fp.write_text(
+        '#SampleID\tBarcodeSequence\tLinkerPrimerSequence\tDescription\nSample1\tACGTACGTACGT\tAAA\tx\n')
+    for name, number in (('R1', 1), ('R2', 2)):
+        with open(tmp_path / 'run1_{}.fastq'.format(name), 'wt') as fastq_file:
+            for i in range(200):
+                seq = ''.join(rng.choice('ACG') for _ in range(100))
+                fastq_file.write('@M001:{} {}:N:0:1\n{}\n+\n{}\n'.format(i, number, seq, 'I' * len(seq)))
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    result = run_script(
+        'pipeline.py', '-i', tmp_path / 'run1_R1.fastq', '-p', tmp_path / 'run1_R2.fastq', '-m', mapping_fp,
+        '-b', 12, '-w', work_dir, '--backend', 'native', '--progress', '--progress-interval', 0.01)
+    assert result.returncode == 0, result.stderr
+    with open(work_dir / 'progress' / 'run1_R1.json', 'rt') as status_file:
+        assert json.load(status_file)['state'] == 'done'
@@ -0,0 +1,87 @@
+import os
+import random
+
+import pytest
+
+from conftest import read_fastq, run_script
+from output_registry import OutputRegistry
+from pipeline_util import PipelineException
+from read_store import ReadStore, ReadStoreWriter, fastq_to_store
+
+
+def write_reads(fastq_fp, read_count=300, seed=0):
+    # lengths that are not a multiple of 4 and a few N bases, so 2-bit reads start and end inside a byte
+    rng = random.Random(seed)
+    with open(fastq_fp, 'wt') as fastq_file:
+        for n in range(read_count):
+            seq = ''.join(rng.choice('ACGT' * 20 + 'N') for _ in range(rng.randint(1, 37)))
+            qual = ''.join(chr(33 + rng.randrange(41)) for _ in seq)
+            fastq_file.write('@M001:1:FC:1:1101:{} 1:N:0:1\n{}\n+\n{}\n'.format(n, seq, qual))
+    return read_fastq(fastq_fp)
+
+
+@pytest.mark.parametrize('encoding', ['uint8', '2bit'])
+def test_round_trip(tmp_path, encoding):
+    fastq_fp = str(tmp_path / 'Sample1.fastq')
+    records = write_reads(fastq_fp)
+    assert any('N' in seq for _, seq, _, _ in records)
+    store_fp = str(tmp_path / 'Sample1.rds')
+    assert fastq_to_store(fastq_fp, store_fp, encoding=encoding) == len(records)
+
+    with ReadStore(store_fp) as store:
+        assert len(store) == len(records)
+        assert store.encoding == encoding
+        base_count = sum(len(seq) for _, seq, _, _ in records)
+        assert store.base_count == base_count
+        seq_bytes = store.columns['seq'][1]
+        assert seq_bytes == ((base_count + 3) // 4 if encoding == '2bit' else base_count)
+        # records are read in any order
+        for record_number in (117, 0, len(records) - 1, 5):
+            header, seq, _, qual = records[record_number]
+            assert store.get_record(record_number) == (header, seq, qual)
+        output_fp = str(tmp_path / 'round_trip.fastq')
+        store.to_fastq(output_fp)
+    assert read_fastq(output_fp) == records
+
+
+def test_sequences_as_one_array(tmp_path):
+    numpy = pytest.importorskip('numpy')
+    fastq_fp = str(tmp_path / 'Sample1.fastq')
+    records = write_reads(fastq_fp, read_count=50)
+    store_fp = str(tmp_path / 'Sample1.rds')
+    fastq_to_store(fastq_fp, store_fp, encoding='2bit')
+    with ReadStore(store_fp) as store:
+        assert store.get_sequences().tobytes().decode('ascii') == ''.join(seq for _, seq, _, _ in records)
+        assert numpy.array_equal(store.get_column('offsets')[:2], [0, len(records[0][1])])
+
+
+def test_bad_records(tmp_path):
+    store_fp = str(tmp_path / 'Sample1.rds')
+    with pytest.raises(PipelineException, match='only A, C, G, T and N'):
+        with ReadStoreWriter(store_fp, encoding='2bit') as writer:
+            writer.add('@read1', 'ACGRT', 'IIIII')
+    with pytest.raises(PipelineException, match='5 bases but 4 quality scores'):
+        with ReadStoreWriter(store_fp) as writer:
+            writer.add('@read1', 'ACGTA', 'IIII')
+    # nothing is left behind by a writer that failed
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_pipeline_writes_read_stores_instead_of_fastq(index_run, tmp_path):
+    mapping_fp, fps = index_run(read_count=300)
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    result = run_script(
+        'pipeline.py', '-i', fps['R1'], '-d', fps['I1'], '-m', mapping_fp, '-b', 12, '-w', work_dir,
+        '--backend', 'native', '--output-format', 'read-store', '--read-store-encoding', '2bit')
+    assert result.returncode == 0, result.stderr
+    registry = OutputRegistry.load(str(work_dir / 'step_03_demultiplex' / 'run1_R1'))
+    store_fps = registry.get_paths('*.rds')
+    assert len(store_fps) == 3
+    assert registry.get_paths('*.fastq') == [] and registry.get_paths('*.idx') == []
+    read_count = 0
+    for store_fp in store_fps:
+        with ReadStore(store_fp) as store:
+            read_count += len(store)
+    # 1 read in 10 has an unknown index
+    assert read_count == 270
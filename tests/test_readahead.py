@@ -0,0 +1,47 @@
+import gzip
+import shutil
+import threading
+
+import pytest
+
+from conftest import read_fastq
+from pipeline_util import PipelineException
+from readahead import SynchronizedReader
+
+
+def test_records_come_out_aligned(index_run, tmp_path):
+    mapping_fp, fps = index_run(read_count=1000)
+    # a compressed stream is read alongside uncompressed ones
+    index_gz_fp = str(tmp_path / 'run1_I1.fastq.gz')
+    with open(fps['I1'], 'rb') as index_file, gzip.open(index_gz_fp, 'wb') as index_gz_file:
+        shutil.copyfileobj(index_file, index_gz_file)
+    records = list(SynchronizedReader([str(fps['R1']), str(fps['R2']), index_gz_fp], batch_size=64, queue_depth=2))
+    assert records == list(zip(read_fastq(fps['R1']), read_fastq(fps['R2']), read_fastq(fps['I1'])))
+
+
+def test_different_record_counts(index_run, tmp_path):
+    mapping_fp, fps = index_run(read_count=100)
+    short_fp = tmp_path / 'short.fastq'
+    with open(fps['R2'], 'rt') as reverse_file:
+        short_fp.write_text(''.join(reverse_file.readlines()[:4 * 99]))
+    with pytest.raises(PipelineException, match='different numbers of records'):
+        list(SynchronizedReader([str(fps['R1']), str(short_fp)], batch_size=16))
+
+
+def test_mismatched_read_ids(index_run, tmp_path):
+    mapping_fp, fps = index_run(read_count=100)
+    shifted_fp = tmp_path / 'shifted.fastq'
+    with open(fps['R2'], 'rt') as reverse_file:
+        lines = reverse_file.readlines()
+    shifted_fp.write_text(''.join(lines[4:] + lines[:4]))
+    with pytest.raises(PipelineException, match='read IDs do not match'):
+        list(SynchronizedReader([str(fps['R1']), str(shifted_fp)]))
+
+
+def test_stopping_early_stops_the_threads(index_run):
+    mapping_fp, fps = index_run(read_count=1000)
+    threads = set(threading.enumerate())
+    reader = iter(SynchronizedReader([str(fps['R1']), str(fps['R2'])], batch_size=8, queue_depth=1))
+    next(reader)
+    reader.close()
+    assert set(threading.enumerate()) <= threads
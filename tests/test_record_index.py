@@ -0,0 +1,91 @@
+import os
+import sys
+
+import pytest
+
+from conftest import read_fastq, run_script
+from output_registry import OutputRegistry
+from record_index import build_index, count_records, get_chunks, get_index_fp
+
+
+# stand in for the QIIME scripts: split_libraries_fastq.py copies a seqs file the native backend wrote,
+# split_sequence_file_on_sample_ids.py writes one SAMPLE.fastq per sample as QIIME does
+fake_split_libraries = '''#!/bin/sh
+cp "$QIIME_SEQS_FP" "$2/seqs.fastq"
+cp "$QIIME_LOG_FP" "$2/split_library_log.txt"
+'''
+
+fake_split_sequence_file = '''#!{python}
+import os, sys
+sample_files = {{}}
+with open(sys.argv[2]) as seqs_file:
+    lines = seqs_file.readlines()
+for n in range(0, len(lines), 4):
+    sample_id = lines[n][1:].split('_')[0]
+    if sample_id not in sample_files:
+        sample_files[sample_id] = open(os.path.join(sys.argv[4], sample_id + '.fastq'), 'w')
+    sample_files[sample_id].writelines(lines[n:n + 4])
+'''
+
+
+@pytest.fixture
+def fake_qiime_env(tmp_path):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    for script_name, script in (
+            ('split_libraries_fastq.py', fake_split_libraries),
+            ('split_sequence_file_on_sample_ids.py', fake_split_sequence_file.format(python=sys.executable))):
+        script_fp = bin_dir / script_name
+        script_fp.write_text(script)
+        script_fp.chmod(0o755)
+    return dict(os.environ, PATH='{}:{}'.format(bin_dir, os.environ['PATH']))
+
+
+def test_chunks_of_an_empty_file(tmp_path):
+    fastq_fp = str(tmp_path / 'empty.fastq')
+    open(fastq_fp, 'w').close()
+    assert build_index(fastq_fp) == 0
+    assert get_chunks(fastq_fp, 3) == []
+
+
+def test_chunks_cover_every_record(tmp_path):
+    fastq_fp = str(tmp_path / 'reads.fastq')
+    with open(fastq_fp, 'w') as fastq_file:
+        for n in range(100):
+            fastq_file.write('@read{}\n{}\n+\n{}\n'.format(n, 'A' * (n % 7 + 1), 'I' * (n % 7 + 1)))
+    build_index(fastq_fp, every=8)
+    chunks = get_chunks(fastq_fp, 3)
+    assert len(chunks) == 3
+    assert chunks[0][0] == 0
+    assert chunks[-1][1] == os.path.getsize(fastq_fp)
+    assert all(end == next_start for (_, end, _), (next_start, _, _) in zip(chunks, chunks[1:]))
+    assert sum(record_count for _, _, record_count in chunks) == 100
+
+
+def test_qiime_step_03_outputs_are_indexed(index_run, tmp_path, fake_qiime_env):
+    mapping_fp, fps = index_run(read_count=300)
+    native_dir = tmp_path / 'native'
+    native_dir.mkdir()
+    result = run_script(
+        'pipeline.py', '-i', fps['R1'], '-d', fps['I1'], '-m', mapping_fp, '-b', 12, '-w', native_dir,
+        '--backend', 'native')
+    assert result.returncode == 0, result.stderr
+    native_seqs_dir = native_dir / 'step_02_split_libraries' / 'run1_R1'
+
+    qiime_dir = tmp_path / 'qiime'
+    qiime_dir.mkdir()
+    result = run_script(
+        'pipeline.py', '-i', fps['R1'], '-d', fps['I1'], '-m', mapping_fp, '-b', 12, '-w', qiime_dir,
+        '--no-index-cache', '--index-every', 16,
+        env=dict(
+            fake_qiime_env,
+            QIIME_SEQS_FP=str(native_seqs_dir / 'run1_R1_seqs.fastq'),
+            QIIME_LOG_FP=str(native_seqs_dir / 'run1_R1_split_library_log.txt')))
+    assert result.returncode == 0, result.stderr
+
+    registry = OutputRegistry.load(str(qiime_dir / 'step_03_demultiplex' / 'run1_R1'))
+    sample_fps = registry.get_paths('*.fastq')
+    assert [os.path.basename(fp) for fp in sample_fps] == ['run1_R1_Sample1.fastq', 'run1_R1_Sample2.fastq', 'run1_R1_Sample3.fastq']
+    assert registry.get_paths('*.idx') == [get_index_fp(fp) for fp in sample_fps]
+    for sample_fp in sample_fps:
+        assert count_records(sample_fp) == len(read_fastq(sample_fp))
@@ -0,0 +1,72 @@
+import json
+import os
+
+import pytest
+
+from conftest import run_script
+from pipeline_util import CommandKilledException, PipelineException, check_cmd, killed_exit_code
+from scheduler import AdmissionScheduler, PipelineJob
+
+
+# stands in for split_libraries_fastq.py: writes part of its output and is killed
+killed_split_libraries = '''#!/bin/sh
+echo partial > "$2/seqs.fastq"
+kill -9 $$
+'''
+
+
+@pytest.fixture
+def killed_qiime_path(tmp_path):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script_fp = bin_dir / 'split_libraries_fastq.py'
+    script_fp.write_text(killed_split_libraries)
+    script_fp.chmod(0o755)
+    return '{}:{}'.format(bin_dir, os.environ['PATH'])
+
+
+def test_check_cmd(tmp_path):
+    log_fp = str(tmp_path / 'log')
+    check_cmd(['true'], log_fp)
+    with pytest.raises(PipelineException, match='exit code 1'):
+        check_cmd(['false'], log_fp)
+    with pytest.raises(CommandKilledException):
+        check_cmd(['sh', '-c', 'kill -9 $$'], log_fp)
+
+
+def test_killed_command_fails_the_step(index_run, tmp_path, killed_qiime_path):
+    mapping_fp, fps = index_run(read_count=100)
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    result = run_script(
+        'pipeline.py', '-i', fps['R1'], '-d', fps['I1'], '-m', mapping_fp, '-b', 12, '-w', work_dir,
+        env=dict(os.environ, PATH=killed_qiime_path))
+    assert result.returncode == killed_exit_code, result.stderr
+    # no partial outputs for the next run to skip
+    assert not os.path.exists(work_dir / 'step_02_split_libraries' / 'run1_R1')
+
+
+def test_killed_job_is_retried_once_and_not_kept_in_history(index_run, tmp_path, killed_qiime_path):
+    mapping_fp, fps = index_run(read_count=100)
+    input_dir = tmp_path / 'input'
+    input_dir.mkdir()
+    os.symlink(str(fps['R1']), str(input_dir / 'run1_R1.fastq'))
+    work_dir = tmp_path / 'work'
+    result = run_script(
+        'scheduler.py', '-i', input_dir, '-w', work_dir, '--memory-gb', 4, '--workers', 1,
+        '--', '-d', fps['I1'], '-m', mapping_fp, '-b', 12,
+        env=dict(os.environ, PATH=killed_qiime_path))
+    assert result.returncode == 1
+    assert result.stderr.count('running it again alone') == 1
+    assert 'failed with exit code {}'.format(killed_exit_code) in result.stderr
+    assert not os.path.exists(work_dir / 'metrics' / 'memory_history.json')
+
+
+
+def test_job_that_cannot_start_is_reported_as_failed(tmp_path):
+    scheduler = AdmissionScheduler(str(tmp_path), memory_budget=2**30, workers=1)
+    job = PipelineJob(str(tmp_path / 'run1_R1.fastq'), [], 'qiime', 0, 2**20)
+    # the job's log path is a directory, so opening the log fails before pipeline.py starts
+    os.makedirs(scheduler.get_log_fp(job))
+    assert scheduler.run([job]) == [job]
+    assert job.attempts == 1
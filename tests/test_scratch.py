@@ -0,0 +1,50 @@
+import os
+
+from conftest import read_fastq, run_script
+
+
+def run_pipeline(fps, mapping_fp, work_dir, *extra_args, **kwargs):
+    if not work_dir.exists():
+        work_dir.mkdir()
+    return run_script(
+        'pipeline.py', '-i', fps['R1'], '-p', fps['R2'], '-d', fps['I1'], '-m', mapping_fp, '-b', 12,
+        '-w', work_dir, *extra_args, **kwargs)
+
+
+def test_only_the_final_files_leave_scratch(index_run, tmp_path):
+    mapping_fp, fps = index_run(read_count=500)
+    result = run_pipeline(fps, mapping_fp, tmp_path / 'direct', '--backend', 'native')
+    assert result.returncode == 0, result.stderr
+    scratch_dir = tmp_path / 'scratch'
+    scratch_dir.mkdir()
+    work_dir = tmp_path / 'staged'
+    result = run_pipeline(fps, mapping_fp, work_dir, '--backend', 'native', '--scratch-dir', scratch_dir)
+    assert result.returncode == 0, result.stderr
+
+    step_dirs = sorted(name for name in os.listdir(str(work_dir)) if name.startswith('step_'))
+    assert step_dirs == ['step_04_make_paired_end_files']
+    assert os.listdir(str(scratch_dir)) == []
+    final_dir = work_dir / 'step_04_make_paired_end_files' / 'run1_R1'
+    direct_dir = tmp_path / 'direct' / 'step_04_make_paired_end_files' / 'run1_R1'
+    fastq_names = sorted(name for name in os.listdir(str(direct_dir)) if name.endswith('.fastq'))
+    assert len(fastq_names) == 6
+    assert sorted(name for name in os.listdir(str(final_dir)) if name.endswith('.fastq')) == fastq_names
+    for name in fastq_names:
+        assert read_fastq(final_dir / name) == read_fastq(direct_dir / name)
+
+    # the final directory is filled, so a second run stages nothing
+    result = run_pipeline(fps, mapping_fp, work_dir, '--backend', 'native', '--scratch-dir', scratch_dir)
+    assert result.returncode == 0, result.stderr
+    assert 'nothing to stage' in result.stderr
+
+
+def test_scratch_is_removed_when_a_step_fails(index_run, tmp_path):
+    mapping_fp, fps = index_run(read_count=100)
+    scratch_dir = tmp_path / 'scratch'
+    scratch_dir.mkdir()
+    # no QIIME scripts on the PATH, step 02 fails
+    result = run_pipeline(
+        fps, mapping_fp, tmp_path / 'work', '--scratch-dir', scratch_dir, env=dict(os.environ, PATH=str(tmp_path)))
+    assert result.returncode != 0
+    assert 'staging intermediate steps in' in result.stderr
+    assert os.listdir(str(scratch_dir)) == []
@@ -0,0 +1,70 @@
+import json
+import os
+import queue
+import signal
+import threading
+import time
+
+import pytest
+
+import service
+
+
+def run_test_job(argv):
+    # stands in for service.run_job in the forked workers
+    if argv == ['die']:
+        os.kill(os.getpid(), signal.SIGKILL)
+    return [], {}
+
+
+@pytest.fixture
+def test_service(monkeypatch):
+    monkeypatch.setattr(service, 'run_job', run_test_job)
+    demultiplex_service = service.DemultiplexService(worker_count=1)
+    yield demultiplex_service
+    demultiplex_service.close()
+
+
+def run(demultiplex_service, argv, timeout=30):
+    events = queue.Queue()
+    demultiplex_service.submit(argv, os.getcwd(), events.put)
+    while True:
+        event = events.get(timeout=timeout)
+        if event['event'] in service.final_events:
+            return event
+
+
+def wait_for(path, timeout=30):
+    deadline = time.time() + timeout
+    while not os.path.exists(path):
+        assert time.time() < deadline, 'no "{}"'.format(path)
+        time.sleep(0.05)
+
+
+def test_dead_worker_fails_its_job_and_is_replaced(test_service):
+    event = run(test_service, ['die'])
+    assert event['event'] == 'failed'
+    assert 'died' in event['message']
+    assert run(test_service, ['-i', 'reads.fastq'])['event'] == 'done'
+
+
+def test_bad_spool_jobs_fail_alone(test_service, tmp_path):
+    spool_dir = str(tmp_path)
+    threading.Thread(target=test_service.watch_spool_dir, args=(spool_dir, 0.05), daemon=True).start()
+    wait_for(os.path.join(spool_dir, 'incoming'))
+    jobs = {
+        'a_malformed.json': '{"args": [',
+        'b_no_args.json': '{"cwd": "/"}',
+        'c_good.json': json.dumps({'args': ['-i', 'reads.fastq']}),
+    }
+    for job_file_name, content in jobs.items():
+        with open(os.path.join(spool_dir, job_file_name + '.tmp'), 'wt') as job_file:
+            job_file.write(content)
+    for job_file_name in sorted(jobs):
+        os.rename(os.path.join(spool_dir, job_file_name + '.tmp'), os.path.join(spool_dir, 'incoming', job_file_name))
+
+    wait_for(os.path.join(spool_dir, 'done', 'c_good.json'))
+    for job_file_name in ('a_malformed.json', 'b_no_args.json'):
+        assert os.path.exists(os.path.join(spool_dir, 'failed', job_file_name))
+        with open(os.path.join(spool_dir, 'status', job_file_name.replace('.json', '.jsonl')), 'rt') as status_file:
+            assert json.loads(status_file.readline())['event'] == 'failed'
@@ -0,0 +1,37 @@
+import subprocess
+import sys
+import time
+
+from conftest import scripts_dir
+
+
+# pipeline.py runs once per input file, what it imports before parsing its arguments is paid every time
+startup_budget_seconds = 0.2
+heavy_modules = ('qiime', 'numpy', 'matplotlib', 'scipy', 'pandas')
+
+
+def get_best_seconds(cmd_line_list, runs=3):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd_line_list, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True, cwd=scripts_dir)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def test_help_imports_no_heavy_modules():
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', 'pipeline.py', '--help'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, cwd=scripts_dir)
+    assert result.returncode == 0, result.stderr
+    imported = {line.rsplit('|', 1)[-1].strip().split('.')[0] for line in result.stderr.splitlines()}
+    assert imported.isdisjoint(heavy_modules), sorted(imported.intersection(heavy_modules))
+
+
+def test_help_starts_within_budget():
+    # the interpreter's own startup is not counted
+    interpreter_seconds = get_best_seconds([sys.executable, '-c', 'pass'])
+    help_seconds = get_best_seconds([sys.executable, 'pipeline.py', '--help'])
+    assert help_seconds - interpreter_seconds < startup_budget_seconds, \
+        'pipeline.py --help took {:.3f} s over interpreter startup'.format(help_seconds - interpreter_seconds)
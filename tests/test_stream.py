@@ -0,0 +1,21 @@
+from conftest import write_dual_index_run
+from demux import split_libraries
+from stream import SampleBatchStream
+
+
+def test_stream_counts_match_split_libraries(tmp_path):
+    mapping_fp, fps = write_dual_index_run(tmp_path)
+    stream = SampleBatchStream(str(mapping_fp), 8, str(fps['R1']), index=str(fps['I1']), index2=str(fps['I2']))
+    for _ in stream:
+        pass
+
+    output_dir = tmp_path / 'split'
+    output_dir.mkdir()
+    counts, sample_counts = split_libraries(
+        [str(fps['R1'])], [str(fps['I1'])], str(output_dir), str(mapping_fp), 8, index2_fp_list=[str(fps['I2'])])
+
+    assert stream.counts['index_hopped'] > 0
+    assert stream.counts['unassigned'] == counts['unassigned'] == 100
+    assert stream.counts['index_hopped'] == counts['index_hopped']
+    assert stream.counts['samples'] == sample_counts
+    assert stream.counts['input'] == sum(sample_counts.values()) + counts['unassigned'] + counts['index_hopped']